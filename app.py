@@ -1,10 +1,18 @@
-from flask import Flask, request, jsonify
-from werkzeug.exceptions import BadRequest, HTTPException, Conflict
+from flask import Flask, Response, request, jsonify
+from werkzeug.exceptions import BadRequest, HTTPException, Conflict, ServiceUnavailable, TooManyRequests, UnprocessableEntity
 from threading import Lock
+import atexit
+import json
+import os
 import time
+import zlib
 from OsmoCaseStudy.database import FragranceDatabase
+from OsmoCaseStudy.duplicate_filter import DuplicateFilter
+from OsmoCaseStudy.group_commit import GroupCommitter
 from OsmoCaseStudy.queue import FormulaCreatedQueue
-from OsmoCaseStudy.validations import validate_request
+from OsmoCaseStudy.validations import (
+    request_fingerprint, validate_request, validate_deltas, validate_export_options, validate_publish_options,
+)
 
 class FragranceServer: 
     """
@@ -13,12 +21,11 @@ class FragranceServer:
     - saves them to a database and
     - publishes them to a message queue that could inform downstream services that a new formula has been added
     """
-    def __init__(self):
+    def __init__(self, db=None, queue=None, group_commit_window=None, group_commit_max_batch=64):
         self.app = Flask(__name__)
-        self.db = FragranceDatabase()
-        self.q = FormulaCreatedQueue()
+        self.setup_storage(db, queue, group_commit_window, group_commit_max_batch)
 
-        self.idempotency_cache = {} # Key: key from header, Value: response from submit_formula
+        self.idempotency_cache = {} # Key: key from header, Value: (request fingerprint, response) - shared by POST and PATCH
         self.idempotency_lock = Lock()
 
         self.register_routes() 
@@ -26,6 +33,17 @@ class FragranceServer:
         # This is for neatly printing error messages to output
         self.app.register_error_handler(HTTPException, self.handle_http_error)
 
+    def setup_storage(self, db, queue, group_commit_window, group_commit_max_batch):
+        # overridden by servers whose storage lives elsewhere (see ShardedFragranceServer)
+        self.db = db if db is not None else FragranceDatabase()
+        self.q = queue if queue is not None else FormulaCreatedQueue()
+
+        # With a window (seconds), concurrent submissions are committed together in batches - see GroupCommitter
+        self.group_committer = None
+        if group_commit_window is not None:
+            self.group_committer = GroupCommitter(self.publish_with_retry, self.db, self.q,
+                                                  window=group_commit_window, max_batch=group_commit_max_batch)
+
     def register_routes(self):
         @self.app.route("/formulas", methods=["POST"])
         def submit_formula():
@@ -34,41 +52,186 @@ class FragranceServer:
             idempotency_key = request.headers.get("Idempotency-Key")
             if not idempotency_key:
                 raise BadRequest("Missing Idempotency-Key header")
-            with self.idempotency_lock:
-                if idempotency_key in self.idempotency_cache:
-                    # Return same response as original request
-                    response = self.idempotency_cache[idempotency_key]
-                    return self.parse_response(response)
+            fingerprint = request_fingerprint(request.method, request.path, request.get_data())
+            seen, response = self.idempotency_lookup(idempotency_key, fingerprint)
+            if seen:
+                # Return same response as original request
+                return self.parse_response(response)
 
             ## Gather data from request
             data = request.get_json()
             fragrance_formulas = validate_request(data)
+            publish_options = self.publish_options(fragrance_formulas)
 
             ## Process request
             try:
-                response = self.publish_with_retry(fragrance_formulas, self.db, self.q)
+                self.commit(fragrance_formulas, **publish_options)
+                # the ids are what PATCH /formulas/<id> takes
+                ids = [hash(formula) for formula in (fragrance_formulas if isinstance(fragrance_formulas, list) else [fragrance_formulas])]
+                response = {"message": "Formula(s) added!", "ids": ids}
+            except (TooManyRequests, ServiceUnavailable):
+                # nothing was stored - don't cache, so the client can retry with the same key
+                raise
             except Exception as e:
                 response = e
             
-            with self.idempotency_lock:
-                self.idempotency_cache[idempotency_key] = response
+            self.idempotency_store(idempotency_key, fingerprint, response)
 
             return self.parse_response(response)
-        
-    def publish_with_retry(self, formulas, db, queue, retries=3, base_delay=1.0, max_delay=10.0):
+
+        @self.app.route("/formulas/<int(signed=True):id>", methods=["PATCH"])
+        def update_formula(id):
+            # e.g. {"materials": [{"name": "Jasmine", "delta": 0.1}]} - "add 0.1 to Jasmine"
+
+            ## Handle idempotency - applying the same deltas twice would change the formula twice
+            idempotency_key = request.headers.get("Idempotency-Key")
+            if not idempotency_key:
+                raise BadRequest("Missing Idempotency-Key header")
+            fingerprint = request_fingerprint(request.method, request.path, request.get_data())
+            seen, response = self.idempotency_lookup(idempotency_key, fingerprint)
+            if seen:
+                return self.parse_response(response)
+
+            ## Gather data from request
+            deltas = validate_deltas(request.get_json(silent=True))
+            publish_options = validate_publish_options(request.headers, None)
+
+            ## Process request
+            try:
+                previous, updated = self.update(id, deltas, **publish_options)
+                response = {"message": "Formula updated!", "id": hash(updated), "previous_id": id, "formula": updated.to_dict()}
+            except (TooManyRequests, ServiceUnavailable):
+                raise
+            except Exception as e:
+                response = e
+
+            self.idempotency_store(idempotency_key, fingerprint, response)
+
+            return self.parse_response(response)
+
+        @self.app.route("/formulas/export", methods=["GET"])
+        def export_formulas():
+            # e.g. GET /formulas/export?fields=name,materials&cursor=41 with "Accept-Encoding: gzip"
+            cursor, fields = validate_export_options(request.args)
+            compress = request.accept_encodings["gzip"] > 0 # honours q-values, e.g. "gzip;q=0" turns it off
+
+            records = self.export(cursor, fields)
+            body = self.encode_export(records, compress)
+            headers = {"Content-Encoding": "gzip", "Vary": "Accept-Encoding"} if compress else {"Vary": "Accept-Encoding"}
+            # no Content-Length - the body is sent as it's generated (chunked transfer on HTTP/1.1)
+            return Response(body, mimetype="application/x-ndjson", headers=headers)
+
+    def idempotency_lookup(self, key, fingerprint):
+        """
+        (seen, response): whether `key` was used before, and the response cached for it.
+        Raises UnprocessableEntity if it was used for a different request (see request_fingerprint),
+        e.g. another body, or a PATCH reusing a POST's key.
+        """
+        with self.idempotency_lock:
+            if key not in self.idempotency_cache:
+                return False, None
+            cached_fingerprint, response = self.idempotency_cache[key]
+        if cached_fingerprint != fingerprint:
+            raise UnprocessableEntity("This Idempotency-Key was already used for a different request")
+        return True, response
+
+    def idempotency_store(self, key, fingerprint, response):
+        with self.idempotency_lock:
+            self.idempotency_cache[key] = (fingerprint, response)
+
+    def commit(self, formulas, **publish_options):
+        """
+        Stores and publishes validated formulas: None on success, raises otherwise.
+        Goes through the group committer when one is configured.
+        """
+        if self.group_committer is not None:
+            return self.group_committer.submit(formulas, **publish_options)
+        return self.publish_with_retry(formulas, self.db, self.q, **publish_options)
+
+    def update(self, id, deltas, **publish_options):
+        """
+        Applies material deltas to the formula stored as `id`: the db rekeys it under its new digest
+        (409 if another formula already has it), then the queue is told with a compact update event.
+        If the queue refuses the update, the db change is undone. Returns (previous, updated) formulas.
+        """
+        try:
+            previous, updated = self.db.update_formula(id, deltas)
+        except ValueError as e:
+            raise BadRequest(str(e))
+        try:
+            self.q.publish_update(updated, id, deltas, **publish_options)
+        except Exception:
+            self.db.replace_formula(hash(updated), previous)
+            raise
+        return previous, updated
+
+    def export(self, cursor=None, fields=None):
+        """
+        Generates the catalogue as dicts, from a snapshot taken when it is called, so formulas stored
+        or removed during a long export neither show up half-way nor get skipped.
+        Each record has a `cursor`; passing the last one received resumes after it (from a new snapshot).
+        `fields` picks which of id/name/materials to include.
+        """
+        snapshot = self.db.snapshot()
+        def records():
+            for entry in snapshot.entries(after_seq=cursor):
+                record = {"cursor": entry.seq}
+                if fields is None or "id" in fields:
+                    record["id"] = entry.id
+                if fields is None or "name" in fields:
+                    record["name"] = entry.formula.name
+                if fields is None or "materials" in fields:
+                    record["materials"] = [material.to_dict() for material in entry.formula.materials]
+                yield record
+        return records()
+
+    def encode_export(self, records, compress=False, chunk_size=64 * 1024):
+        """
+        Serializes records as NDJSON, one formula per line, in chunks of about `chunk_size` bytes
+        (optionally gzip'ed), so the response is written a chunk at a time in constant memory.
+        """
+        compressor = zlib.compressobj(wbits=31) if compress else None # wbits=31: gzip container
+        buffer = []
+        buffered = 0
+        for record in records:
+            line = json.dumps(record, separators=(",", ":")).encode() + b"\n"
+            buffer.append(line)
+            buffered += len(line)
+            if buffered >= chunk_size:
+                chunk = b"".join(buffer)
+                buffer, buffered = [], 0
+                chunk = compressor.compress(chunk) if compressor else chunk
+                if chunk:
+                    yield chunk
+        chunk = b"".join(buffer)
+        if compressor:
+            chunk = compressor.compress(chunk) + compressor.flush()
+        if chunk:
+            yield chunk
+
+    def publish_options(self, formulas):
+        # tenant and priority from the request headers - see validate_publish_options
+        return validate_publish_options(request.headers, formulas)
+
+    def publish_with_retry(self, formulas, db, queue, retries=3, base_delay=1.0, max_delay=10.0, **publish_options):
         """
         Attempts to 
         - store one or many formulas to a database and
-        - publish the formula(s) to a messaging queue
+        - publish the formula(s) to a messaging queue (`publish_options` are passed through, e.g. tenant and priority)
         and implements a rollback strategy with exponential backoff.
         """
         for attempt in range(retries):
             try:
                 db.add_formulas(formulas)
-                queue.publish(formulas)
+                queue.publish(formulas, **publish_options)
                 return None # represents success
             except Conflict as e:
                 raise # duplicate formula entry to db - no need to rollback
+            except (TooManyRequests, ServiceUnavailable):
+                # the queue is saturated - retrying right away would only add load; roll back and let the client back off
+                db.remove_formulas(formulas)
+                queue.remove(formulas)
+                raise
             except Exception as e:
                 # Rollback first: - to maintain atomicity
                 db.remove_formulas(formulas)
@@ -87,11 +250,14 @@ class FragranceServer:
         Either returns a success JSON response or raises an Exception.
         `response` is either:
          - None: represents successful processing 
+         - a dict: represents successful processing, with the JSON to return (e.g. the new ids)
          - an Exception: represents what went wrong during publishing
         in order to support both results from `publish_with_retry()`
         """
         if response is None:
             return jsonify({"message": f"Formula(s) added!"}), 200
+        elif isinstance(response, dict):
+            return jsonify(response), 200
         else:
             raise response
 
@@ -104,16 +270,98 @@ class FragranceServer:
             "message": e.description,
             "status": e.code
         }
-        return jsonify(response), e.code
+        headers = {}
+        if getattr(e, "retry_after", None):
+            # set on TooManyRequests / ServiceUnavailable when the queue applies backpressure
+            headers["Retry-After"] = str(e.retry_after)
+        return jsonify(response), e.code, headers
     
     def run(self, **kwargs):
         self.app.run(**kwargs)
 
 def create_app():
     # Needed for flask to find and create the app at launch
-    server = FragranceServer()
+    # export FORMULA_SHARDS=4 to split storage across 4 worker processes, or
+    # export FORMULA_SHARD_ADDRESSES=host:port,... to route to shards already running - see ShardedFragranceServer
+    shards = os.environ.get("FORMULA_SHARDS")
+    addresses = os.environ.get("FORMULA_SHARD_ADDRESSES")
+    if shards and addresses:
+        raise ValueError("Set FORMULA_SHARDS or FORMULA_SHARD_ADDRESSES, not both")
+    if shards or addresses:
+        from OsmoCaseStudy.sharding import ShardedFragranceServer, parse_addresses # imports this module
+        server = ShardedFragranceServer(
+            num_shards=int(shards) if shards else None,
+            addresses=parse_addresses(addresses) if addresses else None,
+            authkey=shard_authkey_from_env(),
+            queue_options=queue_options_from_env(),
+            database_options=database_options_from_env(),
+            group_commit_window=group_commit_window_from_env(),
+        )
+        atexit.register(server.shutdown)
+        return server.app
+
+    server = FragranceServer(
+        db=database_from_env(),
+        queue=queue_from_env(),
+        group_commit_window=group_commit_window_from_env(),
+    )
     return server.app
 
+def group_commit_window_from_env():
+    # export FORMULA_GROUP_COMMIT_WINDOW_MS=2 to commit concurrent submissions in batches
+    window_ms = os.environ.get("FORMULA_GROUP_COMMIT_WINDOW_MS")
+    return float(window_ms) / 1000 if window_ms else None
+
+def shard_authkey_from_env():
+    # export FORMULA_SHARD_AUTHKEY=... - required to talk to shards over the network, since requests are pickled
+    authkey = os.environ.get("FORMULA_SHARD_AUTHKEY")
+    return authkey.encode() if authkey else None
+
+def database_options_from_env():
+    """
+    export FORMULA_DUPLICATE_FILTER=1 puts a Bloom filter in front of the duplicate check.
+    export FORMULA_DUPLICATE_FILTER_PATH=/tmp/formula-filter.bloom also saves it at exit and reloads it at startup.
+    """
+    path = os.environ.get("FORMULA_DUPLICATE_FILTER_PATH") or None
+    return {
+        "duplicate_filter": bool(path or os.environ.get("FORMULA_DUPLICATE_FILTER")),
+        "duplicate_filter_path": path,
+    }
+
+def make_database(duplicate_filter=False, duplicate_filter_path=None):
+    if not duplicate_filter:
+        return FragranceDatabase()
+    return FragranceDatabase(duplicate_filter=DuplicateFilter(path=duplicate_filter_path))
+
+def database_from_env():
+    options = database_options_from_env()
+    db = make_database(**options)
+    if options["duplicate_filter_path"]:
+        atexit.register(db.save_duplicate_filter)
+    return db
+
+def queue_options_from_env():
+    """
+    Queue limits can be set through environment variables, e.g.
+    export FORMULA_QUEUE_MAX_DEPTH=10000
+    export FORMULA_QUEUE_MAX_IN_FLIGHT=50000
+    export FORMULA_QUEUE_OVERFLOW_PATH=/tmp/formula-overflow.jsonl
+    export FORMULA_QUEUE_OVERFLOW_MAX_EVENTS=1000000
+    """
+    def int_env(name):
+        value = os.environ.get(name)
+        return int(value) if value else None
+
+    return {
+        "max_depth": int_env("FORMULA_QUEUE_MAX_DEPTH"),
+        "max_in_flight": int_env("FORMULA_QUEUE_MAX_IN_FLIGHT"),
+        "overflow_path": os.environ.get("FORMULA_QUEUE_OVERFLOW_PATH") or None,
+        "overflow_max_events": int_env("FORMULA_QUEUE_OVERFLOW_MAX_EVENTS"),
+    }
+
+def queue_from_env():
+    return FormulaCreatedQueue(**queue_options_from_env())
+
 if __name__ == "__main__":
     server = FragranceServer()
     server.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,251 @@
+import asyncio
+import json
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import (
+    BadRequest, Conflict, HTTPException, InternalServerError, MethodNotAllowed, NotFound,
+    ServiceUnavailable, TooManyRequests, UnprocessableEntity,
+)
+
+from OsmoCaseStudy.database import FragranceDatabase
+from OsmoCaseStudy.queue import FormulaCreatedQueue
+from OsmoCaseStudy.validations import request_fingerprint, validate_request, validate_publish_options
+
+# An async-native variant of FragranceServer, as a plain ASGI app (no extra dependencies).
+# A submission waiting on storage, the queue or a retry backoff only holds a coroutine, not a
+# thread, so one process can keep thousands of slow submissions in flight. Run it with any ASGI server:
+#   uvicorn OsmoCaseStudy.async_app:create_asgi_app --factory
+
+_RELEASED = object() # given to waiting retries when the first request stored nothing - they process their own request
+
+async def run_blocking(func, *args):
+    """
+    Runs a blocking store or queue call (locks, the overflow file) on a worker thread, so it doesn't
+    hold up the event loop. A thread can't be interrupted, so if the caller is cancelled meanwhile the
+    call is still waited for: its result or error comes back as usual and the cancellation is raised
+    at the caller's next await. That way the caller always knows whether the call took effect.
+    """
+    call = asyncio.ensure_future(asyncio.to_thread(func, *args))
+    try:
+        return await asyncio.shield(call)
+    except asyncio.CancelledError:
+        await asyncio.wait([call])
+        asyncio.current_task().cancel() # delivered at the next await
+        return call.result()
+
+class AsyncFragranceDatabase:
+    def __init__(self, db=None):
+        """
+        Async interface to a FragranceDatabase. The in-memory store's calls run on a worker thread
+        (see run_blocking), and its lock keeps each check-and-write atomic;
+        a store behind a network would await its driver in `_round_trip()`.
+        """
+        self.db = db if db is not None else FragranceDatabase()
+
+    async def _round_trip(self):
+        pass
+
+    async def add_formulas(self, formulas):
+        await self._round_trip()
+        await run_blocking(self.db.add_formulas, formulas)
+
+    async def remove_formulas(self, formulas):
+        await self._round_trip()
+        await run_blocking(self.db.remove_formulas, formulas)
+
+    async def is_duplicate(self, id):
+        await self._round_trip()
+        return await run_blocking(self.db.is_duplicate, id)
+
+class AsyncFormulaCreatedQueue:
+    def __init__(self, queue=None):
+        """
+        Async interface to a FormulaCreatedQueue (or FormulaEventLog). Its calls take the queue's lock
+        and, with an overflow file, write to disk, so they run on a worker thread (see run_blocking).
+        """
+        self.queue = queue if queue is not None else FormulaCreatedQueue()
+
+    async def _round_trip(self):
+        pass
+
+    async def publish(self, formulas, **publish_options):
+        await self._round_trip()
+        await run_blocking(lambda: self.queue.publish(formulas, **publish_options))
+
+    async def remove(self, formulas):
+        await self._round_trip()
+        await run_blocking(self.queue.remove, formulas)
+
+class AsyncFragranceServer:
+    def __init__(self, db: AsyncFragranceDatabase = None, queue: AsyncFormulaCreatedQueue = None):
+        """
+        The POST /formulas API of FragranceServer as an ASGI application, with the same
+        validation, idempotency, duplicate handling, rollback and error responses.
+        """
+        self.db = db if db is not None else AsyncFragranceDatabase()
+        self.q = queue if queue is not None else AsyncFormulaCreatedQueue()
+
+        # Key: key from header, Value: (request fingerprint, response from submit_formula - or a Future while the first request is still running)
+        # Only changed between awaits, so each check-and-claim is atomic on the event loop without a lock
+        self.idempotency_cache = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+
+        try:
+            if scope["path"] != "/formulas":
+                raise NotFound()
+            if scope["method"] != "POST":
+                raise MethodNotAllowed(valid_methods=["POST"])
+            headers = Headers([(key.decode("latin-1"), value.decode("latin-1")) for key, value in scope["headers"]])
+            body = await self.read_body(receive)
+            payload = await self.submit_formula(headers, body)
+            status, extra_headers = 200, {}
+        except HTTPException as e:
+            status, payload, extra_headers = self.handle_http_error(e)
+        except Exception:
+            status, payload, extra_headers = self.handle_http_error(InternalServerError())
+
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json")] +
+                       [(key.lower().encode(), str(value).encode()) for key, value in extra_headers.items()],
+        })
+        await send({"type": "http.response.body", "body": json.dumps(payload).encode()})
+
+    async def submit_formula(self, headers, body):
+        ## Handle idempotency
+        idempotency_key = headers.get("Idempotency-Key")
+        if not idempotency_key:
+            raise BadRequest("Missing Idempotency-Key header")
+        fingerprint = request_fingerprint("POST", "/formulas", body)
+        while True:
+            cached = self.idempotency_cache.get(idempotency_key)
+            if cached is None:
+                # claim the key, so a concurrent retry waits for this request instead of processing it again
+                pending = asyncio.get_running_loop().create_future()
+                self.idempotency_cache[idempotency_key] = (fingerprint, pending)
+                break
+            cached_fingerprint, response = cached
+            if cached_fingerprint != fingerprint:
+                raise UnprocessableEntity("This Idempotency-Key was already used for a different request")
+            if isinstance(response, asyncio.Future):
+                response = await asyncio.shield(response)
+                if response is _RELEASED:
+                    continue # the first request stored nothing (bad request, saturated, cancelled) - try to claim the key
+            # Return same response as original request
+            return self.parse_response(response)
+
+        try:
+            ## Gather data from request
+            try:
+                data = json.loads(body) if body else None
+            except ValueError:
+                raise BadRequest("Invalid or missing JSON")
+            fragrance_formulas = validate_request(data)
+            publish_options = validate_publish_options(headers, fragrance_formulas)
+
+            ## Process request
+            try:
+                await self.publish_with_retry(fragrance_formulas, self.db, self.q, **publish_options)
+                formulas = fragrance_formulas if isinstance(fragrance_formulas, list) else [fragrance_formulas]
+                response = {"message": "Formula(s) added!", "ids": [hash(formula) for formula in formulas]}
+            except (TooManyRequests, ServiceUnavailable):
+                raise
+            except Exception as e:
+                response = e
+        except BaseException:
+            # nothing was stored (bad request, saturated queue, cancelled) - release the key so the client can retry
+            # with it, and let waiting retries process their own request rather than share this one's failure.
+            # Done without awaiting, so a cancelled request can't be interrupted half-way through
+            self.idempotency_cache.pop(idempotency_key, None)
+            pending.set_result(_RELEASED)
+            raise
+
+        self.idempotency_cache[idempotency_key] = (fingerprint, response)
+        pending.set_result(response)
+        return self.parse_response(response)
+
+    async def publish_with_retry(self, formulas, db, queue, retries=3, base_delay=1.0, max_delay=10.0, **publish_options):
+        """
+        FragranceServer.publish_with_retry with awaited storage/queue calls and an asyncio.sleep backoff,
+        so a submission that is backing off doesn't hold a thread.
+        If it is cancelled (e.g. the client went away) after the formulas were stored, they are rolled back.
+        """
+        for attempt in range(retries):
+            stored = False
+            try:
+                await db.add_formulas(formulas)
+                stored = True
+                await queue.publish(formulas, **publish_options)
+                return None # represents success
+            except Conflict:
+                raise # duplicate formula entry to db - no need to rollback
+            except (TooManyRequests, ServiceUnavailable):
+                await self.rollback(formulas, db, queue)
+                raise
+            except asyncio.CancelledError:
+                if stored:
+                    await self.rollback(formulas, db, queue)
+                raise
+            except Exception:
+                # Rollback first: - to maintain atomicity
+                await self.rollback(formulas, db, queue)
+
+                if attempt == retries - 1:
+                    raise
+
+                delay = min(base_delay * (2 ** attempt), max_delay)
+                await asyncio.sleep(delay)
+
+    async def rollback(self, formulas, db, queue):
+        # shielded, so a cancellation can't stop a rollback half-way
+        async def undo():
+            await db.remove_formulas(formulas)
+            await queue.remove(formulas)
+        await asyncio.shield(undo())
+
+    def parse_response(self, response):
+        # same contract as FragranceServer.parse_response: a dict is the success payload, an Exception is raised
+        if isinstance(response, dict):
+            return response
+        raise response
+
+    def handle_http_error(self, e):
+        response = {
+            "error": e.name,
+            "message": e.description,
+            "status": e.code
+        }
+        headers = {}
+        if getattr(e, "retry_after", None):
+            headers["Retry-After"] = e.retry_after
+        if isinstance(e, MethodNotAllowed):
+            headers["Allow"] = ", ".join(e.valid_methods)
+        return e.code, response, headers
+
+    async def read_body(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                raise BadRequest("Client disconnected")
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                return b"".join(chunks)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+def create_asgi_app():
+    # Needed for ASGI servers (e.g. uvicorn --factory) to create the app at launch
+    return AsyncFragranceServer()
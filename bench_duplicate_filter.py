@@ -0,0 +1,75 @@
+import argparse
+import json
+import time
+
+from OsmoCaseStudy.database import FragranceDatabase
+from OsmoCaseStudy.duplicate_filter import DuplicateFilter
+from OsmoCaseStudy.loadgen import synthetic_formulas
+from OsmoCaseStudy.validations import validate_request
+
+# Benchmarks the duplicate check with and without a DuplicateFilter in front of a store
+# whose existence check costs a round trip, e.g.
+#   python -m OsmoCaseStudy.bench_duplicate_filter --formulas 2000 --duplicate-ratio 0.05 --latency-ms 1
+
+class LatencyDatabase(FragranceDatabase):
+    def __init__(self, latency, duplicate_filter=None):
+        """
+        A FragranceDatabase whose existence check sleeps for `latency` seconds, standing in for an out-of-process store.
+        """
+        self.latency = latency
+        self.round_trips = 0
+        super().__init__(duplicate_filter)
+
+    def exists(self, id):
+        self.round_trips += 1
+        time.sleep(self.latency)
+        return super().exists(id)
+
+def run(formulas, duplicate_ratio, latency, duplicate_filter=None):
+    db = LatencyDatabase(latency, duplicate_filter)
+    duplicates = formulas[:int(len(formulas) * duplicate_ratio)]
+
+    start = time.perf_counter()
+    for formula in formulas + duplicates:
+        try:
+            db.add_formula(formula)
+        except Exception:
+            pass # Conflict - expected for the duplicates
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "submissions": len(formulas) + len(duplicates),
+        "seconds": round(elapsed, 3),
+        "store_round_trips": db.round_trips,
+    }
+    if duplicate_filter is not None:
+        result["filter"] = duplicate_filter.stats()
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Bloom filter duplicate fast path")
+    parser.add_argument("--formulas", type=int, default=2000)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.05)
+    parser.add_argument("--latency-ms", type=float, default=1.0)
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    # synthetic formulas can repeat a material make-up - keep the unique ones so only the planned duplicates conflict
+    unique = {}
+    for payload in synthetic_formulas(args.formulas, seed=args.seed):
+        formula = validate_request(payload)
+        unique.setdefault(hash(formula), formula)
+    formulas = list(unique.values())
+
+    latency = args.latency_ms / 1000
+    results = {
+        "without_filter": run(formulas, args.duplicate_ratio, latency),
+        "with_filter": run(formulas, args.duplicate_ratio, latency,
+                           DuplicateFilter(capacity=len(formulas), error_rate=args.error_rate)),
+    }
+    print(json.dumps(results, indent=2))
+    return results
+
+if __name__ == "__main__":
+    main()
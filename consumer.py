@@ -0,0 +1,113 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from threading import Event, Lock, Semaphore, Thread
+
+from OsmoCaseStudy.queue import FormulaCreatedQueue
+
+class FormulaCreatedConsumer:
+    def __init__(self, queue: FormulaCreatedQueue, handler, max_workers=4, use_processes=False,
+                 heartbeat_interval=None, poll_interval=0.1, retry_delay=5.0):
+        """
+        Runs downstream jobs for FormulaCreatedEvents pulled from a FormulaCreatedQueue
+        (or a SubscriberGroup of a FormulaEventLog).
+
+        - `handler(event)` does the work; it runs on a thread pool, or a process pool if `use_processes`
+          (then the handler must be a picklable top-level function).
+        - At most `max_workers` events are leased at a time, so a slow downstream service doesn't
+          cause the consumer to hoard events it can't work on yet.
+        - While a job runs its lease is extended every `heartbeat_interval` seconds (default: a third of the
+          queue's process_timeout), so long jobs are not redelivered to another consumer mid-way.
+        - A job that finishes is acked; a job that raises is nacked and retried after `retry_delay` seconds.
+        """
+        self.queue = queue
+        self.handler = handler
+        self.max_workers = max_workers
+        self.use_processes = use_processes
+        self.heartbeat_interval = heartbeat_interval if heartbeat_interval is not None else queue.process_timeout / 3
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+
+        self._slots = Semaphore(max_workers)
+        self._in_flight = {} # Key: offset, Value: FormulaCreatedEvent - leased and being processed
+        self._in_flight_lock = Lock()
+        self._stopping = Event() # stop pulling new events
+        self._stopped = Event() # stop heartbeating
+        self._pool = None
+        self._dispatcher = None
+        self._heartbeat = None
+
+    def start(self):
+        pool_class = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+        self._pool = pool_class(max_workers=self.max_workers)
+        self._dispatcher = Thread(target=self._dispatch_loop, name="formula-consumer-dispatch", daemon=True)
+        self._heartbeat = Thread(target=self._heartbeat_loop, name="formula-consumer-heartbeat", daemon=True)
+        self._dispatcher.start()
+        self._heartbeat.start()
+        return self
+
+    def stop(self, drain=True, timeout=None):
+        """
+        Stops pulling new events.
+        - drain=True: waits for in-flight jobs to finish (still heartbeating) and acks/nacks them as usual.
+        - drain=False: abandons in-flight jobs and hands their events straight back to the queue.
+        """
+        self._stopping.set()
+        if self._dispatcher is not None:
+            self._dispatcher.join(timeout)
+
+        if not drain:
+            with self._in_flight_lock:
+                abandoned = list(self._in_flight.values())
+                self._in_flight.clear()
+            for event in abandoned:
+                self.queue.nack(event.id, offset=event.offset)
+        if self._pool is not None:
+            self._pool.shutdown(wait=drain, cancel_futures=not drain)
+
+        self._stopped.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join(timeout)
+
+    def in_flight(self):
+        with self._in_flight_lock:
+            return len(self._in_flight)
+
+    def _dispatch_loop(self):
+        while not self._stopping.is_set():
+            # bounded concurrency: don't lease an event until a worker is free to take it
+            if not self._slots.acquire(timeout=self.poll_interval):
+                continue
+            event = self.queue.get_next_item()
+            if event is None:
+                self._slots.release()
+                self._stopping.wait(self.poll_interval)
+                continue
+
+            with self._in_flight_lock:
+                self._in_flight[event.offset] = event
+            future = self._pool.submit(self.handler, event)
+            future.add_done_callback(lambda f, event=event: self._on_done(event, f))
+
+    def _on_done(self, event, future):
+        try:
+            with self._in_flight_lock:
+                if self._in_flight.pop(event.offset, None) is None:
+                    return # abandoned by stop(drain=False) - already handed back to the queue
+            if future.cancelled() or future.exception() is not None:
+                self.queue.nack(event.id, delay=self.retry_delay, offset=event.offset)
+            else:
+                self.queue.ack(event.id, offset=event.offset)
+        finally:
+            self._slots.release()
+
+    def _heartbeat_loop(self):
+        while not self._stopped.wait(self.heartbeat_interval):
+            with self._in_flight_lock:
+                events = list(self._in_flight.values())
+            for event in events:
+                self.queue.extend_lease(event.id, offset=event.offset)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -1,15 +1,62 @@
-from werkzeug.exceptions import Conflict
+from werkzeug.exceptions import Conflict, NotFound
+from bisect import bisect_right
+from dataclasses import dataclass
+from threading import RLock
+import itertools
 import pprint
 from OsmoCaseStudy.models.fragrance_formula import FragranceFormula
 
+@dataclass(slots=True)
+class CatalogueEntry:
+    seq: int # position in the catalogue, in the order formulas were stored - never reused
+    id: int
+    formula: FragranceFormula
+    added: int # database version that stored it
+    removed: int = None # database version that removed it, None while stored
+
+class CatalogueSnapshot:
+    def __init__(self, entries, end, version):
+        """
+        The catalogue as of one database version, for reading while writes carry on.
+        Entries are only ever appended and marked removed with the version that removed them,
+        so the snapshot is the first `end` entries that were stored at `version`. Iterating it
+        takes no lock and copies nothing.
+        """
+        self._entries = entries
+        self._end = end
+        self.version = version
+
+    def entries(self, after_seq=None):
+        # stored entries in seq order, starting after `after_seq` (a cursor from an earlier read)
+        start = 0 if after_seq is None else bisect_right(self._entries, after_seq, hi=self._end, key=lambda entry: entry.seq)
+        for i in range(start, self._end):
+            entry = self._entries[i]
+            if entry.added <= self.version and (entry.removed is None or entry.removed > self.version):
+                yield entry
+
 class FragranceDatabase:
-    def __init__(self):
+    def __init__(self, duplicate_filter=None):
         """
         Initializes a database for storing Fragrance Formula objects, 
         where formulas are unique. Formula uniqueness is defined by its material make-up.
         Formulas with the same name but different formulas are permitted.
+
+        An optional DuplicateFilter answers most duplicate checks for new formulas without an
+        existence lookup; it is loaded or rebuilt from the stored ids here.
         """
         self._db = {} ## Key: id (hashed formula), Value: the formula
+        self._lock = RLock() # duplicate check + write happen together, so an update can't rekey onto a formula being added
+
+        # append-only log of everything stored, for consistent snapshots (see snapshot())
+        self._entries = [] # CatalogueEntry, in seq order
+        self._entry_by_id = {} # Key: id, Value: its current CatalogueEntry
+        self._removed_entries = 0 # entries in self._entries marked removed, reclaimed by _compact()
+        self._version = 0
+        self._seq = itertools.count()
+        self._fingerprint = 0 # id_fingerprint of the stored ids, kept as a running sum
+        self._duplicate_filter = duplicate_filter
+        if duplicate_filter is not None:
+            duplicate_filter.sync(self.ids(), self.size(), self.fingerprint())
 
     def add_formulas(self, formulas):
         if isinstance(formulas, list):
@@ -21,11 +68,75 @@ class FragranceDatabase:
     def add_formula(self, formula: FragranceFormula):
         id = hash(formula)
 
-        if self.is_duplicate(id):
-            raise Conflict(f"This formula already exists in the database, either by the same name or another name: {formula}")
-        
-        self._db[id] = formula
+        with self._lock:
+            if self.is_duplicate(id):
+                raise Conflict(f"This formula already exists in the database, either by the same name or another name: {formula}")
+
+            self._store(id, formula)
+            if self._duplicate_filter is not None:
+                self._duplicate_filter.add(id)
         return id
+
+    def add_batch(self, submissions):
+        """
+        Check-and-insert for several submissions (lists of formulas) under one lock acquisition,
+        one duplicate check per formula. Each submission is all-or-nothing: one holding a formula
+        that is already stored - including by an earlier submission in the batch - is left out.
+        Returns one entry per submission: None if it was stored, else its Conflict.
+        """
+        results = []
+        with self._lock:
+            for formulas in submissions:
+                ids = [hash(formula) for formula in formulas]
+                seen = set()
+                for formula, id in zip(formulas, ids):
+                    if id in seen or self.is_duplicate(id):
+                        results.append(Conflict(f"This formula already exists in the database, either by the same name or another name: {formula}"))
+                        break
+                    seen.add(id)
+                else:
+                    for formula, id in zip(formulas, ids):
+                        self._store(id, formula)
+                        if self._duplicate_filter is not None:
+                            self._duplicate_filter.add(id)
+                    results.append(None)
+        return results
+
+    def update_formula(self, id, deltas):
+        """
+        Applies material deltas (Key: material name, Value: Decimal change in concentration) to the
+        formula stored as `id` and rekeys it under its new id, under the lock so concurrent updates
+        of the same formula can't both apply to the old version.
+        Returns (previous formula, updated formula).
+        """
+        with self._lock:
+            previous = self._db.get(id)
+            if previous is None:
+                raise NotFound(f"No formula with id {id}")
+            updated = previous.with_deltas(deltas) # ValueError if a concentration drops to 0 or below
+            self.replace_formula(id, updated)
+        return previous, updated
+
+    def replace_formula(self, id, formula: FragranceFormula):
+        """
+        Stores `formula` in place of the formula stored as `id`, under the new formula's own id.
+        Raises Conflict if another formula already has that id. Also used to undo an update.
+        """
+        new_id = hash(formula)
+        with self._lock:
+            if id not in self._db:
+                raise NotFound(f"No formula with id {id}")
+            if new_id != id and self.is_duplicate(new_id):
+                raise Conflict(f"This formula already exists in the database, either by the same name or another name: {formula}")
+
+            # new key first, so a reader never sees neither version
+            self._store(new_id, formula)
+            if new_id != id:
+                self._drop(id)
+            if self._duplicate_filter is not None:
+                # the old id can't be taken out of the filter - it becomes a (confirmed) false positive
+                self._duplicate_filter.add(new_id)
+        return new_id
     
     def remove_formulas(self, formulas):
         if isinstance(formulas, list):
@@ -38,11 +149,76 @@ class FragranceDatabase:
         id = hash(formula)
         # Gracefully handle when an ID isn't present
         # instead of a KeyError, just return None
-        self._db.pop(id, None)
+        with self._lock:
+            self._drop(id)
 
     def is_duplicate(self, id):
+        if self._duplicate_filter is not None:
+            if self._duplicate_filter.needs_rebuild():
+                self._duplicate_filter.rebuild(self.ids())
+            return self._duplicate_filter.is_duplicate(id, self.exists)
+        return self.exists(id)
+
+    def exists(self, id):
+        # the store's own existence check - a lookup/round trip for a real database
         return id in self._db
+
+    def get(self, id):
+        return self._db.get(id)
+
+    def ids(self):
+        return list(self._db)
+
+    def snapshot(self):
+        """
+        A CatalogueSnapshot of everything stored right now; later writes don't show up in it.
+        """
+        with self._lock:
+            return CatalogueSnapshot(self._entries, len(self._entries), self._version)
+
+    def _store(self, id, formula):
+        # callers hold self._lock
+        self._version += 1
+        if id in self._entry_by_id:
+            # replaced in place under the same id - the old version stays visible to older snapshots
+            self._mark_removed(self._entry_by_id[id])
+        else:
+            self._fingerprint = (self._fingerprint + id) % (1 << 64)
+        entry = CatalogueEntry(next(self._seq), id, formula, self._version)
+        self._entries.append(entry)
+        self._entry_by_id[id] = entry
+        self._db[id] = formula
+
+    def _drop(self, id):
+        # callers hold self._lock
+        if self._db.pop(id, None) is None:
+            return
+        self._fingerprint = (self._fingerprint - id) % (1 << 64)
+        self._version += 1
+        self._mark_removed(self._entry_by_id.pop(id))
+        if self._removed_entries > 1024 and self._removed_entries > len(self._entry_by_id):
+            self._compact()
+
+    def _mark_removed(self, entry):
+        entry.removed = self._version
+        self._removed_entries += 1
+
+    def _compact(self):
+        # callers hold self._lock
+        # builds a new list rather than editing the old one in place, so open snapshots keep reading theirs
+        self._entries = [entry for entry in self._entries if entry.removed is None]
+        self._removed_entries = 0
+
+    def save_duplicate_filter(self, path=None):
+        if self._duplicate_filter is not None:
+            with self._lock:
+                store_size, fingerprint = self.size(), self.fingerprint()
+            self._duplicate_filter.save(path, store_size=store_size, fingerprint=fingerprint)
     
+    def fingerprint(self):
+        # same as duplicate_filter.id_fingerprint(self.ids()), without the scan
+        return self._fingerprint
+
     def is_empty(self):
         return len(self._db) == 0
     
@@ -0,0 +1,128 @@
+import os
+from threading import Lock
+
+from OsmoCaseStudy.bloom import BloomFilter
+
+def id_fingerprint(ids):
+    # order-independent summary of a set of ids; ids are additive digests, so a store can keep it as a running sum
+    return sum(ids) % (1 << 64)
+
+class DuplicateFilter:
+    def __init__(self, capacity=1_000_000, error_rate=0.01, path=None):
+        """
+        A Bloom filter of formula digests in front of a store's duplicate check.
+
+        Nearly every submission is a new formula, so for a store where an existence check is a
+        round trip (a real database), most of those checks can be skipped: if the digest is not in
+        the filter the formula is definitely new. Only filter hits are confirmed against the store.
+
+        The filter can't forget ids removed from the store (e.g. on rollback); those become false
+        positives, which are still confirmed against the store, so results stay exact. Counters
+        track how often that happens (see stats()); needs_rebuild() says when it's worth rebuilding.
+
+        With `path`, save() persists the filter and sync() reloads it at startup.
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.path = path
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._lock = Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.lookups = 0
+        self.skipped = 0 # definite negatives - no store round trip
+        self.confirmed = 0 # filter hits that really were in the store
+        self.false_positives = 0 # filter hits the store said were new
+
+    def is_duplicate(self, id: int, exists) -> bool:
+        """
+        `exists(id)` is the store's own (possibly slow) existence check.
+        """
+        self.lookups += 1
+        if id not in self._bloom:
+            self.skipped += 1
+            return False
+        if exists(id):
+            self.confirmed += 1
+            return True
+        self.false_positives += 1
+        return False
+
+    def add(self, id: int):
+        with self._lock:
+            self._bloom.add(id)
+
+    def rebuild(self, ids):
+        # sized for what's in the store now, with room to grow
+        ids = list(ids)
+        bloom = BloomFilter(max(self.capacity, 2 * len(ids)), self.error_rate)
+        for id in ids:
+            bloom.add(id)
+        with self._lock:
+            self._bloom = bloom
+            self.capacity = bloom.capacity
+        self.reset_stats()
+
+    def needs_rebuild(self):
+        # over capacity, or stale ids are pushing false positives well above what the filter was sized for
+        if self._bloom.count > self.capacity:
+            return True
+        negatives = self.skipped + self.false_positives
+        return negatives >= 1000 and self.false_positive_rate() > 2 * self.error_rate
+
+    def false_positive_rate(self):
+        # observed: share of lookups for new formulas that the filter didn't rule out
+        negatives = self.skipped + self.false_positives
+        return self.false_positives / negatives if negatives else 0.0
+
+    def stats(self):
+        return {
+            "lookups": self.lookups,
+            "skipped_store_lookups": self.skipped,
+            "confirmed_duplicates": self.confirmed,
+            "false_positives": self.false_positives,
+            "false_positive_rate": self.false_positive_rate(),
+            "target_false_positive_rate": self.error_rate,
+            "ids": self._bloom.count,
+            "capacity": self.capacity,
+            "bytes": self._bloom.nbytes(),
+        }
+
+    def save(self, path=None, store_size=None, fingerprint=None):
+        """
+        Writes the filter to `path`, recording `store_size` and the store's id `fingerprint`
+        so sync() can tell whether it still matches the store.
+        """
+        path = path or self.path
+        with self._lock:
+            with open(path + ".tmp", "wb") as f:
+                self._bloom.save(f, store_size=store_size, fingerprint=fingerprint)
+        os.replace(path + ".tmp", path) # never leave a half-written filter behind
+
+    def sync(self, ids, store_size, fingerprint=None, path=None):
+        """
+        Startup: loads the persisted filter if it was saved for a store with the same size and
+        id fingerprint (computed from `ids` if not given), otherwise rebuilds it from the store's ids.
+        A filter that misses ids in the store would let duplicates through, so anything doubtful is rebuilt -
+        a store of the same size but different contents included.
+        """
+        path = path or self.path
+        ids = list(ids)
+        if fingerprint is None:
+            fingerprint = id_fingerprint(ids)
+        if path and os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    bloom, header = BloomFilter.load(f)
+                if header.get("store_size") == store_size and header.get("fingerprint") == fingerprint:
+                    with self._lock:
+                        self._bloom = bloom
+                        self.capacity = bloom.capacity
+                        self.error_rate = bloom.error_rate
+                    self.reset_stats()
+                    return "loaded"
+            except (ValueError, KeyError, OSError):
+                pass # unreadable - fall through and rebuild
+        self.rebuild(ids)
+        return "rebuilt"
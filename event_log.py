@@ -0,0 +1,304 @@
+from collections import deque
+import heapq
+import itertools
+from werkzeug.exceptions import InternalServerError
+from threading import Lock
+import time
+
+from OsmoCaseStudy.models.fragrance_formula import FragranceFormula
+from OsmoCaseStudy.queue import FormulaCreatedEvent, FormulaUpdatedEvent, DEFAULT_TENANT, PRIORITY_NORMAL
+from OsmoCaseStudy.id_set import CompactIdSet
+
+class FormulaEventLog:
+    def __init__(self, process_timeout=30, archive=None, published_retention=None):
+        """
+        A log-structured alternative to FormulaCreatedQueue for fanning events out to several
+        downstream services (search indexing, QA, billing...).
+
+        Each event is appended once and gets a monotonically increasing offset. Every named
+        subscriber group (see SubscriberGroup) reads the log through its own cursor and leases,
+        so publishing costs the same no matter how many groups there are. Events are only
+        dropped from the front of the log once every group has acked past them.
+
+        Publishing has the same interface as FormulaCreatedQueue, so FragranceServer can use either.
+        With an `archive` (an EventSegmentStore), events dropped from the log are kept there for replay.
+        """
+        self._log = deque() # retained events, self._log[i] has offset self._base_offset + i; None marks a rolled back event
+        self._base_offset = 0
+        self._next_offset = 0
+        self._offset_by_id = {} # Key: id, Value: offset - for rollback of retained events
+        self._published_hashes = CompactIdSet(max_entries=published_retention, bloom_error_rate=0.01) # set of all id's of formulas that have been published
+        self._groups = {} # Key: group name, Value: SubscriberGroup
+
+        self._lock = Lock()
+        self.process_timeout = process_timeout
+        self._archive = archive
+
+    ###########################################
+    # Publishing (same interface as FormulaCreatedQueue)
+    ###########################################
+    def publish(self, formulas, tenant=DEFAULT_TENANT, priority=PRIORITY_NORMAL):
+        if isinstance(formulas, list):
+            for formula in formulas:
+                self.publish_one(formula, tenant, priority)
+        elif isinstance(formulas, FragranceFormula):
+            self.publish_one(formulas, tenant, priority)
+
+    def publish_one(self, formula, tenant=DEFAULT_TENANT, priority=PRIORITY_NORMAL):
+        id = hash(formula)
+
+        with self._lock:
+            if id in self._published_hashes:
+                raise InternalServerError(f"This formula already exists in the queue")
+
+            offset = self._next_offset
+            self._log.append(FormulaCreatedEvent(formula.name, id, tenant=tenant, priority=priority, offset=offset))
+            self._next_offset += 1
+            self._offset_by_id[id] = offset
+            self._published_hashes.add(id)
+        return offset
+
+    def publish_many(self, entries):
+        """
+        Appends a batch of (formula, tenant, priority) entries under a single lock acquisition.
+        """
+        with self._lock:
+            ids = [hash(formula) for formula, tenant, priority in entries]
+            if len(set(ids)) != len(ids) or any(id in self._published_hashes for id in ids):
+                raise InternalServerError(f"This formula already exists in the queue")
+
+            offsets = []
+            for id, (formula, tenant, priority) in zip(ids, entries):
+                offset = self._next_offset
+                self._log.append(FormulaCreatedEvent(formula.name, id, tenant=tenant, priority=priority, offset=offset))
+                self._next_offset += 1
+                self._offset_by_id[id] = offset
+                self._published_hashes.add(id)
+                offsets.append(offset)
+        return offsets
+
+    def publish_update(self, formula, previous_id, deltas, tenant=DEFAULT_TENANT, priority=PRIORITY_NORMAL):
+        """
+        Appends a compact FormulaUpdatedEvent for the formula published as `previous_id`.
+        Unlike FormulaCreatedQueue.publish_update, a waiting created event is never rekeyed in place -
+        some groups may already have read it.
+        """
+        id = hash(formula)
+        with self._lock:
+            if id != previous_id and id in self._published_hashes:
+                raise InternalServerError(f"This formula already exists in the queue")
+
+            offset = self._next_offset
+            self._log.append(FormulaUpdatedEvent(formula.name, id, previous_id,
+                                                 tuple((name, str(delta)) for name, delta in deltas.items()),
+                                                 tenant=tenant, priority=priority, offset=offset))
+            self._next_offset += 1
+            self._offset_by_id[id] = offset
+            self._published_hashes.discard(previous_id)
+            self._published_hashes.add(id)
+        return offset
+
+    def remove(self, formulas):
+        if isinstance(formulas, list):
+            for formula in formulas:
+                self.remove_one(formula)
+        elif isinstance(formulas, FragranceFormula):
+            self.remove_one(formulas)
+
+    def remove_one(self, formula):
+        # rollback: the entry is blanked rather than deleted so offsets stay stable; groups skip it
+        id = hash(formula)
+        with self._lock:
+            self._published_hashes.discard(id)
+            offset = self._offset_by_id.pop(id, None)
+            if offset is None:
+                return
+            self._log[offset - self._base_offset] = None
+            for group in self._groups.values():
+                group._forget(offset)
+            self._truncate()
+
+    def already_processed(self, formula):
+        return hash(formula) in self._published_hashes
+
+    def is_empty(self):
+        return self.size() == 0
+
+    def size(self):
+        # events retained in the log (not yet acked by every group)
+        return self._next_offset - self._base_offset
+
+    def end_offset(self):
+        # the offset the next published event will get
+        return self._next_offset
+
+    ###########################################
+    # Subscriber groups
+    ###########################################
+    def group(self, name, start="earliest"):
+        """
+        Returns the subscriber group `name`, creating it if needed.
+        A new group starts at the oldest retained event ("earliest") or only sees events published from now on ("latest").
+        """
+        with self._lock:
+            group = self._groups.get(name)
+            if group is None:
+                start_offset = self._base_offset if start == "earliest" else self._next_offset
+                group = self._groups[name] = SubscriberGroup(self, name, start_offset)
+            return group
+
+    def remove_group(self, name):
+        # a group that goes away must not hold back retention forever
+        with self._lock:
+            self._groups.pop(name, None)
+            self._truncate()
+
+    def _event_at(self, offset):
+        # callers hold self._lock
+        return self._log[offset - self._base_offset]
+
+    def _truncate(self):
+        # callers hold self._lock
+        # drop events every group has acked; with no groups, keep everything for the first one to subscribe
+        if not self._groups:
+            return
+        low_watermark = min(group.committed for group in self._groups.values())
+        while self._base_offset < low_watermark:
+            event = self._log.popleft()
+            if event is not None:
+                if self._offset_by_id.get(event.id) == self._base_offset:
+                    del self._offset_by_id[event.id] # unless the id was published again later (A -> B -> A)
+                if self._archive is not None:
+                    self._archive.append(event)
+            self._base_offset += 1
+
+class SubscriberGroup:
+    def __init__(self, log: FormulaEventLog, name, start_offset):
+        """
+        One downstream service's view of a FormulaEventLog.
+        Offers the same consumer interface as FormulaCreatedQueue (get_next_item / ack / nack / extend_lease),
+        so a FormulaCreatedConsumer can run against a group.
+        - cursor: next offset never delivered to this group
+        - committed: every offset below it has been acked by this group
+        Get it from FormulaEventLog.group(name).
+        """
+        self.log = log
+        self.name = name
+        self.process_timeout = log.process_timeout
+        self.cursor = start_offset
+        self.committed = start_offset
+
+        self._in_process = {} # Key: offset, Value: (id, ack_deadline) - leased by a consumer of this group
+        self._leased_by_id = {} # Key: id, Value: leased offsets - an id can be in the log twice (A -> B -> A)
+        self._acked = set() # offsets acked out of order, above `committed`
+        self._redeliver = deque() # offsets to deliver again before moving the cursor (expired leases, nacks)
+        self._delayed = [] # heap of (ready_at, seq, offset) - nack'ed with a delay
+        self._delayed_seq = itertools.count()
+
+    def get_next_item(self):
+        log = self.log
+        with log._lock:
+            now = time.time()
+            expired = [offset for offset, (id, deadline) in self._in_process.items() if deadline <= now]
+            for offset in expired:
+                self._release(offset)
+                self._redeliver.append(offset)
+            while self._delayed and self._delayed[0][0] <= now:
+                self._redeliver.append(heapq.heappop(self._delayed)[2])
+
+            while self._redeliver:
+                offset = self._redeliver.popleft()
+                event = self._live_event(offset)
+                if event is not None:
+                    return self._lease(event)
+                self._mark_acked(offset) # rolled back while waiting for redelivery
+
+            while self.cursor < log._next_offset:
+                offset = self.cursor
+                self.cursor += 1
+                event = self._live_event(offset)
+                if event is not None:
+                    return self._lease(event)
+                self._mark_acked(offset) # rolled back event - nothing to deliver
+            return None
+
+    def ack(self, id: int, offset=None):
+        # without an offset, the oldest lease on `id` is acked
+        with self.log._lock:
+            offset = self._leased_offset(id, offset)
+            if offset is None:
+                return False
+            self._release(offset)
+            self._mark_acked(offset)
+            return True
+
+    def nack(self, id: int, delay=0, offset=None):
+        with self.log._lock:
+            offset = self._leased_offset(id, offset)
+            if offset is None:
+                return False
+            self._release(offset)
+            if delay > 0:
+                heapq.heappush(self._delayed, (time.time() + delay, next(self._delayed_seq), offset))
+            else:
+                self._redeliver.append(offset)
+            return True
+
+    def extend_lease(self, id: int, extension=None, offset=None):
+        with self.log._lock:
+            offset = self._leased_offset(id, offset)
+            if offset is None or self._in_process[offset][1] <= time.time():
+                return False
+            self._in_process[offset] = (id, time.time() + (extension if extension is not None else self.process_timeout))
+            return True
+
+    def lag(self):
+        # events published that this group has not acked yet
+        return self.log.end_offset() - self.committed
+
+    def _live_event(self, offset):
+        # callers hold the log's lock
+        if offset < self.log._base_offset:
+            return None
+        return self.log._event_at(offset)
+
+    def _lease(self, event):
+        self._in_process[event.offset] = (event.id, time.time() + self.process_timeout)
+        self._leased_by_id.setdefault(event.id, []).append(event.offset)
+        return event
+
+    def _leased_offset(self, id, offset=None):
+        # callers hold the log's lock
+        # the lease on `offset`, or the oldest lease on formula `id` when no offset is given
+        if offset is not None:
+            leased = self._in_process.get(offset)
+            return offset if leased is not None and leased[0] == id else None
+        offsets = self._leased_by_id.get(id)
+        return min(offsets) if offsets else None
+
+    def _release(self, offset):
+        # callers hold the log's lock
+        id, deadline = self._in_process.pop(offset)
+        offsets = self._leased_by_id[id]
+        offsets.remove(offset)
+        if not offsets:
+            del self._leased_by_id[id]
+
+    def _mark_acked(self, offset):
+        # callers hold the log's lock
+        if offset < self.committed:
+            return
+        self._acked.add(offset)
+        advanced = False
+        while self.committed in self._acked:
+            self._acked.discard(self.committed)
+            self.committed += 1
+            advanced = True
+        if advanced:
+            self.log._truncate()
+
+    def _forget(self, offset):
+        # the event at `offset` was rolled back: treat any lease on it as acked
+        if offset in self._in_process:
+            self._release(offset)
+            self._mark_acked(offset)
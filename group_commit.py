@@ -0,0 +1,123 @@
+from dataclasses import dataclass, field
+from threading import Condition, Event, Thread
+import time
+
+from OsmoCaseStudy.models.fragrance_formula import FragranceFormula
+from OsmoCaseStudy.queue import DEFAULT_TENANT, PRIORITY_NORMAL
+
+@dataclass
+class PendingSubmission:
+    formulas: list
+    tenant: str = DEFAULT_TENANT
+    priority: int = PRIORITY_NORMAL
+    error: Exception = None # what went wrong for this submission, None on success
+    fallback: bool = False # the batch couldn't take it - the submitter commits it on its own
+    done: Event = field(default_factory=Event)
+
+class GroupCommitter:
+    def __init__(self, commit, db, queue, window=0.002, max_batch=64):
+        """
+        Collects submissions arriving within `window` seconds (or until `max_batch` are waiting)
+        and commits them together: one database check-and-insert (FragranceDatabase.add_batch)
+        and one queue publish_many(), instead of one of each per request.
+
+        Each submission keeps its own outcome: submissions that conflict with the store or with
+        an earlier submission in the same batch get their own Conflict and are left out of the batch.
+
+        If the queue won't take the batch (saturated, or failing), the batch's writes are undone and
+        each submitter commits its own submission with `commit(formulas, db, queue, tenant=..., priority=...)`
+        (FragranceServer.publish_with_retry) in its own thread: admission is then decided per submission,
+        and retries and backoff sleeps don't hold up the committer thread.
+        """
+        self.commit = commit
+        self.db = db
+        self.queue = queue
+        self.window = window
+        self.max_batch = max_batch
+
+        self._pending = []
+        self._cond = Condition()
+        self._thread = None
+        self._closed = False
+
+    def submit(self, formulas, tenant=DEFAULT_TENANT, priority=PRIORITY_NORMAL):
+        """
+        Blocks until the batch holding this submission is committed.
+        Returns None on success, or raises, like publish_with_retry().
+        """
+        if isinstance(formulas, FragranceFormula):
+            formulas = [formulas]
+        submission = PendingSubmission(formulas, tenant, priority)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("GroupCommitter is closed")
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="formula-group-commit", daemon=True)
+                self._thread.start()
+            self._pending.append(submission)
+            self._cond.notify_all()
+
+        submission.done.wait()
+        if submission.fallback:
+            return self.commit(formulas, self.db, self.queue, tenant=tenant, priority=priority)
+        if submission.error is not None:
+            raise submission.error
+        return None
+
+    def close(self):
+        # commits whatever is pending, then stops the committer thread
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._closed)
+                if not self._pending:
+                    return # closed
+
+                # the first submission opens the window; close it early if the batch fills up
+                deadline = time.monotonic() + self.window
+                while len(self._pending) < self.max_batch and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+
+            self._commit_batch(batch)
+
+    def _commit_batch(self, batch):
+        try:
+            # first come, first served - later submissions of a formula in the same batch conflict with the earlier one
+            accepted = []
+            for submission, error in zip(batch, self.db.add_batch([submission.formulas for submission in batch])):
+                if error is None:
+                    accepted.append(submission)
+                else:
+                    submission.error = error
+            if accepted:
+                self._publish_accepted(accepted)
+        except Exception:
+            for submission in batch:
+                if submission.error is None:
+                    submission.fallback = True
+        finally:
+            for submission in batch:
+                submission.done.set()
+
+    def _publish_accepted(self, accepted):
+        formulas = [formula for submission in accepted for formula in submission.formulas]
+        try:
+            self.queue.publish_many([(formula, submission.tenant, submission.priority)
+                                     for submission in accepted for formula in submission.formulas])
+        except Exception:
+            # undo the batch's writes; each submission is then committed on its own by its submitter
+            self.db.remove_formulas(formulas)
+            self.queue.remove(formulas)
+            for submission in accepted:
+                submission.fallback = True
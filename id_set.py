@@ -0,0 +1,102 @@
+from array import array
+from bisect import bisect_left
+
+from OsmoCaseStudy.bloom import BloomFilter
+
+class CompactIdSet:
+    def __init__(self, block_size=4096, max_entries=None, bloom_error_rate=None, bloom_capacity=65536):
+        """
+        An exact set of integer ids (formula hashes) that costs ~8 bytes per id instead of the
+        ~60-70 bytes of a Python set entry.
+
+        New ids go into a small set buffer; when it holds `block_size` ids it is sorted into a
+        sealed array('q') block. Lookups check the buffer, then binary search each block.
+        Blocks are kept oldest first, so with `max_entries` set the oldest ids are forgotten once
+        the set grows past it (match it to how long the durable store keeps formulas).
+
+        With `bloom_error_rate` set, a BloomFilter in front answers most lookups for ids that were
+        never added without touching the blocks.
+        """
+        self.block_size = block_size
+        self.max_entries = max_entries
+        self.bloom_error_rate = bloom_error_rate
+        self._blocks = [] # sorted array('q') blocks, oldest first
+        self._buffer = set() # newest ids, not yet sealed into a block
+        self._size = 0
+        self._bloom = BloomFilter(bloom_capacity, bloom_error_rate) if bloom_error_rate else None
+        self._bloom_stale = 0 # ids removed since the bloom filter was built - it can't forget them itself
+
+    def add(self, id: int):
+        if id in self:
+            return
+        self._buffer.add(id)
+        self._size += 1
+        if self._bloom is not None:
+            self._bloom.add(id)
+            if self._bloom.is_full():
+                self._rebuild_bloom(capacity=self._bloom.capacity * 2)
+        if len(self._buffer) >= self.block_size:
+            self._seal()
+
+    def discard(self, id: int):
+        if id in self._buffer:
+            self._buffer.discard(id)
+        else:
+            block, index = self._find(id)
+            if block is None:
+                return
+            del block[index] # O(block_size) memmove - removals only happen on rollback
+        self._size -= 1
+        if self._bloom is not None:
+            self._bloom_stale += 1
+            if self._bloom_stale > self._size:
+                self._rebuild_bloom()
+
+    def __contains__(self, id: int):
+        if self._bloom is not None and id not in self._bloom:
+            return False
+        if id in self._buffer:
+            return True
+        return self._find(id)[0] is not None
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for block in self._blocks:
+            yield from block
+        yield from self._buffer
+
+    def nbytes(self):
+        # approximate memory for the ids themselves
+        blocks = sum(block.itemsize * len(block) for block in self._blocks)
+        bloom = self._bloom.nbytes() if self._bloom is not None else 0
+        return blocks + bloom + 64 * len(self._buffer)
+
+    def _find(self, id):
+        # newest blocks first - recently published ids are the likeliest to be checked again
+        for block in reversed(self._blocks):
+            index = bisect_left(block, id)
+            if index < len(block) and block[index] == id:
+                return block, index
+        return None, None
+
+    def _seal(self):
+        self._blocks.append(array("q", sorted(self._buffer)))
+        self._buffer = set()
+        if self.max_entries is not None:
+            while self._blocks and self._size - len(self._blocks[0]) >= self.max_entries:
+                dropped = len(self._blocks.pop(0))
+                self._size -= dropped
+                if self._bloom is not None:
+                    # forgotten ids stay in the bloom filter (harmless false positives) until it's worth rebuilding
+                    self._bloom_stale += dropped
+            if self._bloom is not None and self._bloom_stale > self._size:
+                self._rebuild_bloom()
+
+    def _rebuild_bloom(self, capacity=None):
+        capacity = max(capacity or self._bloom.capacity, self._size)
+        self._bloom = BloomFilter(capacity, self.bloom_error_rate)
+        for id in self:
+            self._bloom.add(id)
+        self._bloom_stale = 0
@@ -0,0 +1,268 @@
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from threading import Lock
+
+# A tool for driving the API with realistic traffic, used for capacity planning.
+# It replays a request file (one JSON formula payload per line) or a synthetic
+# distribution of formulas against either the Flask test client (in-process) or a
+# running server, and reports throughput, latency percentiles and status codes.
+#
+# Example:
+#   python -m OsmoCaseStudy.loadgen --synthetic 5000 --concurrency 32 --rate 500
+#   python -m OsmoCaseStudy.loadgen --requests requests.jsonl --target http://127.0.0.1:5000
+
+SYNTHETIC_MATERIALS = [
+    "Bergamot Oil", "Lavender Absolute", "Sandalwood", "Amber", "Jasmine",
+    "Rose Otto", "Vetiver", "Patchouli", "Neroli", "Vanilla Absolute",
+    "Cedarwood", "Ylang Ylang", "Iris Butter", "Oakmoss", "Musk",
+]
+
+PERCENTILES = (50, 95, 99, 99.9)
+
+@dataclass
+class PlannedRequest:
+    payload: object
+    idempotency_key: str
+    kind: str = "new" # "new", "duplicate" (same formula, new key) or "key_reuse" (same formula, same key)
+
+@dataclass
+class RequestResult:
+    kind: str
+    status: int # 0 when the request never got a response
+    latency: float # seconds, measured from the scheduled send time
+    error: str = None
+
+@dataclass
+class LoadReport:
+    results: list = field(default_factory=list)
+    duration: float = 0.0
+
+    def throughput(self):
+        if self.duration <= 0:
+            return 0.0
+        return len(self.results) / self.duration
+
+    def latency_percentiles(self):
+        latencies = sorted(result.latency for result in self.results)
+        return {p: percentile(latencies, p) for p in PERCENTILES}
+
+    def status_counts(self):
+        return Counter(result.status for result in self.results)
+
+    def error_counts(self):
+        # transport level errors (connection refused, timeouts...) keyed by exception type
+        return Counter(result.error for result in self.results if result.error)
+
+    def status_counts_by_kind(self):
+        counts = {}
+        for result in self.results:
+            counts.setdefault(result.kind, Counter())[result.status] += 1
+        return counts
+
+    def summary(self):
+        return {
+            "requests": len(self.results),
+            "duration_s": round(self.duration, 3),
+            "throughput_rps": round(self.throughput(), 1),
+            "latency_ms": {f"p{p:g}": round(v * 1000, 3) for p, v in self.latency_percentiles().items()},
+            "status_codes": dict(sorted(self.status_counts().items())),
+            "status_codes_by_kind": {kind: dict(sorted(c.items())) for kind, c in self.status_counts_by_kind().items()},
+            "errors": dict(self.error_counts()),
+        }
+
+def percentile(sorted_values, p):
+    """
+    Nearest-rank percentile of an already sorted list. Returns 0.0 for an empty list.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(-(-p * len(sorted_values) // 100))) # ceil(p/100 * n), at least 1
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+###########################################
+# Workload sources
+###########################################
+def load_request_file(path):
+    """
+    Reads one request payload per line. A line is either a formula (or list of formulas)
+    exactly as it would be POSTed, or an object wrapping it: {"payload": ..., "idempotency_key": ...}
+    """
+    requests = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            requests.append(json.loads(line))
+    return requests
+
+def synthetic_formulas(count, min_materials=1, max_materials=6, seed=None):
+    """
+    Generates `count` formula payloads with a random selection of materials and concentrations.
+    """
+    rng = random.Random(seed)
+    for i in range(count):
+        size = rng.randint(min_materials, min(max_materials, len(SYNTHETIC_MATERIALS)))
+        materials = rng.sample(SYNTHETIC_MATERIALS, size)
+        yield {
+            "name": f"Synthetic Formula {i}",
+            "materials": [
+                {"name": name, "concentration": round(rng.uniform(0.1, 60.0), 1)}
+                for name in materials
+            ],
+        }
+
+def build_plan(payloads, duplicate_ratio=0.0, key_reuse_ratio=0.0, seed=None):
+    """
+    Turns a list of payloads into the requests to send.
+    - duplicate_ratio: share of extra requests that resend an earlier formula under a new key (expect 409)
+    - key_reuse_ratio: share of extra requests that resend an earlier formula with its original key (expect a replayed response)
+    """
+    rng = random.Random(seed)
+    plan = []
+    for payload in payloads:
+        if isinstance(payload, dict) and "payload" in payload:
+            key = payload.get("idempotency_key") or str(uuid.uuid4())
+            payload = payload["payload"]
+        else:
+            key = str(uuid.uuid4())
+
+        if plan:
+            roll = rng.random()
+            if roll < key_reuse_ratio:
+                original = rng.choice(plan)
+                plan.append(PlannedRequest(original.payload, original.idempotency_key, "key_reuse"))
+            elif roll < key_reuse_ratio + duplicate_ratio:
+                original = rng.choice(plan)
+                plan.append(PlannedRequest(original.payload, str(uuid.uuid4()), "duplicate"))
+        plan.append(PlannedRequest(payload, key))
+    return plan
+
+###########################################
+# Transports
+###########################################
+class TestClientTransport:
+    # pytest would otherwise try to collect this class because of its name
+    __test__ = False
+
+    def __init__(self, app):
+        """
+        Sends requests in-process through Flask's test client. Each worker thread gets its own client.
+        """
+        self.app = app
+        self._local = threading.local()
+
+    def send(self, payload, idempotency_key):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.post("/formulas", json=payload, headers={"Idempotency-Key": idempotency_key})
+        return response.status_code
+
+class HttpTransport:
+    def __init__(self, base_url, timeout=10.0):
+        """
+        Sends requests to a running server over HTTP.
+        """
+        self.url = base_url.rstrip("/") + "/formulas"
+        self.timeout = timeout
+
+    def send(self, payload, idempotency_key):
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(payload).encode(),
+            headers={"Content-Type": "application/json", "Idempotency-Key": idempotency_key},
+            method="POST",
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            # 4xx/5xx are results, not transport failures
+            return e.code
+
+###########################################
+# Driver
+###########################################
+def run_load(plan, transport, concurrency=8, rate=None):
+    """
+    Sends every planned request through `transport` using `concurrency` worker threads.
+
+    If `rate` (requests/second) is given the load is open-loop: requests are released on a
+    fixed schedule whether or not earlier ones have completed, and latency is measured from the
+    scheduled send time so that queueing inside the generator counts against the server
+    (avoids coordinated omission). Without a rate the workers send back-to-back (closed loop).
+    """
+    report = LoadReport()
+    results_lock = Lock()
+
+    def send(planned, scheduled_at):
+        if scheduled_at is None:
+            # closed loop: the clock starts when a worker actually picks the request up
+            scheduled_at = time.perf_counter()
+        error = None
+        try:
+            status = transport.send(planned.payload, planned.idempotency_key)
+        except Exception as e:
+            status, error = 0, type(e).__name__
+        result = RequestResult(planned.kind, status, time.perf_counter() - scheduled_at, error)
+        with results_lock:
+            report.results.append(result)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for i, planned in enumerate(plan):
+            scheduled_at = None
+            if rate:
+                scheduled_at = start + i / rate
+                wait = scheduled_at - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+            pool.submit(send, planned, scheduled_at)
+    report.duration = time.perf_counter() - start
+    return report
+
+def format_report(report):
+    return json.dumps(report.summary(), indent=2)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay formula submissions against the Fragrance API")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--requests", help="path to a .jsonl file with one request payload per line")
+    source.add_argument("--synthetic", type=int, help="number of synthetic formulas to generate")
+    parser.add_argument("--target", help="base URL of a running server; defaults to an in-process test client")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=None, help="open-loop arrival rate in requests/second")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.0)
+    parser.add_argument("--key-reuse-ratio", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    if args.requests:
+        payloads = load_request_file(args.requests)
+    else:
+        payloads = list(synthetic_formulas(args.synthetic, seed=args.seed))
+    plan = build_plan(payloads, args.duplicate_ratio, args.key_reuse_ratio, seed=args.seed)
+
+    if args.target:
+        transport = HttpTransport(args.target)
+    else:
+        from OsmoCaseStudy.app import create_app
+        transport = TestClientTransport(create_app())
+
+    report = run_load(plan, transport, concurrency=args.concurrency, rate=args.rate)
+    print(format_report(report))
+    return report
+
+if __name__ == "__main__":
+    main()
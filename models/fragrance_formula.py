@@ -1,6 +1,26 @@
 
+from hashlib import blake2b
 from .material import Material
 
+DIGEST_MODULUS = 1 << 64
+
+def material_digest(position: int, material: Material) -> int:
+    """
+    Stable 64-bit digest of one material at one position in a formula.
+    Equal concentrations hash the same however they were written (15.5 == 15.50).
+    """
+    key = f"{position}\x1f{material.name}\x1f{material.concentration.normalize()}"
+    return int.from_bytes(blake2b(key.encode(), digest_size=8).digest(), "big")
+
+def combine_digests(material_digests) -> int:
+    """
+    A formula's digest is the sum of its material digests mod 2^64, as a signed 64-bit int
+    (the range of Python's hash()). Being a sum, it can be updated for a changed material
+    by subtracting the old material's digest and adding the new one.
+    """
+    total = sum(material_digests) % DIGEST_MODULUS
+    return total - DIGEST_MODULUS if total >= DIGEST_MODULUS // 2 else total
+
 class FragranceFormula:
     def __init__(self, name:str, materials:tuple[Material]):
         """
@@ -14,12 +34,53 @@ class FragranceFormula:
 
         self.name = name
         self.materials = materials
+        self._digest = None
+
+    def digest(self) -> int:
+        # computed once - materials don't change after creation
+        if self._digest is None:
+            self._digest = combine_digests(
+                material_digest(position, material) for position, material in enumerate(self.materials)
+            )
+        return self._digest
+
+    def with_deltas(self, deltas: dict) -> "FragranceFormula":
+        """
+        Returns a copy of this formula with `deltas` applied (Key: material name, Value: Decimal change
+        in concentration). Materials not in the formula are appended to it.
+        Only the changed materials are rehashed: the copy's digest is this digest minus the old
+        materials' digests plus the new ones'. Raises ValueError if a concentration would not stay above 0.
+        """
+        materials = list(self.materials)
+        positions = {}
+        for position, material in enumerate(materials):
+            positions.setdefault(material.name, position)
+
+        digest = self.digest()
+        for name, delta in deltas.items():
+            position = positions.get(name)
+            if position is None:
+                # new material - goes at the end, so no other material changes position
+                position = positions[name] = len(materials)
+                materials.append(None)
+                concentration = delta
+            else:
+                digest -= material_digest(position, materials[position])
+                concentration = materials[position].concentration + delta
+            if concentration <= 0:
+                raise ValueError(f"Concentration of {name!r} would be {concentration}, it must stay above 0")
+            materials[position] = Material(name, concentration)
+            digest += material_digest(position, materials[position])
+
+        updated = FragranceFormula(self.name, tuple(materials))
+        updated._digest = combine_digests([digest])
+        return updated
 
     def __hash__(self):
-        # Note: create hash based on formula only, not name, because python's string hash
-        # may have different results across different runs, and we will use this hash as 
-        # a unique identifier and need to get the same hash code in future runs to query the db
-        return hash((self.materials))
+        # Note: create hash based on formula only, not name, because formula uniqueness is defined by its material make-up.
+        # We use this hash as a unique identifier and need to get the same hash code in future runs (and other processes)
+        # to query the db, so it comes from digest() rather than python's hash(), which is salted per process for strings
+        return self.digest()
     
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
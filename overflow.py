@@ -0,0 +1,84 @@
+from dataclasses import asdict
+from threading import Lock
+import json
+import os
+
+class OverflowSegment:
+    def __init__(self, path, max_events=None):
+        """
+        An append-only file of queue events (one JSON object per line) that absorbs bursts
+        when the in-memory queue is full, so they don't have to be held in RAM or rejected.
+        Events are read back in the order they were written; once everything written has been
+        read back the file is truncated so it doesn't grow forever.
+
+        The file is opened once and kept open, and the segment has its own lock, so the queue
+        doesn't hold its lock during file I/O: it reserve()s room for a spill under its lock
+        (so depth decisions count the spill straight away) and append()s after releasing it.
+
+        An existing non-empty file is refused rather than truncated - its events may belong to
+        another running queue, or be the only copy left of a previous one's backlog.
+        """
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            raise ValueError(f"Overflow file {path} already holds events - refusing to overwrite it")
+        self.path = path
+        self.max_events = max_events
+        self._file = open(path, "a+b") # appends always go to the end; reads seek to _read_offset
+        self._lock = Lock()
+        self._read_offset = 0 # byte offset of the next event to read
+        self._written = 0 # events in the file not yet read back
+        self._reserved = 0 # events reserved by a publisher but not written yet
+
+    def has_room(self, count=1):
+        return self.max_events is None or len(self) + count <= self.max_events
+
+    def reserve(self, count):
+        with self._lock:
+            self._reserved += count
+
+    def cancel(self, count):
+        # the reserved events won't be written after all (the write failed)
+        with self._lock:
+            self._reserved -= count
+
+    def append(self, events):
+        lines = b"".join(json.dumps(asdict(event)).encode() + b"\n" for event in events)
+        with self._lock:
+            self._file.write(lines)
+            self._file.flush()
+            self._reserved -= len(events)
+            self._written += len(events)
+
+    def read(self, max_events):
+        """
+        Returns up to `max_events` of the oldest written events as dicts, removing them from the segment.
+        """
+        records = []
+        with self._lock:
+            self._file.seek(self._read_offset)
+            while len(records) < max_events:
+                line = self._file.readline()
+                if not line:
+                    break
+                records.append(json.loads(line))
+            self._read_offset = self._file.tell()
+            self._written -= len(records)
+
+            if self._written <= 0:
+                # fully drained - reclaim the disk space; reserved events are written at the new end
+                self._file.truncate(0)
+                self._read_offset = 0
+                self._written = 0
+        return records
+
+    def readable(self):
+        # events written and waiting to be read back
+        return self._written
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __len__(self):
+        return self._written + self._reserved
@@ -1,92 +1,461 @@
 from collections import deque
-from werkzeug.exceptions import InternalServerError
-from dataclasses import dataclass, field
+import heapq
+import itertools
+from werkzeug.exceptions import InternalServerError, ServiceUnavailable, TooManyRequests
+from dataclasses import dataclass, field, replace
 from threading import Lock
+import math
 import time
 
 from OsmoCaseStudy.models.fragrance_formula import FragranceFormula
+from OsmoCaseStudy.overflow import OverflowSegment
+from OsmoCaseStudy.id_set import CompactIdSet
+
+# Priority lanes - a lower number is served first
+PRIORITY_HIGH = 0 # interactive submissions
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2 # large list submissions / backfills
+PRIORITIES = {"high": PRIORITY_HIGH, "normal": PRIORITY_NORMAL, "bulk": PRIORITY_BULK}
+
+DEFAULT_TENANT = "default"
 
 @dataclass
 class FormulaCreatedEvent:
     name: str
     id: int
     created_timestamp: int = field(default_factory=time.time_ns)
+    tenant: str = DEFAULT_TENANT
+    priority: int = PRIORITY_NORMAL
+    offset: int = None # unique per event: publish order in a FormulaCreatedQueue, position in a FormulaEventLog
+
+@dataclass
+class FormulaUpdatedEvent:
+    # A compact "formula changed" notice: only the material deltas, not the whole formula
+    name: str
+    id: int # the formula's new id
+    previous_id: int
+    deltas: tuple = () # (material name, change in concentration as a string) pairs
+    created_timestamp: int = field(default_factory=time.time_ns)
+    tenant: str = DEFAULT_TENANT
+    priority: int = PRIORITY_NORMAL
+    offset: int = None
+
+def event_from_record(record):
+    # rebuilds an event written out with dataclasses.asdict, e.g. by OverflowSegment
+    if "previous_id" in record:
+        return FormulaUpdatedEvent(**{**record, "deltas": tuple(tuple(delta) for delta in record["deltas"])})
+    return FormulaCreatedEvent(**record)
 
 @dataclass
 class InProcessEvent:
     event: FormulaCreatedEvent
     ack_deadline: float
-    
+
+class PriorityLane:
+    def __init__(self, tenant_weights=None):
+        """
+        The events waiting at one priority, shared fairly between tenants with deficit round-robin:
+        each tenant has its own FIFO, and tenants with waiting events take turns in `_active`.
+        On its turn a tenant earns `weight` credits and may dequeue one event per credit,
+        so a tenant bulk-loading 100k formulas gets the same share as a tenant submitting one.
+        push/pop are O(1) amortised.
+        Weights must be positive - a tenant that never earns a credit would never be served.
+        """
+        for tenant, weight in (tenant_weights or {}).items():
+            if not weight > 0:
+                raise ValueError(f"Tenant weight must be positive, got {weight!r} for tenant {tenant!r}")
+        self._tenant_queues = {} # Key: tenant, Value: deque of events
+        self._active = deque() # tenants with waiting events, in round-robin order
+        self._deficit = {} # Key: tenant, Value: dequeue credits left in its current turn
+        self._tenant_weights = tenant_weights or {}
+        self._size = 0
+
+    def push(self, event):
+        self._queue_for(event.tenant).append(event)
+        self._size += 1
+
+    def push_front(self, event):
+        # used for redelivered events: they go to the front of their tenant's queue, and the tenant gets the next turn
+        tenant_queue = self._tenant_queues.get(event.tenant)
+        if not tenant_queue:
+            tenant_queue = self._tenant_queues[event.tenant] = deque()
+            self._deficit[event.tenant] = 0
+            self._active.appendleft(event.tenant)
+        elif self._active[0] != event.tenant:
+            # already waiting for its turn - bring the turn forward, keeping whatever credit it has left
+            self._active.remove(event.tenant) # O(number of active tenants)
+            self._active.appendleft(event.tenant)
+        tenant_queue.appendleft(event)
+        self._size += 1
+
+    def pop(self):
+        while self._active:
+            tenant = self._active[0]
+            if self._deficit[tenant] < 1:
+                # start of this tenant's turn
+                self._deficit[tenant] += self._tenant_weights.get(tenant, 1)
+                if self._deficit[tenant] < 1:
+                    # fractional weight - not enough credit yet, skip to the next tenant
+                    self._active.rotate(-1)
+                    continue
+
+            tenant_queue = self._tenant_queues[tenant]
+            event = tenant_queue.popleft()
+            self._deficit[tenant] -= 1
+            self._size -= 1
+            if not tenant_queue:
+                self._retire(tenant)
+            elif self._deficit[tenant] < 1:
+                # turn over - go to the back of the line
+                self._active.rotate(-1)
+            return event
+        return None
+
+    def remove(self, event):
+        tenant_queue = self._tenant_queues.get(event.tenant)
+        if not tenant_queue:
+            return False
+        try:
+            tenant_queue.remove(event) # O(n) in the tenant's queue, only used during rollback
+        except ValueError:
+            return False
+        self._size -= 1
+        if not tenant_queue:
+            self._active.remove(event.tenant)
+            self._retire(event.tenant, active=False)
+        return True
+
+    def __len__(self):
+        return self._size
+
+    def _queue_for(self, tenant):
+        tenant_queue = self._tenant_queues.get(tenant)
+        if tenant_queue is None:
+            tenant_queue = self._tenant_queues[tenant] = deque()
+            self._deficit[tenant] = 0
+            self._active.append(tenant)
+        return tenant_queue
+
+    def _retire(self, tenant, active=True):
+        # an idle tenant loses its unused credit (DRR) and its bookkeeping, so idle tenants cost nothing
+        if active:
+            self._active.popleft()
+        del self._tenant_queues[tenant]
+        del self._deficit[tenant]
+
 class FormulaCreatedQueue:
-    def __init__(self, process_timeout=30):
+    def __init__(self, process_timeout=30, num_priorities=len(PRIORITIES), tenant_weights=None,
+                 max_depth=None, max_in_flight=None, overflow_path=None, overflow_max_events=None,
+                 default_retry_after=5, max_retry_after=60, archive=None, published_retention=None):
         """
         Initializes a queue for publishing a events when formulas are created.
 
         This queue can be used to notify other components when a new formula has been added and requires further processing. Only the formula name and hashcode (id) are stored in the queue. The hashcode can be used to look up the formula in the db, and the name can be used for quick logging etc that should not require an entire lookup.
+
+        Events are published into priority lanes (PRIORITY_HIGH first) and, within a lane, tenants
+        are served fairly (see PriorityLane). `tenant_weights` gives some tenants a larger share.
+
+        Backpressure (all optional, unbounded by default):
+        - max_depth: events waiting in memory. Beyond it publishing raises TooManyRequests (429),
+          unless `overflow_path` is set, in which case bursts spill to an OverflowSegment on disk
+          (up to `overflow_max_events`) and are read back as the queue drains.
+        - max_in_flight: events accepted but not yet acked (waiting + in process + delayed).
+          Beyond it publishing raises ServiceUnavailable (503) - consumers are not keeping up.
+        Both errors carry a Retry-After estimated from the rate at which consumers have been acking.
+
+        With an `archive` (an EventSegmentStore), acked events are kept there for replay instead of being forgotten.
+
+        `published_retention` bounds how many published ids are remembered for duplicate checks
+        (oldest forgotten first); keep it in line with how long the durable store keeps formulas.
         """
         # Represent the 3 stages of event processing
-        self._formula_created_queue = deque() # new events, waiting to be processed
-        self._in_process = {} # Key: id, Value: InProcessEvent - event fetched by consumer, being processed
-        self._published_hashes = set() # set of all id's of formulas that have been published
+        self._lanes = [PriorityLane(tenant_weights) for _ in range(num_priorities)] # new events, waiting to be processed
+        self._queued = {} # Key: offset, Value: FormulaCreatedEvent - index of events waiting in a lane
+        self._in_process = {} # Key: offset, Value: InProcessEvent - event fetched by consumer, being processed
+        self._offsets_by_id = {} # Key: id, Value: offsets of that formula's events waiting, in process or delayed
+        self._next_offset = itertools.count() # events are keyed by offset, not id - an update can bring an id back (A -> B -> A)
+        self._published_hashes = CompactIdSet(max_entries=published_retention, bloom_error_rate=0.01) # set of all id's of formulas that have been published
+        self._delayed = [] # heap of (ready_at, seq, event) - events nack'ed with a delay, waiting to be re-queued
+        self._delayed_seq = itertools.count() # tie-breaker so the heap never compares events
         
         self._lock = Lock()
         self.process_timeout = process_timeout
+
+        self.max_depth = max_depth
+        self.max_in_flight = max_in_flight
+        self.default_retry_after = default_retry_after # used until consumers have acked anything
+        self.max_retry_after = max_retry_after
+        self._recent_acks = deque(maxlen=128) # timestamps of the latest acks, for the drain rate
+        self._overflow = OverflowSegment(overflow_path, overflow_max_events) if overflow_path else None
+        self._spilled = {} # Key: id, Value: offsets of that formula's events in the overflow segment (reserved or written)
+        self._overflow_removed = set() # offsets of spilled events rolled back while on disk - skipped when read back
+        self._archive = archive
         
-    def publish(self, formulas):
+    def publish(self, formulas, tenant=DEFAULT_TENANT, priority=PRIORITY_NORMAL):
         if isinstance(formulas, list):
+            # admit the whole list or none of it
+            self.admit(len(formulas))
             for formula in formulas:
-                self.publish_one(formula)
+                self._publish(formula, tenant, priority)
         elif isinstance(formulas, FragranceFormula):
-            self.publish_one(formulas)
+            self.publish_one(formulas, tenant, priority)
 
-    def publish_one(self, formula):
+    def publish_one(self, formula, tenant=DEFAULT_TENANT, priority=PRIORITY_NORMAL):
+        self.admit(1)
+        return self._publish(formula, tenant, priority)
+
+    def _publish(self, formula, tenant=DEFAULT_TENANT, priority=PRIORITY_NORMAL):
         id = hash(formula) # db also uses hash as id/Key
 
         if id in self._published_hashes:
             # we have already published that this formula has been created - do not publish it again
             raise InternalServerError(f"This formula already exists in the queue")
         
-        event = FormulaCreatedEvent(formula.name, id)
+        event = FormulaCreatedEvent(formula.name, id, tenant=tenant, priority=priority, offset=next(self._next_offset))
         with self._lock:
-            self._formula_created_queue.append(event)
+            spill = self._should_spill()
+            if spill:
+                self._reserve_spill(event)
+            else:
+                self._enqueue(event)
             self._published_hashes.add(id) ## this is simply to check for duplicates in the future - name could be improved
+        if spill:
+            self._spill([event])
+        return id
+
+    def publish_many(self, entries):
+        """
+        Publishes a batch of (formula, tenant, priority) entries as one unit: admitted together,
+        checked for duplicates up front, and enqueued under a single lock acquisition.
+        """
+        self.admit(len(entries))
+        with self._lock:
+            ids = [hash(formula) for formula, tenant, priority in entries]
+            if len(set(ids)) != len(ids) or any(id in self._published_hashes for id in ids):
+                raise InternalServerError(f"This formula already exists in the queue")
+
+            events = [
+                FormulaCreatedEvent(formula.name, id, tenant=tenant, priority=priority, offset=next(self._next_offset))
+                for id, (formula, tenant, priority) in zip(ids, entries)
+            ]
+            spilled = []
+            for event in events:
+                if spilled or self._should_spill():
+                    spilled.append(event)
+                    self._reserve_spill(event)
+                else:
+                    self._enqueue(event)
+                self._published_hashes.add(event.id)
+        if spilled:
+            self._spill(spilled)
+        return ids
+
+    def publish_update(self, formula, previous_id, deltas, tenant=DEFAULT_TENANT, priority=PRIORITY_NORMAL):
+        """
+        Tells consumers that the formula published as `previous_id` has been updated to `formula`
+        (`deltas`: Key: material name, Value: Decimal change in concentration).
+
+        If its FormulaCreatedEvent is still waiting, that event is rekeyed in place - no consumer has
+        seen the old version, so they'll simply read the updated formula. Otherwise a compact
+        FormulaUpdatedEvent is published. Events already fetched by a consumer (or spilled to disk) keep the old id.
+        Either way the published ids are rekeyed, and nothing changes if this raises.
+        """
+        id = hash(formula)
+        with self._lock:
+            rekey_in_place = self._waiting_created_event(previous_id) is not None
+        if not rekey_in_place:
+            self.admit(1)
+
+        spilled = None
+        with self._lock:
+            if id != previous_id and id in self._published_hashes:
+                raise InternalServerError(f"This formula already exists in the queue")
+
+            waiting = self._waiting_created_event(previous_id)
+            if waiting is not None:
+                self._untrack(waiting)
+                waiting.id = id
+                waiting.name = formula.name
+                self._track(waiting)
+            else:
+                event = FormulaUpdatedEvent(formula.name, id, previous_id,
+                                            tuple((name, str(delta)) for name, delta in deltas.items()),
+                                            tenant=tenant, priority=priority, offset=next(self._next_offset))
+                if self._should_spill():
+                    spilled = event
+                    self._reserve_spill(event)
+                else:
+                    self._enqueue(event)
+            self._published_hashes.discard(previous_id)
+            self._published_hashes.add(id)
+        if spilled is not None:
+            self._spill([spilled], restore_id=previous_id)
         return id
 
     def get_next_item(self):
+        if self._overflow is not None and self._overflow.readable():
+            self._refill_from_overflow()
+
         with self._lock:
             # return unack'ed messages to queue if process-timeout expired
             now = time.time()
             # gather list of all events that are still "processing" but have exceeded their ack deadline (default: 30 seconds)
-            expired = [id for id, event in self._in_process.items() if event.ack_deadline <= now]
-            for id in expired:
+            expired = [offset for offset, event in self._in_process.items() if event.ack_deadline <= now]
+            for offset in expired:
                 # prioritize items that have been waiting a long time; append them to left (benefits of deque)
-                self._formula_created_queue.appendleft(self._in_process.pop(id).event)
+                # they keep their original priority lane
+                self._enqueue(self._in_process.pop(offset).event, front=True)
+
+            # release nack'ed events whose delay has passed; they go to the back like a fresh publish
+            while self._delayed and self._delayed[0][0] <= now:
+                self._enqueue(heapq.heappop(self._delayed)[2])
 
-            if not self._formula_created_queue:
+            next_item = None
+            for lane in self._lanes:
+                # strict priority between lanes, fair between tenants within a lane
+                if len(lane):
+                    next_item = lane.pop()
+                    break
+            if next_item is None:
                 return None
-            
-            next_item = self._formula_created_queue.popleft()
-            self._in_process[next_item.id] = InProcessEvent(
+            del self._queued[next_item.offset]
+
+            self._in_process[next_item.offset] = InProcessEvent(
                 event=next_item,
                 ack_deadline=time.time() + self.process_timeout
             )
             return next_item
         
-    def ack(self, id: int):
+    def ack(self, id: int, offset=None):
         # for client to call when the "processing" is complete
+        # pass the event's offset when the same id may be leased twice; without it the oldest lease on `id` is acked
+        with self._lock:
+            offset = self._leased_offset(id, offset)
+            if offset is None:
+                return False
+            in_process_event = self._in_process.pop(offset)
+            self._untrack(in_process_event.event)
+            self._recent_acks.append(time.time())
+        if self._archive is not None:
+            self._archive.append(in_process_event.event)
+        return True
+
+    def admit(self, count=1):
+        """
+        Admission control: raises if `count` more events would exceed the configured limits.
+        Limits are soft - concurrent publishers that are admitted together can overshoot slightly.
+        """
         with self._lock:
-            return self._in_process.pop(id, None) is not None
+            if self.max_in_flight is not None:
+                in_flight = self._in_flight_count()
+                if in_flight + count > self.max_in_flight:
+                    raise ServiceUnavailable(
+                        "Formula processing is saturated, try again later",
+                        retry_after=self.retry_after(in_flight + count - self.max_in_flight)
+                    )
+            if self.max_depth is not None:
+                # how many of the new events would not fit in memory
+                spilled = count if self._should_spill() else max(0, len(self._queued) + count - self.max_depth)
+                if spilled and (self._overflow is None or not self._overflow.has_room(spilled)):
+                    raise TooManyRequests(
+                        "Too many formulas waiting to be processed, try again later",
+                        retry_after=self.retry_after(len(self._queued) + count - self.max_depth)
+                    )
+
+    def drain_rate(self):
+        """
+        Events acked per second over the recent acks, or None before anything was acked.
+        Measured up to now, so the rate falls off when consumers stall.
+        """
+        if not self._recent_acks:
+            return None
+        elapsed = time.time() - self._recent_acks[0]
+        if elapsed <= 0:
+            return None
+        return len(self._recent_acks) / elapsed
+
+    def retry_after(self, excess):
+        # seconds until consumers should have cleared `excess` events at the observed drain rate
+        rate = self.drain_rate()
+        if not rate:
+            return self.default_retry_after
+        return min(self.max_retry_after, max(1, math.ceil(excess / rate)))
+
+    def extend_lease(self, id: int, extension=None, offset=None):
+        """
+        Heartbeat for consumers whose processing outlives `process_timeout`.
+        Pushes the ack deadline of an in-process event out by `extension` seconds (default: process_timeout)
+        so it is not redelivered while still being worked on.
+        Returns False if the lease is gone (acked, nacked, removed, or already expired and redelivered).
+        """
+        with self._lock:
+            offset = self._leased_offset(id, offset)
+            if offset is None:
+                return False
+            in_process_event = self._in_process[offset]
+            if in_process_event.ack_deadline <= time.time():
+                # too late - the next get_next_item() will hand it to someone else
+                return False
+            in_process_event.ack_deadline = time.time() + (extension if extension is not None else self.process_timeout)
+            return True
+
+    def nack(self, id: int, delay=0, offset=None):
+        """
+        For consumers to give an event back when processing failed.
+        The event becomes available again after `delay` seconds.
+        """
+        with self._lock:
+            offset = self._leased_offset(id, offset)
+            if offset is None:
+                return False
+            in_process_event = self._in_process.pop(offset)
+            if delay > 0:
+                heapq.heappush(self._delayed, (time.time() + delay, next(self._delayed_seq), in_process_event.event))
+            else:
+                self._enqueue(in_process_event.event)
+            return True
 
     def is_empty(self):
-        return len(self._formula_created_queue) == 0 
+        return self.size() == 0 
     
     def size(self):
-        return len(self._formula_created_queue)
+        return len(self._queued) + (len(self._overflow) if self._overflow is not None else 0)
+
+    def size_by_priority(self):
+        return [len(lane) for lane in self._lanes]
     
     def already_processed(self, formula):
         # only used in unit tests eg assert already-published
         return hash(formula) in self._published_hashes
     
+    def withdraw(self, id: int):
+        """
+        For moving a formula to another queue (see ShardedFragranceServer.update): forgets `id` as
+        published here, and takes its FormulaCreatedEvent out if it is still waiting - no consumer has
+        seen it, so the other queue can deliver it instead. Events already leased to a consumer, update
+        events and spilled events stay where they are. Returns the withdrawn event, or None.
+        """
+        with self._lock:
+            event = self._waiting_created_event(id)
+            if event is not None:
+                del self._queued[event.offset]
+                self._lane_for(event).remove(event)
+                self._untrack(event)
+            self._published_hashes.discard(id)
+        return event
+
+    def accept(self, id: int, event=None):
+        """
+        The other half of withdraw(): marks `id` as published here and enqueues the withdrawn `event`, if any.
+        The event was admitted by the queue it came from, so it isn't admitted again.
+        """
+        with self._lock:
+            if id in self._published_hashes:
+                raise InternalServerError(f"This formula already exists in the queue")
+            if event is not None:
+                self._enqueue(replace(event, offset=None)) # offsets are per queue
+            self._published_hashes.add(id)
+
     def remove(self, formulas):
         if isinstance(formulas, list):
             for formula in formulas:
@@ -102,13 +471,17 @@ class FormulaCreatedQueue:
             # don't let a ValueError from one block another
             try:
                 self.remove_event_from_queue_by_id(id)
+                # can't rewrite the overflow file - skip the formula's spilled events when they're read back instead
+                self._overflow_removed.update(self._spilled.pop(id, ()))
             except ValueError:
                 pass ## Gracefully handle when the ID isn't present 
 
-            try:
-                self._in_process.pop(id, None)
-            except ValueError:
-                pass
+            for offset in self._offsets_by_id.pop(id, ()):
+                self._in_process.pop(offset, None)
+
+            if any(delayed[2].id == id for delayed in self._delayed):
+                self._delayed = [delayed for delayed in self._delayed if delayed[2].id != id]
+                heapq.heapify(self._delayed)
 
             try:
                 # Remove from published hashes to allow retry
@@ -117,10 +490,118 @@ class FormulaCreatedQueue:
                 pass
 
     def remove_event_from_queue_by_id(self, id: int):
-        # the Deque built-in .remove() function already operates at O(n)
-        # therefore this could be made more efficient
-        for event in self._formula_created_queue:
-            if event.id == id:
-                self._formula_created_queue.remove(event)
-                return True
-        return False
\ No newline at end of file
+        # the index finds the events' lane and tenant directly; removal from the tenant's
+        # deque is still O(n) in that tenant's backlog
+        removed = False
+        for offset in self._offsets_by_id.get(id, ()):
+            event = self._queued.pop(offset, None)
+            if event is not None:
+                removed = self._lane_for(event).remove(event) or removed
+        return removed
+
+    def _waiting_created_event(self, id):
+        # callers hold self._lock
+        for offset in self._offsets_by_id.get(id, ()):
+            event = self._queued.get(offset)
+            if isinstance(event, FormulaCreatedEvent):
+                return event
+        return None
+
+    def _leased_offset(self, id, offset=None):
+        # callers hold self._lock
+        # the lease on the event at `offset`, or the oldest lease on formula `id` when no offset is given
+        if offset is not None:
+            in_process_event = self._in_process.get(offset)
+            return offset if in_process_event is not None and in_process_event.event.id == id else None
+        leased = [offset for offset in self._offsets_by_id.get(id, ()) if offset in self._in_process]
+        return min(leased) if leased else None
+
+    def _track(self, event):
+        # callers hold self._lock
+        offsets = self._offsets_by_id.setdefault(event.id, [])
+        if event.offset not in offsets:
+            offsets.append(event.offset)
+
+    def _untrack(self, event):
+        # callers hold self._lock
+        offsets = self._offsets_by_id.get(event.id)
+        if offsets and event.offset in offsets:
+            offsets.remove(event.offset)
+            if not offsets:
+                del self._offsets_by_id[event.id]
+
+    def _lane_for(self, event):
+        # priorities beyond the configured lanes share the lowest one
+        return self._lanes[min(max(event.priority, 0), len(self._lanes) - 1)]
+
+    def _in_flight_count(self):
+        # callers hold self._lock
+        return self.size() + len(self._in_process) + len(self._delayed)
+
+    def _should_spill(self):
+        # callers hold self._lock
+        # once anything has spilled, newer events follow it to disk so they can't overtake it
+        if self._overflow is None:
+            return False
+        return len(self._overflow) > 0 or (self.max_depth is not None and len(self._queued) >= self.max_depth)
+
+    def _reserve_spill(self, event):
+        # callers hold self._lock
+        self._overflow.reserve(1)
+        self._spilled.setdefault(event.id, []).append(event.offset)
+
+    def _unspill(self, id, offset):
+        # callers hold self._lock
+        offsets = self._spilled.get(id)
+        if offsets and offset in offsets:
+            offsets.remove(offset)
+            if not offsets:
+                del self._spilled[id]
+
+    def _spill(self, events, restore_id=None):
+        # called without self._lock, after reserving room under it - the file write doesn't hold up other publishers or consumers
+        try:
+            self._overflow.append(events)
+        except Exception:
+            # the events never made it to disk - un-publish them so the publisher's rollback/retry starts clean
+            self._overflow.cancel(len(events))
+            with self._lock:
+                for event in events:
+                    self._unspill(event.id, event.offset)
+                    self._overflow_removed.discard(event.offset)
+                    self._published_hashes.discard(event.id)
+                if restore_id is not None:
+                    self._published_hashes.add(restore_id)
+            raise
+
+    def _refill_from_overflow(self):
+        # called without self._lock: the file is read outside it, then the events are enqueued under it.
+        # Consumers refilling at the same time read different events, and can overshoot max_depth by a few.
+        while True:
+            with self._lock:
+                room = self.max_depth - len(self._queued) if self.max_depth is not None else self._overflow.readable()
+            if room <= 0:
+                return
+            records = self._overflow.read(room)
+            if not records:
+                return
+            with self._lock:
+                for record in records:
+                    self._unspill(record["id"], record["offset"])
+                    if record["offset"] in self._overflow_removed:
+                        # rolled back while on disk - drop it, and read again to fill its place
+                        self._overflow_removed.discard(record["offset"])
+                        continue
+                    self._enqueue(event_from_record(record))
+
+    def _enqueue(self, event, front=False):
+        # callers hold self._lock
+        if event.offset is None:
+            event.offset = next(self._next_offset)
+        lane = self._lane_for(event)
+        if front:
+            lane.push_front(event)
+        else:
+            lane.push(event)
+        self._queued[event.offset] = event
+        self._track(event)
@@ -0,0 +1,187 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from threading import Lock
+
+from OsmoCaseStudy.queue import FormulaCreatedEvent, FormulaUpdatedEvent
+
+class EventSegment:
+    def __init__(self, base_position):
+        """
+        A run of consecutive archived events stored column by column in typed arrays,
+        so each event costs a few machine words plus its name instead of a full Python object.
+        The event at index i is the store's (base_position + i)th archived event; its offset is offsets[i].
+        """
+        self.base_position = base_position
+        self.ids = array("q")
+        self.offsets = array("q") # offset as recorded on the event (e.g. its FormulaEventLog offset)
+        self.index_offsets = array("q") # running max of offsets - sorted, so it can be binary searched
+        self.timestamps = array("q") # created_timestamp (ns) as recorded on the event
+        self.index_timestamps = array("q") # running max of timestamps - sorted, so it can be binary searched
+        self.priorities = array("b")
+        self.names = []
+        self.tenants = []
+        self.updates = {} # Key: index, Value: (previous_id, deltas) - only for FormulaUpdatedEvents, which are rare
+
+    def append(self, event, offset, index_offset, index_timestamp):
+        if isinstance(event, FormulaUpdatedEvent):
+            self.updates[len(self.ids)] = (event.previous_id, event.deltas)
+        self.ids.append(event.id)
+        self.offsets.append(offset)
+        self.index_offsets.append(index_offset)
+        self.timestamps.append(event.created_timestamp)
+        self.index_timestamps.append(index_timestamp)
+        self.priorities.append(event.priority)
+        self.names.append(event.name)
+        self.tenants.append(event.tenant)
+
+    def event_at(self, index):
+        if index in self.updates:
+            previous_id, deltas = self.updates[index]
+            return FormulaUpdatedEvent(
+                self.names[index],
+                self.ids[index],
+                previous_id,
+                deltas,
+                created_timestamp=self.timestamps[index],
+                tenant=self.tenants[index],
+                priority=self.priorities[index],
+                offset=self.offsets[index],
+            )
+        return FormulaCreatedEvent(
+            self.names[index],
+            self.ids[index],
+            created_timestamp=self.timestamps[index],
+            tenant=self.tenants[index],
+            priority=self.priorities[index],
+            offset=self.offsets[index],
+        )
+
+    def end_position(self):
+        return self.base_position + len(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+class EventSegmentStore:
+    def __init__(self, segment_size=65536, max_segments=None):
+        """
+        Retains acknowledged events so consumers can replay them after a downstream outage
+        instead of re-deriving them from FragranceDatabase.
+
+        Events keep the offset they carry (their FormulaEventLog or FormulaCreatedQueue offset), so a
+        replayed event can be matched up with the log; an event without one gets the next offset after
+        the highest seen. Both offsets and created_timestamps can be sought by binary search (see replay()).
+        Events are kept in segments of `segment_size`; with `max_segments` set, the oldest segment is
+        dropped once that many are full.
+        """
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self._segments = [EventSegment(0)]
+        self._last_index_offset = -1
+        self._last_index_timestamp = 0
+        self._lock = Lock()
+
+    def append(self, event: FormulaCreatedEvent):
+        with self._lock:
+            segment = self._segments[-1]
+            if len(segment) >= self.segment_size:
+                segment = EventSegment(segment.end_position())
+                self._segments.append(segment)
+                if self.max_segments is not None and len(self._segments) > self.max_segments:
+                    self._segments.pop(0)
+
+            offset = event.offset if event.offset is not None else self._last_index_offset + 1
+            # events are acked roughly, not strictly, in creation (and offset) order - index on the running max
+            # so the index stays sorted; a seek then lands on or slightly before the requested time or offset
+            self._last_index_offset = max(self._last_index_offset, offset)
+            self._last_index_timestamp = max(self._last_index_timestamp, event.created_timestamp)
+            segment.append(event, offset, self._last_index_offset, self._last_index_timestamp)
+            return offset
+
+    def first_offset(self):
+        # offset of the oldest retained event
+        with self._lock:
+            segment = self._segments[0]
+            return segment.offsets[0] if len(segment) else self._last_index_offset + 1
+
+    def end_offset(self):
+        # the offset the next archived event gets if it doesn't carry one
+        with self._lock:
+            return self._last_index_offset + 1
+
+    def size(self):
+        with self._lock:
+            return self._segments[-1].end_position() - self._segments[0].base_position
+
+    def seek_offset(self, offset):
+        """
+        Returns the offset replay(from_offset=offset) starts at: `offset` itself if it was archived,
+        else the next archived offset after it. Older offsets start at the oldest retained event.
+        """
+        with self._lock:
+            return self._offset_at(self._seek("index_offsets", self._last_index_offset, offset))
+
+    def seek_timestamp(self, timestamp):
+        """
+        Returns the offset of the first archived event created at or after `timestamp` (ns).
+        Events archived out of creation order by more than that may also follow it, but no event
+        created at or after `timestamp` comes before it.
+        """
+        with self._lock:
+            return self._offset_at(self._seek("index_timestamps", self._last_index_timestamp, timestamp))
+
+    def replay(self, from_offset=None, from_timestamp=None, batch_size=500):
+        """
+        Streams archived events as lists of at most `batch_size` events (FormulaCreatedEvents or FormulaUpdatedEvents), starting from
+        `from_offset`, or from the first event created at/after `from_timestamp` (ns), or from the oldest retained.
+        Stops at the end of the store as of each batch, so it also picks up events archived while replaying.
+        Only one batch is materialised at a time.
+        """
+        with self._lock:
+            if from_timestamp is not None:
+                position = self._seek("index_timestamps", self._last_index_timestamp, from_timestamp)
+            else:
+                position = self._seek("index_offsets", self._last_index_offset, from_offset if from_offset is not None else 0)
+
+        while True:
+            batch, position = self._read(position, batch_size)
+            if not batch:
+                return
+            yield batch
+
+    def _seek(self, index, last_value, value):
+        # callers hold self._lock
+        # read position of the first event whose `index` column (a running max) reaches `value`
+        # segments are in position order and so is their index, so search segments by their last entry first
+        last_values = [getattr(segment, index)[-1] if len(segment) else last_value for segment in self._segments]
+        i = bisect_left(last_values, value)
+        if i == len(self._segments):
+            return self._segments[-1].end_position()
+        segment = self._segments[i]
+        return segment.base_position + bisect_left(getattr(segment, index), value)
+
+    def _offset_at(self, position):
+        # callers hold self._lock
+        if position >= self._segments[-1].end_position():
+            return self._last_index_offset + 1
+        i = bisect_right([segment.base_position for segment in self._segments], position) - 1
+        segment = self._segments[i]
+        return segment.offsets[position - segment.base_position]
+
+    def _read(self, position, count):
+        # returns the batch and the read position after it
+        with self._lock:
+            # skip ahead if retention dropped what we were about to read
+            position = max(position, self._segments[0].base_position)
+            base_positions = [segment.base_position for segment in self._segments]
+            i = bisect_right(base_positions, position) - 1
+            batch = []
+            while i < len(self._segments) and len(batch) < count:
+                segment = self._segments[i]
+                index = position - segment.base_position
+                while index < len(segment) and len(batch) < count:
+                    batch.append(segment.event_at(index))
+                    index += 1
+                position = segment.base_position + index
+                i += 1
+            return batch, position
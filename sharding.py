@@ -0,0 +1,410 @@
+import argparse
+from bisect import bisect_right
+from dataclasses import replace
+from concurrent.futures import Future, ThreadPoolExecutor
+from hashlib import blake2b
+import itertools
+import multiprocessing
+from multiprocessing.connection import AuthenticationError, Client, Listener
+import os
+from threading import Lock, Thread
+from werkzeug.exceptions import BadRequest, NotFound, NotImplemented as HTTPNotImplemented
+
+from OsmoCaseStudy.app import (
+    FragranceServer, database_options_from_env, group_commit_window_from_env, make_database,
+    queue_options_from_env, shard_authkey_from_env,
+)
+from OsmoCaseStudy.bloom import MASK_64
+from OsmoCaseStudy.models.fragrance_formula import FragranceFormula
+from OsmoCaseStudy.queue import FormulaCreatedQueue
+
+class ConsistentHashRing:
+    def __init__(self, num_shards, vnodes=64):
+        """
+        Maps formula digests to shards. Each shard owns `vnodes` points on a 64-bit ring and a digest
+        belongs to the first point at or after it, so adding a shard only moves ~1/N of the formulas.
+        """
+        self.num_shards = num_shards
+        points = []
+        for shard in range(num_shards):
+            for vnode in range(vnodes):
+                key = f"shard-{shard}-{vnode}".encode()
+                points.append((int.from_bytes(blake2b(key, digest_size=8).digest(), "big"), shard))
+        points.sort()
+        self._points = [point for point, shard in points]
+        self._shards = [shard for point, shard in points]
+
+    def shard_for(self, digest: int):
+        index = bisect_right(self._points, digest & MASK_64) % len(self._points)
+        return self._shards[index]
+
+def parse_addresses(value):
+    # "host:port,host:port" -> [(host, port), ...]
+    addresses = []
+    for address in value.split(","):
+        host, port = address.strip().rsplit(":", 1)
+        addresses.append((host, int(port)))
+    return addresses
+
+def shard_options(options, path_key, shard):
+    # a copy of `options` for one shard: a configured file path gets a per-shard suffix, so shards sharing a config don't share files
+    options = dict(options or {})
+    if options.get(path_key):
+        options[path_key] = f"{options[path_key]}.shard-{shard}"
+    return options
+
+class Shard:
+    def __init__(self, shard, queue_options=None, database_options=None, group_commit_window=None, max_workers=32):
+        """
+        One partition of the formulas: its own FragranceDatabase and FormulaCreatedQueue (and group
+        committer), configured like a standalone server from the same options.
+
+        Routers send requests as (request_id, op, *args) and get replies as (request_id, "ok", result)
+        or (request_id, "error", exception). Requests are handled on a pool of `max_workers` threads
+        and answered as they finish, so one request backing off or waiting on a lock doesn't hold up
+        the others, and a router can have many requests in flight on one connection.
+        Several routers can connect to the same shard (see serve_forever()); idempotency keys are
+        kept here too, so a retry is recognised whichever router it reaches.
+        """
+        self.shard = shard
+        self.database_options = shard_options(database_options, "duplicate_filter_path", shard)
+        self.server = FragranceServer(
+            db=make_database(**self.database_options),
+            queue=FormulaCreatedQueue(**shard_options(queue_options, "overflow_path", shard)),
+            group_commit_window=group_commit_window,
+        )
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"formula-shard-{shard}")
+
+    def serve(self, conn):
+        # serves one router connection until the router says "stop" or goes away
+        send_lock = Lock()
+        def reply(request_id, op, args):
+            try:
+                message = (request_id, "ok", self.handle(op, *args))
+            except Exception as e:
+                message = (request_id, "error", e)
+            with send_lock:
+                try:
+                    conn.send(message)
+                except (OSError, ValueError):
+                    pass # router went away
+                except Exception as e:
+                    # the result or error couldn't be pickled - report that instead
+                    conn.send((request_id, "error", RuntimeError(f"Unserializable shard reply: {e!r}")))
+
+        while True:
+            try:
+                request_id, op, *args = conn.recv()
+            except (EOFError, OSError):
+                return # router went away
+            if op == "stop":
+                with send_lock:
+                    conn.send((request_id, "ok", None))
+                return
+            self._pool.submit(reply, request_id, op, args)
+
+    def serve_forever(self, listener):
+        # accepts router connections (multiprocessing.connection.Listener) and serves each on its own thread
+        while True:
+            try:
+                conn = listener.accept()
+            except OSError:
+                return # listener closed
+            except AuthenticationError:
+                continue
+            Thread(target=self.serve, args=(conn,), name=f"formula-shard-{self.shard}-router", daemon=True).start()
+
+    def handle(self, op, *args):
+        server = self.server
+        if op == "submit":
+            formulas, publish_options = args
+            return server.commit(formulas, **publish_options)
+        if op == "rollback":
+            (formulas,) = args
+            server.db.remove_formulas(formulas)
+            server.q.remove(formulas)
+            return None
+        if op == "get":
+            (id,) = args
+            return server.db.get(id)
+        if op == "update":
+            id, deltas, publish_options = args
+            return server.update(id, deltas, **publish_options)
+        # An update that moves a formula between shards (see ShardedFragranceServer.update)
+        if op == "adopt":
+            # store the updated formula on its new shard (with the duplicate check); it's announced later
+            (formula,) = args
+            server.db.add_formula(formula)
+            return None
+        if op == "release":
+            # drop the previous version from its old shard, unless it has changed since it was read.
+            # Returns its FormulaCreatedEvent if no consumer has fetched it yet, so it moves with the formula;
+            # events consumers are working on are left alone
+            (formula,) = args
+            if server.db.get(hash(formula)) is None:
+                raise NotFound(f"No formula with id {hash(formula)}")
+            server.db.remove_formula(formula)
+            return server.q.withdraw(hash(formula))
+        if op == "announce":
+            # tell consumers on the new shard: the moved FormulaCreatedEvent (rekeyed, as in a single queue), or an update event
+            formula, previous_id, deltas, waiting, publish_options = args
+            if waiting is not None:
+                server.q.accept(hash(formula), replace(waiting, id=hash(formula), name=formula.name))
+            else:
+                server.q.publish_update(formula, previous_id, deltas, **publish_options)
+            return None
+        if op == "restore":
+            # undo "release"
+            formula, waiting = args
+            server.db.add_formula(formula)
+            server.q.accept(hash(formula), waiting)
+            return None
+        if op == "idempotency_lookup":
+            key, fingerprint = args
+            return server.idempotency_lookup(key, fingerprint)
+        if op == "idempotency_store":
+            key, fingerprint, response = args
+            return server.idempotency_store(key, fingerprint, response)
+        if op == "stats":
+            return {"formulas": server.db.size(), "queued": server.q.size()}
+        raise ValueError(f"Unknown shard operation: {op}")
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        if self.server.group_committer is not None:
+            self.server.group_committer.close()
+        if self.database_options.get("duplicate_filter_path"):
+            self.server.db.save_duplicate_filter()
+
+def shard_main(conn, shard, queue_options=None, database_options=None, group_commit_window=None):
+    # entry point of a shard process started by ShardedFragranceServer: serves its one router until told to stop
+    worker = Shard(shard, queue_options, database_options, group_commit_window)
+    try:
+        worker.serve(conn)
+    finally:
+        worker.close()
+
+class ShardClient:
+    def __init__(self, conn):
+        """
+        The router's end of a shard connection. Requests are tagged with ids and replies are matched
+        back to them by a reader thread, so any number of router threads can have requests in flight
+        on the same connection; the connection is only locked while a request is being written.
+        """
+        self._conn = conn
+        self._send_lock = Lock()
+        self._request_ids = itertools.count()
+        self._pending = {} # Key: request id, Value: Future waiting for the shard's reply
+        self._pending_lock = Lock()
+        self._reader = Thread(target=self._read_replies, name="formula-shard-client", daemon=True)
+        self._reader.start()
+
+    def request(self, op, *args):
+        # returns a Future of the shard's result; it raises the shard's error
+        future = Future()
+        request_id = next(self._request_ids)
+        with self._pending_lock:
+            self._pending[request_id] = future
+        try:
+            with self._send_lock:
+                self._conn.send((request_id, op, *args))
+        except Exception:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            raise
+        return future
+
+    def close(self):
+        self._conn.close()
+
+    def _read_replies(self):
+        while True:
+            try:
+                request_id, status, result = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._pending_lock:
+                future = self._pending.pop(request_id, None)
+            if future is None:
+                continue
+            if status == "error":
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        # the shard went away - fail whatever is still waiting
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(ConnectionError("Shard connection closed"))
+
+class ShardedFragranceServer(FragranceServer):
+    def __init__(self, num_shards=None, addresses=None, authkey=None, queue_options=None, database_options=None,
+                 group_commit_window=None, vnodes=64, start_method="spawn"):
+        """
+        The same REST API as FragranceServer, with storage split across shard processes
+        so writes aren't all serialized behind one GIL.
+
+        This process is a router: it validates requests, picks each formula's shard from its digest
+        with a ConsistentHashRing, and forwards it (see ShardClient). A list submission is split by
+        shard and sent to all of its shards at once; if any shard fails, the shards that succeeded
+        are rolled back so the request stays all-or-nothing.
+
+        - num_shards: starts that many shard processes (default: one per core), each configured with
+          `queue_options`, `database_options` and `group_commit_window` (file paths get a per-shard suffix).
+        - addresses: connects to shards already running (`python -m OsmoCaseStudy.sharding`) instead, so
+          several router processes can share them and the routing work scales with cores too. Needs `authkey`.
+        Idempotency keys are kept by the shards, so every router sees every key.
+        """
+        super().__init__()
+        if addresses:
+            if authkey is None:
+                raise ValueError("Connecting to shards by address needs an authkey")
+            self._clients = [ShardClient(Client(address, authkey=authkey)) for address in addresses]
+            self._processes = []
+        else:
+            context = multiprocessing.get_context(start_method)
+            self._clients = []
+            self._processes = []
+            for shard in range(num_shards or os.cpu_count() or 1):
+                router_end, worker_end = context.Pipe()
+                process = context.Process(target=shard_main,
+                                          args=(worker_end, shard, queue_options, database_options, group_commit_window),
+                                          name=f"formula-shard-{shard}", daemon=True)
+                process.start()
+                worker_end.close()
+                self._clients.append(ShardClient(router_end))
+                self._processes.append(process)
+        self.num_shards = len(self._clients)
+        self.ring = ConsistentHashRing(self.num_shards, vnodes)
+
+    def setup_storage(self, db, queue, group_commit_window, group_commit_max_batch):
+        # storage lives in the shards
+        self.db = self.q = self.group_committer = None
+
+    def idempotency_lookup(self, key, fingerprint):
+        return self._call(self._shard_for_key(key), "idempotency_lookup", key, fingerprint)
+
+    def idempotency_store(self, key, fingerprint, response):
+        self._call(self._shard_for_key(key), "idempotency_store", key, fingerprint, response)
+
+    def commit(self, formulas, **publish_options):
+        if isinstance(formulas, FragranceFormula):
+            formulas = [formulas]
+        by_shard = {}
+        for formula in formulas:
+            by_shard.setdefault(self.ring.shard_for(hash(formula)), []).append(formula)
+
+        replies = self._call_many({shard: ("submit", shard_formulas, publish_options)
+                                   for shard, shard_formulas in by_shard.items()})
+        errors = [reply for status, reply in replies.values() if status == "error"]
+        if errors:
+            succeeded = [shard for shard, (status, reply) in replies.items() if status == "ok"]
+            if succeeded:
+                self._call_many({shard: ("rollback", by_shard[shard]) for shard in succeeded})
+            raise errors[0]
+        return None
+
+    def update(self, id, deltas, **publish_options):
+        """
+        An update usually moves the formula to another shard, since its digest changes.
+        Same shard: the shard updates it in place. Otherwise, like FragranceServer.update across two stores:
+        - the new shard stores the updated formula (with its duplicate check),
+        - the old shard releases the previous version (NotFound if it has changed since it was read),
+          handing back its FormulaCreatedEvent if no consumer has fetched it yet,
+        - the new shard announces the formula: that created event, rekeyed, or else an update event.
+        A failing step undoes the ones before it.
+        """
+        shard = self.ring.shard_for(id)
+        previous = self._call(shard, "get", id)
+        if previous is None:
+            raise NotFound(f"No formula with id {id}")
+        try:
+            updated = previous.with_deltas(deltas)
+        except ValueError as e:
+            raise BadRequest(str(e))
+
+        new_shard = self.ring.shard_for(hash(updated))
+        if new_shard == shard:
+            return self._call(shard, "update", id, deltas, publish_options)
+
+        self._call(new_shard, "adopt", updated)
+        try:
+            waiting = self._call(shard, "release", previous)
+        except Exception:
+            self._call(new_shard, "rollback", [updated])
+            raise
+        try:
+            self._call(new_shard, "announce", updated, id, deltas, waiting, publish_options)
+        except Exception:
+            self._call(new_shard, "rollback", [updated])
+            self._call(shard, "restore", previous, waiting)
+            raise
+        return previous, updated
+
+    def export(self, cursor=None, fields=None):
+        # a consistent export would need a snapshot held open in every shard for the whole stream
+        raise HTTPNotImplemented("Export is not supported with sharded storage yet")
+
+    def shard_stats(self):
+        replies = self._call_many({shard: ("stats",) for shard in range(self.num_shards)})
+        return [replies[shard][1] for shard in range(self.num_shards)]
+
+    def shutdown(self):
+        # stops the shard processes this router started; shards it connected to by address keep running
+        for client in self._clients:
+            if self._processes:
+                try:
+                    client.request("stop").result(timeout=10)
+                except Exception:
+                    pass
+            client.close()
+        for process in self._processes:
+            process.join()
+
+    def _shard_for_key(self, key):
+        return self.ring.shard_for(int.from_bytes(blake2b(key.encode(), digest_size=8).digest(), "big"))
+
+    def _call(self, shard, op, *args):
+        # one shard, one request: returns its result or raises its error
+        return self._clients[shard].request(op, *args).result()
+
+    def _call_many(self, requests):
+        """
+        Sends each shard its request (op, *args), then collects the replies as (status, result),
+        so the shards work in parallel.
+        """
+        futures = {shard: self._clients[shard].request(*request) for shard, request in requests.items()}
+        replies = {}
+        for shard, future in futures.items():
+            try:
+                replies[shard] = ("ok", future.result())
+            except Exception as e:
+                replies[shard] = ("error", e)
+        return replies
+
+def main(argv=None):
+    """
+    Runs one shard as a standalone server for routers started with FORMULA_SHARD_ADDRESSES, e.g.
+    FORMULA_SHARD_AUTHKEY=secret python -m OsmoCaseStudy.sharding --shard 0 --address 127.0.0.1:7000
+    Queue, database and group commit settings are read from the same environment variables as the app.
+    """
+    parser = argparse.ArgumentParser(description="Run one formula storage shard")
+    parser.add_argument("--shard", type=int, required=True, help="this shard's index in FORMULA_SHARD_ADDRESSES")
+    parser.add_argument("--address", required=True, help="host:port to listen on")
+    args = parser.parse_args(argv)
+
+    authkey = shard_authkey_from_env()
+    if authkey is None:
+        parser.error("FORMULA_SHARD_AUTHKEY must be set")
+    shard = Shard(args.shard, queue_options_from_env(), database_options_from_env(), group_commit_window_from_env())
+    listener = Listener(parse_addresses(args.address)[0], authkey=authkey)
+    try:
+        shard.serve_forever(listener)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        shard.close()
+
+if __name__ == "__main__":
+    main()
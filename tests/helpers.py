@@ -0,0 +1,8 @@
+from decimal import Decimal
+
+from OsmoCaseStudy.models.material import Material
+from OsmoCaseStudy.models.fragrance_formula import FragranceFormula
+
+def make_formulas(count, material="Amber"):
+    # distinct formulas, for tests that need more than the conftest fixtures
+    return [FragranceFormula(f"Formula {i}", (Material(material, Decimal(i + 1)),)) for i in range(count)]
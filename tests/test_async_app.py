@@ -0,0 +1,214 @@
+import asyncio
+import json
+import pytest
+import threading
+from OsmoCaseStudy.async_app import AsyncFragranceDatabase, AsyncFormulaCreatedQueue, AsyncFragranceServer
+from OsmoCaseStudy.queue import FormulaCreatedQueue, PRIORITY_HIGH
+from OsmoCaseStudy.tests.helpers import make_formulas
+
+class SlowDatabase(AsyncFragranceDatabase):
+    # stands in for a store behind a network: every call waits `latency` seconds without holding a thread
+    def __init__(self, latency):
+        super().__init__()
+        self.latency = latency
+        self.calls = 0
+
+    async def _round_trip(self):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+
+async def post(server, payload, headers=None, method="POST", path="/formulas"):
+    # drives the ASGI app directly, the way an ASGI server would
+    body = json.dumps(payload).encode()
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "headers": [(key.lower().encode(), value.encode()) for key, value in (headers or {}).items()],
+    }
+    messages = [{"type": "http.request", "body": body[:5], "more_body": True},
+                {"type": "http.request", "body": body[5:], "more_body": False}]
+    async def receive():
+        return messages.pop(0)
+
+    sent = []
+    async def send(message):
+        sent.append(message)
+
+    await server(scope, receive, send)
+    start, body = sent
+    return start["status"], dict(start["headers"]), json.loads(body["body"])
+
+def test_submit_formula_valid(summer_breeze):
+    server = AsyncFragranceServer()
+    status, headers, body = asyncio.run(post(server, summer_breeze.to_dict(), {"Idempotency-Key": "abc"}))
+
+    assert status == 200
+    assert body["message"] == "Formula(s) added!"
+    assert body["ids"] == [hash(summer_breeze)]
+    assert server.db.db.size() == 1
+    assert server.q.queue.size() == 1
+
+def test_same_idempotency_key_returns_cached_response(summer_breeze, winter_breeze):
+    server = AsyncFragranceServer()
+    async def run():
+        first = await post(server, summer_breeze.to_dict(), {"Idempotency-Key": "abc"})
+        retry = await post(server, summer_breeze.to_dict(), {"Idempotency-Key": "abc"})
+        other = await post(server, winter_breeze.to_dict(), {"Idempotency-Key": "abc"})
+        return first, retry, other
+    first, retry, other = asyncio.run(run())
+
+    assert first[0] == retry[0] == 200
+    assert retry[2] == first[2]
+    assert other[0] == 422 # the key was used for a different formula
+    assert server.db.db.size() == 1 # neither later request was processed
+
+def test_duplicate_formula_conflict(winter_breeze, winter_breeze_dupe):
+    server = AsyncFragranceServer()
+    async def run():
+        await post(server, winter_breeze.to_dict(), {"Idempotency-Key": "1"})
+        return await post(server, winter_breeze_dupe.to_dict(), {"Idempotency-Key": "2"})
+    status, headers, body = asyncio.run(run())
+
+    assert status == 409
+    assert body["error"] == "Conflict"
+
+def test_invalid_requests(summer_breeze):
+    server = AsyncFragranceServer()
+    async def run():
+        return [
+            await post(server, summer_breeze.to_dict()),
+            await post(server, {"name": "No materials"}, {"Idempotency-Key": "1"}),
+            await post(server, summer_breeze.to_dict(), {"Idempotency-Key": "2", "X-Priority": "urgent"}),
+            await post(server, summer_breeze.to_dict(), {"Idempotency-Key": "3"}, method="GET"),
+            await post(server, summer_breeze.to_dict(), {"Idempotency-Key": "4"}, path="/other"),
+        ]
+    statuses = [status for status, headers, body in asyncio.run(run())]
+
+    assert statuses == [400, 400, 400, 405, 404]
+    assert server.idempotency_cache == {} # bad requests don't claim their key
+
+def test_publish_options_from_headers(summer_breeze):
+    server = AsyncFragranceServer()
+    headers = {"Idempotency-Key": "abc", "X-Tenant-Id": "acme", "X-Priority": "high"}
+    asyncio.run(post(server, summer_breeze.to_dict(), headers))
+
+    event = server.q.queue.get_next_item()
+    assert event.tenant == "acme"
+    assert event.priority == PRIORITY_HIGH
+
+def test_saturated_queue_is_not_cached(summer_breeze):
+    queue = AsyncFormulaCreatedQueue(FormulaCreatedQueue(max_depth=0))
+    server = AsyncFragranceServer(queue=queue)
+    status, headers, body = asyncio.run(post(server, summer_breeze.to_dict(), {"Idempotency-Key": "abc"}))
+
+    assert status == 429
+    assert "retry-after" in {key.decode() for key in headers}
+    assert server.db.db.size() == 0 # rolled back
+    assert "abc" not in server.idempotency_cache
+
+def test_concurrent_slow_submissions_overlap():
+    # 500 submissions, each waiting on two 50ms round trips - done one at a time this would take 50s
+    server = AsyncFragranceServer(db=SlowDatabase(latency=0.05))
+    payloads = [formula.to_dict() for formula in make_formulas(500)]
+    async def run():
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        results = await asyncio.gather(*(post(server, payload, {"Idempotency-Key": str(i)})
+                                         for i, payload in enumerate(payloads)))
+        return results, loop.time() - start
+    results, elapsed = asyncio.run(run())
+
+    assert all(status == 200 for status, headers, body in results)
+    assert server.db.db.size() == 500
+    assert elapsed < 5
+
+def test_concurrent_same_key_waits_for_first(summer_breeze):
+    server = AsyncFragranceServer(db=SlowDatabase(latency=0.05))
+    async def run():
+        return await asyncio.gather(*(post(server, summer_breeze.to_dict(), {"Idempotency-Key": "abc"}) for _ in range(10)))
+    results = asyncio.run(run())
+
+    assert all(status == 200 for status, headers, body in results) # no Conflict from processing the retries again
+    assert server.db.calls == 1
+    assert server.db.db.size() == 1
+
+def test_cancelled_first_request_releases_key_to_waiting_retry(summer_breeze):
+    server = AsyncFragranceServer(db=SlowDatabase(latency=0.05))
+    headers = {"Idempotency-Key": "abc"}
+    async def run():
+        first = asyncio.create_task(post(server, summer_breeze.to_dict(), headers))
+        await asyncio.sleep(0.01) # first is waiting on the store
+        retry = asyncio.create_task(post(server, summer_breeze.to_dict(), headers))
+        await asyncio.sleep(0.01) # retry is waiting on first
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await retry
+    status, headers, body = asyncio.run(run())
+
+    assert status == 200 # processed by the retry itself
+    assert server.db.db.size() == 1
+
+def test_cancelled_after_store_is_rolled_back(summer_breeze):
+    class SlowQueue(AsyncFormulaCreatedQueue):
+        async def _round_trip(self):
+            await asyncio.sleep(0.05)
+
+    server = AsyncFragranceServer(queue=SlowQueue())
+    async def run():
+        first = asyncio.create_task(post(server, summer_breeze.to_dict(), {"Idempotency-Key": "abc"}))
+        await asyncio.sleep(0.01) # stored, waiting on the queue
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+    asyncio.run(run())
+
+    assert server.db.db.size() == 0
+    assert server.q.queue.size() == 0
+    assert server.idempotency_cache == {}
+
+def test_blocking_calls_run_off_the_event_loop(summer_breeze, tmp_path):
+    queue = FormulaCreatedQueue(max_depth=0, overflow_path=str(tmp_path / "overflow.jsonl")) # every event is written to disk
+    server = AsyncFragranceServer(queue=AsyncFormulaCreatedQueue(queue))
+    threads = []
+    append = queue._overflow.append
+    queue._overflow.append = lambda events: threads.append(threading.get_ident()) or append(events)
+    status, headers, body = asyncio.run(post(server, summer_breeze.to_dict(), {"Idempotency-Key": "abc"}))
+
+    assert status == 200
+    assert threads and threading.get_ident() not in threads # the loop ran in this thread
+
+def test_publish_with_retry_backs_off_with_asyncio_sleep(summer_breeze, monkeypatch):
+    class FlakyQueue(AsyncFormulaCreatedQueue):
+        failures = 2
+        async def publish(self, formulas, **publish_options):
+            if self.failures:
+                self.failures -= 1
+                raise RuntimeError("queue unavailable")
+            await super().publish(formulas, **publish_options)
+
+    delays = []
+    async def fake_sleep(delay):
+        delays.append(delay)
+    monkeypatch.setattr(asyncio, "sleep", fake_sleep)
+
+    server = AsyncFragranceServer()
+    db, queue = AsyncFragranceDatabase(), FlakyQueue()
+    asyncio.run(server.publish_with_retry([summer_breeze], db, queue))
+
+    assert delays == [1.0, 2.0]
+    assert db.db.size() == 1
+    assert queue.queue.size() == 1
+
+def test_lifespan():
+    server = AsyncFragranceServer()
+    messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+    sent = []
+    async def receive():
+        return messages.pop(0)
+    async def send(message):
+        sent.append(message)
+    asyncio.run(server({"type": "lifespan"}, receive, send))
+
+    assert [message["type"] for message in sent] == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
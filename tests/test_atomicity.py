@@ -1,5 +1,6 @@
 import pytest
 from unittest.mock import MagicMock, patch
+from werkzeug.exceptions import TooManyRequests
 from OsmoCaseStudy.app import FragranceServer
 from OsmoCaseStudy.queue import FormulaCreatedQueue
 from OsmoCaseStudy.database import FragranceDatabase
@@ -92,4 +93,19 @@ def test_publish_all_retries_fail(mock_sleep, summer_breeze, winter_breeze, anot
     mock_sleep.assert_any_call(2.0)
 
     assert q.is_empty()
-    assert db.is_empty()
\ No newline at end of file
+    assert db.is_empty()
+
+@patch("time.sleep", return_value=None)
+def test_publish_queue_saturated_no_retry(mock_sleep, summer_breeze, winter_breeze):
+    server = FragranceServer()
+    db = FragranceDatabase()
+    q = FormulaCreatedQueue(max_depth=1)
+    formulas = [summer_breeze, winter_breeze]
+
+    with pytest.raises(TooManyRequests):
+        server.publish_with_retry(formulas, db, q)
+
+    # rolled back once, and no backoff retries against a saturated queue
+    mock_sleep.assert_not_called()
+    assert db.is_empty()
+    assert q.is_empty()
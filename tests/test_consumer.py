@@ -0,0 +1,81 @@
+import time
+from threading import Event
+from OsmoCaseStudy.consumer import FormulaCreatedConsumer
+from OsmoCaseStudy.queue import FormulaCreatedQueue
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+def test_consumer_processes_and_acks(summer_breeze, winter_breeze, another_summer_breeze):
+    q = FormulaCreatedQueue()
+    q.publish([summer_breeze, winter_breeze, another_summer_breeze])
+    handled = []
+
+    with FormulaCreatedConsumer(q, handled.append, max_workers=2, poll_interval=0.01):
+        assert wait_for(lambda: len(handled) == 3)
+        assert wait_for(lambda: len(q._in_process) == 0)
+
+    assert q.is_empty()
+    assert {event.name for event in handled} == {"Summer Breeze", "Winter Breeze"}
+
+def test_consumer_heartbeats_long_jobs(summer_breeze):
+    # the job outlives process_timeout but is never redelivered because the lease is extended
+    q = FormulaCreatedQueue(process_timeout=0.1)
+    q.publish(summer_breeze)
+    calls = []
+
+    def slow_handler(event):
+        calls.append(event.id)
+        time.sleep(0.4)
+
+    consumer = FormulaCreatedConsumer(q, slow_handler, max_workers=2, heartbeat_interval=0.02, poll_interval=0.01).start()
+    assert wait_for(lambda: len(calls) == 1)
+    time.sleep(0.3)
+    assert q.get_next_item() is None # still leased
+    consumer.stop()
+
+    assert len(calls) == 1
+    assert len(q._in_process) == 0
+
+def test_consumer_nacks_failures_with_delay(summer_breeze):
+    q = FormulaCreatedQueue()
+    q.publish(summer_breeze)
+
+    def failing_handler(event):
+        raise RuntimeError("downstream unavailable")
+
+    with FormulaCreatedConsumer(q, failing_handler, poll_interval=0.01, retry_delay=60):
+        assert wait_for(lambda: len(q._delayed) == 1)
+    assert len(q._in_process) == 0
+
+def test_consumer_bounded_concurrency(summer_breeze, winter_breeze, another_summer_breeze):
+    q = FormulaCreatedQueue()
+    q.publish([summer_breeze, winter_breeze, another_summer_breeze])
+    release = Event()
+
+    consumer = FormulaCreatedConsumer(q, lambda event: release.wait(), max_workers=2, poll_interval=0.01).start()
+    assert wait_for(lambda: consumer.in_flight() == 2)
+    time.sleep(0.05)
+    assert consumer.in_flight() == 2
+    assert q.size() == 1 # the third event is left for other consumers
+    release.set()
+    consumer.stop()
+    assert q.is_empty() and len(q._in_process) == 0
+
+def test_consumer_stop_without_drain_returns_events(summer_breeze):
+    q = FormulaCreatedQueue()
+    q.publish(summer_breeze)
+    release = Event()
+
+    consumer = FormulaCreatedConsumer(q, lambda event: release.wait(), poll_interval=0.01).start()
+    assert wait_for(lambda: consumer.in_flight() == 1)
+    consumer.stop(drain=False)
+    release.set()
+
+    assert len(q._in_process) == 0
+    assert q.get_next_item().name == "Summer Breeze"
@@ -1,10 +1,11 @@
 import pytest
-from werkzeug.exceptions import Conflict
+from werkzeug.exceptions import Conflict, NotFound
 from decimal import Decimal
 
 from OsmoCaseStudy.database import FragranceDatabase
 from OsmoCaseStudy.models.material import Material
 from OsmoCaseStudy.models.fragrance_formula import FragranceFormula
+from OsmoCaseStudy.tests.helpers import make_formulas
 
 def test_add_formula_success(summer_breeze):
     db = FragranceDatabase()
@@ -45,3 +46,55 @@ def test_remove_formulas(summer_breeze, winter_breeze):
     db.add_formulas([summer_breeze, winter_breeze])
     db.remove_formulas([summer_breeze, winter_breeze])
     assert db.is_empty()
+
+def test_update_formula_rekeys(summer_breeze):
+    db = FragranceDatabase()
+    db.add_formulas(summer_breeze)
+    previous, updated = db.update_formula(hash(summer_breeze), {"Sandalwood": Decimal("1")})
+
+    assert previous is summer_breeze
+    assert db.get(hash(summer_breeze)) is None
+    assert db.get(hash(updated)) is updated
+    assert db.size() == 1
+
+def test_update_formula_collision(summer_breeze, bergamot_oil, lavender_absolute):
+    db = FragranceDatabase()
+    target = FragranceFormula("Stronger Breeze", (bergamot_oil, lavender_absolute, Material("Sandalwood", Decimal("6.2"))))
+    db.add_formulas([summer_breeze, target])
+
+    with pytest.raises(Conflict):
+        db.update_formula(hash(summer_breeze), {"Sandalwood": Decimal("1")})
+    assert db.get(hash(summer_breeze)) is summer_breeze # nothing changed
+
+def test_update_formula_missing(summer_breeze):
+    with pytest.raises(NotFound):
+        FragranceDatabase().update_formula(hash(summer_breeze), {"Sandalwood": Decimal("1")})
+
+def test_snapshot_ignores_later_writes(summer_breeze, winter_breeze, another_summer_breeze):
+    db = FragranceDatabase()
+    db.add_formulas([summer_breeze, winter_breeze])
+    snapshot = db.snapshot()
+
+    db.add_formulas(another_summer_breeze)
+    db.remove_formulas(summer_breeze)
+
+    assert [entry.formula for entry in snapshot.entries()] == [summer_breeze, winter_breeze]
+    assert [entry.formula for entry in db.snapshot().entries()] == [winter_breeze, another_summer_breeze]
+
+def test_snapshot_resumes_after_cursor(summer_breeze, winter_breeze, another_summer_breeze):
+    db = FragranceDatabase()
+    db.add_formulas([summer_breeze, winter_breeze, another_summer_breeze])
+    first = next(db.snapshot().entries())
+    assert [entry.formula for entry in db.snapshot().entries(after_seq=first.seq)] == [winter_breeze, another_summer_breeze]
+
+def test_snapshot_survives_compaction():
+    db = FragranceDatabase()
+    formulas = make_formulas(3000)
+    db.add_formulas(formulas)
+    snapshot = db.snapshot()
+
+    db.remove_formulas(formulas[:2000]) # enough removals to compact the entry log
+    assert len(db._entries) < 3000
+
+    assert sum(1 for entry in snapshot.entries()) == 3000
+    assert sum(1 for entry in db.snapshot().entries()) == 1000
@@ -0,0 +1,60 @@
+import pytest
+from werkzeug.exceptions import Conflict
+from OsmoCaseStudy.database import FragranceDatabase
+from OsmoCaseStudy.duplicate_filter import DuplicateFilter, id_fingerprint
+from OsmoCaseStudy.models.fragrance_formula import FragranceFormula
+from OsmoCaseStudy.bench_duplicate_filter import LatencyDatabase
+
+def test_new_formulas_skip_store_lookup(summer_breeze, winter_breeze):
+    db = LatencyDatabase(latency=0, duplicate_filter=DuplicateFilter(capacity=100))
+    db.add_formulas([summer_breeze, winter_breeze])
+    assert db.round_trips == 0
+    assert db._duplicate_filter.stats()["skipped_store_lookups"] == 2
+
+def test_duplicates_confirmed_against_store(summer_breeze, winter_breeze, winter_breeze_dupe):
+    db = LatencyDatabase(latency=0, duplicate_filter=DuplicateFilter(capacity=100))
+    db.add_formulas([summer_breeze, winter_breeze])
+    with pytest.raises(Conflict):
+        db.add_formulas(winter_breeze_dupe)
+    assert db.round_trips == 1
+    assert db._duplicate_filter.confirmed == 1
+
+def test_removed_formula_is_false_positive_not_duplicate(summer_breeze):
+    db = FragranceDatabase(duplicate_filter=DuplicateFilter(capacity=100))
+    db.add_formulas(summer_breeze)
+    db.remove_formulas(summer_breeze) # the filter can't forget it
+    db.add_formulas(summer_breeze) # confirmed against the store - still accepted
+    assert db._duplicate_filter.false_positives == 1
+
+def test_needs_rebuild_when_over_capacity():
+    duplicate_filter = DuplicateFilter(capacity=2)
+    for id in range(3):
+        duplicate_filter.add(id)
+    assert duplicate_filter.needs_rebuild()
+    duplicate_filter.rebuild(range(3))
+    assert not duplicate_filter.needs_rebuild()
+    assert all(duplicate_filter.is_duplicate(id, lambda id: True) for id in range(3))
+
+def test_filter_persisted_and_loaded(tmp_path, summer_breeze, winter_breeze):
+    path = str(tmp_path / "formulas.bloom")
+    db = FragranceDatabase(duplicate_filter=DuplicateFilter(capacity=100, path=path))
+    db.add_formulas([summer_breeze, winter_breeze])
+    db.save_duplicate_filter()
+
+    loaded = DuplicateFilter(path=path)
+    assert loaded.sync([hash(summer_breeze), hash(winter_breeze)], store_size=2) == "loaded"
+    assert hash(summer_breeze) in loaded._bloom
+    # saved for a different store - can't be trusted, so it's rebuilt from the store's ids
+    assert DuplicateFilter(path=path).sync([hash(summer_breeze)], store_size=1) == "rebuilt"
+
+def test_filter_for_different_contents_is_rebuilt(tmp_path, summer_breeze, winter_breeze, amber):
+    path = str(tmp_path / "formulas.bloom")
+    db = FragranceDatabase(duplicate_filter=DuplicateFilter(capacity=100, path=path))
+    db.add_formulas([summer_breeze, winter_breeze])
+    db.save_duplicate_filter()
+    db.remove_formula(winter_breeze)
+    db.add_formula(FragranceFormula("Amber only", (amber,)))
+
+    assert db.fingerprint() == id_fingerprint(db.ids())
+    # same size as when saved, different formulas
+    assert DuplicateFilter(path=path).sync(db.ids(), db.size(), db.fingerprint()) == "rebuilt"
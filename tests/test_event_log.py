@@ -0,0 +1,126 @@
+import pytest
+import time
+from decimal import Decimal
+from werkzeug.exceptions import InternalServerError
+from OsmoCaseStudy.app import FragranceServer
+from OsmoCaseStudy.consumer import FormulaCreatedConsumer
+from OsmoCaseStudy.event_log import FormulaEventLog
+
+def test_publish_assigns_offsets(summer_breeze, winter_breeze):
+    log = FormulaEventLog()
+    assert log.publish_one(summer_breeze) == 0
+    assert log.publish_one(winter_breeze) == 1
+    assert log.size() == 2
+    with pytest.raises(InternalServerError):
+        log.publish(summer_breeze)
+
+def test_groups_read_independently(summer_breeze, winter_breeze):
+    log = FormulaEventLog()
+    log.publish([summer_breeze, winter_breeze])
+    search = log.group("search")
+    billing = log.group("billing")
+
+    assert search.get_next_item().name == "Summer Breeze"
+    assert search.get_next_item().name == "Winter Breeze"
+    assert search.get_next_item() is None
+    # billing still sees everything
+    assert billing.get_next_item().name == "Summer Breeze"
+
+def test_retention_waits_for_every_group(summer_breeze, winter_breeze):
+    log = FormulaEventLog()
+    search = log.group("search")
+    billing = log.group("billing")
+    log.publish([summer_breeze, winter_breeze])
+
+    for event in iter(search.get_next_item, None):
+        search.ack(event.id)
+    assert search.lag() == 0
+    assert log.size() == 2 # billing hasn't acked yet
+
+    event = billing.get_next_item()
+    billing.ack(event.id)
+    assert log.size() == 1
+    assert billing.lag() == 1
+
+def test_out_of_order_acks_commit_contiguously(summer_breeze, winter_breeze, another_summer_breeze):
+    log = FormulaEventLog()
+    qa = log.group("qa")
+    log.publish([summer_breeze, winter_breeze, another_summer_breeze])
+    first, second, third = qa.get_next_item(), qa.get_next_item(), qa.get_next_item()
+
+    qa.ack(third.id)
+    qa.ack(second.id)
+    assert qa.committed == 0
+    qa.ack(first.id)
+    assert qa.committed == 3
+    assert log.is_empty()
+
+def test_expired_lease_redelivered_to_same_group(summer_breeze, winter_breeze):
+    log = FormulaEventLog()
+    qa = log.group("qa")
+    log.publish([summer_breeze, winter_breeze])
+    event = qa.get_next_item()
+    qa._in_process[event.offset] = (event.id, 35) # long expired
+
+    assert qa.get_next_item().name == "Summer Breeze"
+
+def test_latest_group_skips_history(summer_breeze, winter_breeze):
+    log = FormulaEventLog()
+    log.publish(summer_breeze)
+    billing = log.group("billing", start="latest")
+    log.publish(winter_breeze)
+    assert billing.get_next_item().name == "Winter Breeze"
+    assert billing.get_next_item() is None
+
+def test_rolled_back_event_is_skipped(summer_breeze, winter_breeze):
+    log = FormulaEventLog()
+    qa = log.group("qa")
+    log.publish([summer_breeze, winter_breeze])
+    log.remove(summer_breeze)
+    assert not log.already_processed(summer_breeze)
+
+    event = qa.get_next_item()
+    assert event.name == "Winter Breeze"
+    qa.ack(event.id)
+    assert log.is_empty()
+
+def test_server_publishes_to_log(summer_breeze):
+    log = FormulaEventLog()
+    search = log.group("search")
+    billing = log.group("billing")
+    server = FragranceServer(queue=log)
+    client = server.app.test_client()
+
+    response = client.post("/formulas", json=summer_breeze.to_dict(), headers={"Idempotency-Key": "key-1"})
+    assert response.status_code == 200
+    assert search.get_next_item().id == billing.get_next_item().id == hash(summer_breeze)
+
+def test_consumer_runs_against_group(summer_breeze, winter_breeze):
+    log = FormulaEventLog()
+    indexed = []
+    log.publish([summer_breeze, winter_breeze])
+
+    with FormulaCreatedConsumer(log.group("search"), indexed.append, poll_interval=0.01):
+        deadline = time.time() + 5
+        while log.group("search").lag() and time.time() < deadline:
+            time.sleep(0.01)
+    assert len(indexed) == 2
+    assert log.group("search").lag() == 0
+
+def test_same_id_leased_twice(summer_breeze):
+    # A -> B -> A: the log holds the same id at two offsets
+    log = FormulaEventLog()
+    qa = log.group("qa")
+    log.publish(summer_breeze)
+    deltas = {"Sandalwood": Decimal("1")}
+    updated = summer_breeze.with_deltas(deltas)
+    log.publish_update(updated, hash(summer_breeze), deltas)
+    log.publish_update(updated.with_deltas({"Sandalwood": Decimal("-1")}), hash(updated), {"Sandalwood": Decimal("-1")})
+
+    first, middle, last = qa.get_next_item(), qa.get_next_item(), qa.get_next_item()
+    assert first.id == last.id
+    assert qa.ack(last.id, offset=last.offset)
+    assert qa.ack(middle.id)
+    assert qa.ack(first.id)
+    assert qa.committed == 3
+    assert log.is_empty()
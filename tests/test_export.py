@@ -0,0 +1,69 @@
+import gzip
+import json
+import pytest
+from decimal import Decimal
+from OsmoCaseStudy.app import FragranceServer
+from OsmoCaseStudy.models.fragrance_formula import FragranceFormula
+from OsmoCaseStudy.models.material import Material
+from OsmoCaseStudy.tests.helpers import make_formulas
+
+@pytest.fixture
+def server():
+    server = FragranceServer()
+    server.db.add_formulas(make_formulas(500))
+    return server
+
+@pytest.fixture
+def client(server):
+    with server.app.test_client() as client:
+        yield client
+
+def read_ndjson(body):
+    return [json.loads(line) for line in body.decode().splitlines()]
+
+def test_export_all(client):
+    response = client.get("/formulas/export")
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    assert response.is_streamed
+
+    records = read_ndjson(response.data)
+    assert len(records) == 500
+    assert records[0]["name"] == "Formula 0"
+    assert records[0]["materials"] == [{"name": "Amber", "concentration": 1.0}]
+    assert records[0]["id"] == hash(make_formulas(1)[0])
+
+def test_export_gzip(client):
+    response = client.get("/formulas/export", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert len(read_ndjson(gzip.decompress(response.data))) == 500
+
+def test_export_gzip_refused_by_quality(client):
+    response = client.get("/formulas/export", headers={"Accept-Encoding": "gzip;q=0, identity"})
+    assert "Content-Encoding" not in response.headers
+    assert len(read_ndjson(response.data)) == 500
+
+def test_export_fields_projection(client):
+    records = read_ndjson(client.get("/formulas/export?fields=name").data)
+    assert set(records[0]) == {"cursor", "name"}
+
+def test_export_resume_from_cursor(client):
+    records = read_ndjson(client.get("/formulas/export").data)
+    resumed = read_ndjson(client.get(f"/formulas/export?cursor={records[99]['cursor']}").data)
+    assert resumed == records[100:]
+
+def test_export_is_a_snapshot(server):
+    stream = server.encode_export(server.export(), chunk_size=1024)
+    first_chunk = next(stream)
+
+    # writes after the export started don't change what it returns
+    server.db.remove_formulas(make_formulas(500)[-1])
+    server.db.add_formulas(FragranceFormula("Late", (Material("Musk", Decimal("1")),)))
+
+    records = read_ndjson(first_chunk + b"".join(stream))
+    assert len(records) == 500
+    assert records[-1]["name"] == "Formula 499"
+
+def test_export_invalid_options(client):
+    assert client.get("/formulas/export?fields=name,secret").status_code == 400
+    assert client.get("/formulas/export?cursor=abc").status_code == 400
@@ -0,0 +1,116 @@
+import pytest
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.exceptions import Conflict, TooManyRequests
+from OsmoCaseStudy.app import FragranceServer
+from OsmoCaseStudy.database import FragranceDatabase
+from OsmoCaseStudy.group_commit import GroupCommitter
+from OsmoCaseStudy.queue import FormulaCreatedQueue, PRIORITY_HIGH
+from OsmoCaseStudy.tests.helpers import make_formulas
+
+def submit_concurrently(committer, submissions):
+    def submit(formulas):
+        try:
+            return committer.submit(formulas)
+        except Exception as e:
+            return e
+    with ThreadPoolExecutor(max_workers=len(submissions)) as pool:
+        return list(pool.map(submit, submissions))
+
+class BatchCountingDatabase(FragranceDatabase):
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+        self.lookups = 0
+
+    def add_batch(self, submissions):
+        self.batches.append(len(submissions))
+        return super().add_batch(submissions)
+
+    def exists(self, id):
+        self.lookups += 1
+        return super().exists(id)
+
+def test_concurrent_submissions_share_commits():
+    server = FragranceServer()
+    db, q = BatchCountingDatabase(), FormulaCreatedQueue()
+
+    committer = GroupCommitter(server.publish_with_retry, db, q, window=0.05, max_batch=100)
+    results = submit_concurrently(committer, [[formula] for formula in make_formulas(50)])
+    committer.close()
+
+    assert results == [None] * 50
+    assert db.size() == 50 and q.size() == 50
+    assert sum(db.batches) == 50
+    assert len(db.batches) < 50
+
+def test_one_duplicate_check_per_formula():
+    server = FragranceServer()
+    db, q = BatchCountingDatabase(), FormulaCreatedQueue()
+    committer = GroupCommitter(server.publish_with_retry, db, q, window=0)
+    committer.submit(make_formulas(4))
+    committer.close()
+
+    assert db.lookups == 4
+
+def test_saturated_batch_admits_each_submission():
+    # the two submissions don't fit in the queue together, but each fits on its own
+    server = FragranceServer()
+    db, q = FragranceDatabase(), FormulaCreatedQueue(max_depth=3)
+    fallback_threads = []
+    def commit(formulas, db, queue, **publish_options):
+        fallback_threads.append(threading.current_thread().name)
+        return server.publish_with_retry(formulas, db, queue, **publish_options)
+
+    committer = GroupCommitter(commit, db, q, window=0.05)
+    formulas = make_formulas(4)
+    results = submit_concurrently(committer, [formulas[:2], formulas[2:]])
+    committer.close()
+
+    assert sorted(isinstance(result, TooManyRequests) for result in results) == [False, True]
+    assert db.size() == 2 and q.size() == 2
+    assert len(fallback_threads) == 2 and "formula-group-commit" not in fallback_threads # run in the submitters' threads
+
+def test_conflicts_reported_per_submission(summer_breeze, winter_breeze, winter_breeze_dupe):
+    server = FragranceServer()
+    db, q = FragranceDatabase(), FormulaCreatedQueue()
+    db.add_formulas(summer_breeze)
+    committer = GroupCommitter(server.publish_with_retry, db, q, window=0.05)
+
+    results = submit_concurrently(committer, [[summer_breeze], [winter_breeze], [winter_breeze_dupe]])
+    committer.close()
+
+    assert isinstance(results[0], Conflict) # already in the store
+    # winter_breeze and its dupe race within the batch - exactly one wins
+    assert sorted(isinstance(result, Conflict) for result in results[1:]) == [False, True]
+    assert db.size() == 2 and q.size() == 1
+
+def test_list_submission_is_all_or_nothing(summer_breeze, winter_breeze, winter_breeze_dupe):
+    server = FragranceServer()
+    db, q = FragranceDatabase(), FormulaCreatedQueue()
+    committer = GroupCommitter(server.publish_with_retry, db, q, window=0)
+
+    with pytest.raises(Conflict):
+        committer.submit([summer_breeze, winter_breeze, winter_breeze_dupe])
+    committer.close()
+    assert db.is_empty() and q.is_empty()
+
+def test_batch_keeps_each_submissions_priority(summer_breeze, winter_breeze):
+    server = FragranceServer()
+    db, q = FragranceDatabase(), FormulaCreatedQueue()
+    committer = GroupCommitter(server.publish_with_retry, db, q, window=0)
+    committer.submit(summer_breeze)
+    committer.submit(winter_breeze, tenant="perfumer", priority=PRIORITY_HIGH)
+    committer.close()
+
+    event = q.get_next_item()
+    assert event.name == "Winter Breeze" and event.tenant == "perfumer"
+
+def test_server_with_group_commit(summer_breeze):
+    server = FragranceServer(group_commit_window=0.001)
+    client = server.app.test_client()
+    payload = summer_breeze.to_dict()
+
+    assert client.post("/formulas", json=payload, headers={"Idempotency-Key": "key-1"}).status_code == 200
+    assert client.post("/formulas", json=payload, headers={"Idempotency-Key": "key-1"}).status_code == 200
+    assert client.post("/formulas", json=payload, headers={"Idempotency-Key": "key-2"}).status_code == 409
@@ -0,0 +1,57 @@
+import random
+from OsmoCaseStudy.bloom import BloomFilter
+from OsmoCaseStudy.id_set import CompactIdSet
+
+def random_ids(count, seed):
+    rng = random.Random(seed)
+    return [rng.randint(-2**63, 2**63 - 1) for _ in range(count)]
+
+def test_bloom_no_false_negatives():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    ids = random_ids(1000, seed=1)
+    for id in ids:
+        bloom.add(id)
+    assert all(id in bloom for id in ids)
+
+def test_bloom_false_positive_rate():
+    bloom = BloomFilter(capacity=10_000, error_rate=0.01)
+    for id in random_ids(10_000, seed=2):
+        bloom.add(id)
+    false_positives = sum(id in bloom for id in random_ids(10_000, seed=3))
+    assert false_positives < 300 # ~1% expected
+
+def test_id_set_exact_membership():
+    ids = CompactIdSet(block_size=16, bloom_error_rate=0.01, bloom_capacity=32)
+    added = random_ids(500, seed=4)
+    for id in added:
+        ids.add(id)
+    ids.add(added[0]) # no double counting
+
+    assert len(ids) == 500
+    assert len(ids._blocks) == 31
+    assert all(id in ids for id in added)
+    assert not any(id in ids for id in random_ids(500, seed=5))
+
+def test_id_set_discard_from_buffer_and_block():
+    ids = CompactIdSet(block_size=4)
+    for id in range(6):
+        ids.add(id)
+    ids.discard(1) # sealed block
+    ids.discard(5) # buffer
+    ids.discard(42) # never added
+    assert len(ids) == 4
+    assert sorted(ids) == [0, 2, 3, 4]
+
+def test_id_set_retention_forgets_oldest():
+    ids = CompactIdSet(block_size=10, max_entries=30, bloom_error_rate=0.01, bloom_capacity=16)
+    for id in range(100):
+        ids.add(id)
+    assert 30 <= len(ids) < 40
+    assert 0 not in ids
+    assert 99 in ids
+
+def test_id_set_memory_per_id():
+    ids = CompactIdSet(bloom_error_rate=0.01)
+    for id in random_ids(100_000, seed=6):
+        ids.add(id)
+    assert ids.nbytes() / len(ids) < 12 # vs ~60-70 bytes per entry in a set
@@ -0,0 +1,48 @@
+from unittest.mock import patch
+from OsmoCaseStudy.app import FragranceServer
+from OsmoCaseStudy.loadgen import (
+    TestClientTransport,
+    build_plan,
+    percentile,
+    run_load,
+    synthetic_formulas,
+)
+
+def test_percentile_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile(values, 99.9) == 100
+    assert percentile([], 50) == 0.0
+
+def test_synthetic_formulas_are_valid_payloads():
+    formulas = list(synthetic_formulas(10, seed=1))
+    assert len(formulas) == 10
+    for formula in formulas:
+        assert "name" in formula
+        assert 1 <= len(formula["materials"]) <= 6
+
+def test_build_plan_ratios():
+    payloads = list(synthetic_formulas(200, seed=2))
+    plan = build_plan(payloads, duplicate_ratio=0.25, key_reuse_ratio=0.25, seed=2)
+    kinds = [planned.kind for planned in plan]
+    assert kinds.count("new") == 200
+    assert kinds.count("duplicate") > 0
+    assert kinds.count("key_reuse") > 0
+
+@patch("time.sleep", return_value=None)
+def test_run_load_against_test_client(mock_sleep):
+    server = FragranceServer()
+    payloads = list(synthetic_formulas(50, seed=3))
+    plan = build_plan(payloads, duplicate_ratio=0.2, key_reuse_ratio=0.2, seed=3)
+
+    report = run_load(plan, TestClientTransport(server.app), concurrency=4)
+    summary = report.summary()
+
+    assert summary["requests"] == len(plan)
+    assert summary["errors"] == {}
+    assert set(summary["status_codes"]) <= {200, 409}
+    # every formula resent under a new key conflicts with its original (whichever lands second)
+    duplicates = sum(summary["status_codes_by_kind"]["duplicate"].values())
+    assert summary["status_codes"][409] >= duplicates
+    assert summary["latency_ms"]["p50"] <= summary["latency_ms"]["p99.9"]
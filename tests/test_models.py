@@ -1,4 +1,7 @@
+import os
 import pytest
+import subprocess
+import sys
 from decimal import Decimal
 
 from OsmoCaseStudy.models.material import Material
@@ -18,3 +21,38 @@ def test_fragrance_forumla_hashing(summer_breeze, winter_breeze, winter_breeze_d
     assert hash(summer_breeze) != hash(winter_breeze)
     assert hash(winter_breeze_dupe) == hash(winter_breeze) == hash(winter_breeze_dupe)
 
+
+def test_fragrance_formula_digest_stable_across_processes(summer_breeze):
+    # python's own hash() of strings changes with every process; formula ids must not
+    code = (
+        "from decimal import Decimal\n"
+        "from OsmoCaseStudy.models.material import Material\n"
+        "from OsmoCaseStudy.models.fragrance_formula import FragranceFormula\n"
+        "print(hash(FragranceFormula('x', (Material('Bergamot Oil', Decimal('15.5')), "
+        "Material('Lavender Absolute', Decimal('10.0')), Material('Sandalwood', Decimal('5.2'))))))"
+    )
+    for seed in ("1", "2"):
+        env = dict(os.environ, PYTHONHASHSEED=seed, PYTHONPATH=os.pathsep.join(sys.path))
+        output = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True)
+        assert int(output.stdout) == hash(summer_breeze)
+
+def test_fragrance_formula_digest_ignores_trailing_zeros(bergamot_oil):
+    written_differently = Material("Bergamot Oil", Decimal("15.50"))
+    assert hash(FragranceFormula("a", (bergamot_oil,))) == hash(FragranceFormula("b", (written_differently,)))
+
+def test_with_deltas_matches_full_rehash(summer_breeze):
+    updated = summer_breeze.with_deltas({"Lavender Absolute": Decimal("0.1"), "Jasmine": Decimal("2")})
+
+    assert [(m.name, m.concentration) for m in updated.materials] == [
+        ("Bergamot Oil", Decimal("15.5")), ("Lavender Absolute", Decimal("10.1")),
+        ("Sandalwood", Decimal("5.2")), ("Jasmine", Decimal("2")),
+    ]
+    rehashed = FragranceFormula(updated.name, tuple(Material(m.name, m.concentration) for m in updated.materials))
+    assert hash(updated) == hash(rehashed)
+    assert summer_breeze.materials[1].concentration == Decimal("10.0") # original untouched
+
+def test_with_deltas_rejects_non_positive_concentration(summer_breeze):
+    with pytest.raises(ValueError):
+        summer_breeze.with_deltas({"Sandalwood": Decimal("-5.2")})
+    with pytest.raises(ValueError):
+        summer_breeze.with_deltas({"Jasmine": Decimal("-1")})
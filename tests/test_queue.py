@@ -1,9 +1,13 @@
 import pytest
-from OsmoCaseStudy.queue import FormulaCreatedQueue
+import time
+from decimal import Decimal
+from OsmoCaseStudy.queue import FormulaCreatedQueue, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_BULK
+from OsmoCaseStudy.models.material import Material
+from OsmoCaseStudy.models.fragrance_formula import FragranceFormula
 
-from OsmoCaseStudy.queue import FormulaCreatedEvent
-from OsmoCaseStudy.queue import InProcessEvent
-from werkzeug.exceptions import InternalServerError
+from OsmoCaseStudy.queue import FormulaCreatedEvent, FormulaUpdatedEvent
+from werkzeug.exceptions import InternalServerError, ServiceUnavailable, TooManyRequests
+from OsmoCaseStudy.tests.helpers import make_formulas
 
 def test_publish_success(summer_breeze):
     q = FormulaCreatedQueue()
@@ -33,15 +37,12 @@ def test_get_next_item_success(summer_breeze, winter_breeze, another_summer_bree
 
 def test_get_next_item_expired_item(summer_breeze, winter_breeze):
     q = FormulaCreatedQueue()
+    q.publish(summer_breeze)
+    sb = q.get_next_item() # leased by a consumer
     q.publish(winter_breeze) #priority 1
-    q.publish(summer_breeze) #priority 2
     
-    # modify the event such that more than 30 seconds have passed for priority 2
-    in_process_event_mock = InProcessEvent(
-        event=FormulaCreatedEvent(summer_breeze.name, hash(summer_breeze)),
-        ack_deadline=35
-    )
-    q._in_process[hash(summer_breeze)] = in_process_event_mock
+    # modify the lease such that more than 30 seconds have passed for priority 2
+    q._in_process[sb.offset].ack_deadline = 35
 
     next_item = q.get_next_item()
 
@@ -111,3 +112,297 @@ def test_remove_correct_item_with_dupe_name(summer_breeze, another_summer_breeze
 
 
 
+def test_extend_lease_success(summer_breeze):
+    q = FormulaCreatedQueue(process_timeout=30)
+    q.publish(summer_breeze)
+    sb = q.get_next_item()
+    old_deadline = q._in_process[sb.offset].ack_deadline
+
+    assert q.extend_lease(sb.id, extension=60)
+    assert q._in_process[sb.offset].ack_deadline > old_deadline
+
+def test_extend_lease_expired_or_acked(summer_breeze):
+    q = FormulaCreatedQueue()
+    q.publish(summer_breeze)
+    sb = q.get_next_item()
+    q._in_process[sb.offset].ack_deadline = 35 # long expired
+    assert not q.extend_lease(sb.id)
+
+    q._in_process[sb.offset].ack_deadline = float("inf")
+    q.ack(sb.id)
+    assert not q.extend_lease(sb.id)
+
+def test_nack_requeues(summer_breeze, winter_breeze):
+    q = FormulaCreatedQueue()
+    q.publish(summer_breeze)
+    q.publish(winter_breeze)
+    sb = q.get_next_item()
+
+    assert q.nack(sb.id)
+    assert len(q._in_process) == 0
+    # nack'ed events go to the back of the queue
+    assert q.get_next_item().name == "Winter Breeze"
+    assert q.get_next_item().name == "Summer Breeze"
+
+def test_nack_with_delay(summer_breeze):
+    q = FormulaCreatedQueue()
+    q.publish(summer_breeze)
+    sb = q.get_next_item()
+    q.nack(sb.id, delay=60)
+    assert q.get_next_item() is None
+
+    q._delayed[0] = (0, *q._delayed[0][1:]) # pretend the delay has passed
+    assert q.get_next_item().name == "Summer Breeze"
+
+def test_remove_delayed_event(summer_breeze):
+    q = FormulaCreatedQueue()
+    q.publish(summer_breeze)
+    q.nack(q.get_next_item().id, delay=60)
+    q.remove(summer_breeze)
+    assert len(q._delayed) == 0
+    assert len(q._published_hashes) == 0
+###########################################
+# Priority lanes and tenant fairness
+###########################################
+def test_high_priority_served_first(summer_breeze, winter_breeze):
+    q = FormulaCreatedQueue()
+    q.publish(summer_breeze, priority=PRIORITY_BULK)
+    q.publish(winter_breeze, priority=PRIORITY_HIGH)
+    assert q.size_by_priority() == [1, 0, 1]
+    assert q.get_next_item().name == "Winter Breeze"
+    assert q.get_next_item().name == "Summer Breeze"
+
+def test_tenants_share_lane_fairly():
+    q = FormulaCreatedQueue()
+    bulk = [FragranceFormula(f"Bulk {i}", (Material("Amber", Decimal(i + 1)),)) for i in range(100)]
+    q.publish(bulk, tenant="bulk-loader")
+    q.publish(FragranceFormula("Single", (Material("Jasmine", Decimal(1)),)), tenant="perfumer")
+
+    # the single submission is picked up second, not after the 100 bulk events
+    names = [q.get_next_item().name for _ in range(3)]
+    assert names == ["Bulk 0", "Single", "Bulk 1"]
+
+def test_tenant_weights():
+    q = FormulaCreatedQueue(tenant_weights={"big": 3})
+    q.publish([FragranceFormula(f"Big {i}", (Material("Amber", Decimal(i + 1)),)) for i in range(6)], tenant="big")
+    q.publish([FragranceFormula(f"Small {i}", (Material("Musk", Decimal(i + 1)),)) for i in range(6)], tenant="small")
+
+    names = [q.get_next_item().name for _ in range(8)]
+    assert names == ["Big 0", "Big 1", "Big 2", "Small 0", "Big 3", "Big 4", "Big 5", "Small 1"]
+
+def test_tenant_weights_must_be_positive():
+    # a weight that never earns a credit would spin pop() forever under the queue lock
+    for weight in (0, -1):
+        with pytest.raises(ValueError):
+            FormulaCreatedQueue(tenant_weights={"stuck": weight})
+
+def test_redelivered_event_keeps_priority(summer_breeze, winter_breeze):
+    q = FormulaCreatedQueue()
+    q.publish(summer_breeze, priority=PRIORITY_HIGH)
+    sb = q.get_next_item()
+    q.publish(winter_breeze, priority=PRIORITY_NORMAL)
+    q._in_process[sb.offset].ack_deadline = 35 # expired
+
+    next_item = q.get_next_item()
+    assert next_item.name == "Summer Breeze"
+    assert next_item.priority == PRIORITY_HIGH
+
+def test_redelivered_event_gets_next_turn():
+    q = FormulaCreatedQueue()
+    q.publish(make_formulas(2), tenant="a", priority=PRIORITY_NORMAL)
+    q.publish(make_formulas(1, "Musk"), tenant="b", priority=PRIORITY_NORMAL)
+    first = q.get_next_item() # a's turn is over, b is next in line
+    q._in_process[first.offset].ack_deadline = 35 # expired
+
+    assert q.get_next_item() is first # a is still active, but the redelivery goes ahead of b
+    assert [event.tenant for event in iter(q.get_next_item, None)] == ["b", "a"]
+
+def test_remove_from_tenant_lane(summer_breeze, winter_breeze):
+    q = FormulaCreatedQueue()
+    q.publish(summer_breeze, tenant="a", priority=PRIORITY_BULK)
+    q.publish(winter_breeze, tenant="b", priority=PRIORITY_BULK)
+    q.remove(summer_breeze)
+    assert q.size() == 1
+    assert q.get_next_item().name == "Winter Breeze"
+    assert q.get_next_item() is None
+
+###########################################
+# Backpressure
+###########################################
+def test_max_depth_rejects_with_retry_after():
+    q = FormulaCreatedQueue(max_depth=2, default_retry_after=7)
+    q.publish(make_formulas(2))
+    with pytest.raises(TooManyRequests) as e_info:
+        q.publish(make_formulas(1, "Musk"))
+    assert e_info.value.retry_after == 7 # nothing acked yet - no drain rate to go on
+    assert q.size() == 2
+
+def test_max_depth_rejects_whole_list():
+    q = FormulaCreatedQueue(max_depth=3)
+    q.publish(make_formulas(2))
+    with pytest.raises(TooManyRequests):
+        q.publish(make_formulas(2, "Musk"))
+    assert q.size() == 2 # no partial publish
+
+def test_max_in_flight_counts_unacked_events():
+    q = FormulaCreatedQueue(max_in_flight=2)
+    q.publish(make_formulas(2))
+    q.get_next_item() # in process, still counts
+    with pytest.raises(ServiceUnavailable):
+        q.publish(make_formulas(1, "Musk"))
+
+    q.ack(q.get_next_item().id)
+    q.publish(make_formulas(1, "Musk"))
+
+def test_retry_after_from_drain_rate():
+    q = FormulaCreatedQueue(max_retry_after=60)
+    now = time.time()
+    q._recent_acks.extend([now - 10 + i for i in range(10)]) # ~1 ack per second
+    assert 9 <= q.retry_after(10) <= 11
+    assert q.retry_after(10_000) == 60 # capped
+
+def test_overflow_spills_and_refills(tmp_path):
+    q = FormulaCreatedQueue(max_depth=2, overflow_path=str(tmp_path / "overflow.jsonl"), overflow_max_events=3)
+    q.publish(make_formulas(5))
+    assert len(q._queued) == 2
+    assert len(q._overflow) == 3
+    assert q.size() == 5
+
+    with pytest.raises(TooManyRequests):
+        q.publish(make_formulas(1, "Musk")) # overflow full too
+
+    names = [q.get_next_item().name for _ in range(5)]
+    assert names == [f"Formula {i}" for i in range(5)] # spilled events keep their order
+    assert q.is_empty()
+    assert (tmp_path / "overflow.jsonl").stat().st_size == 0 # drained segment is truncated
+
+def test_remove_spilled_event(tmp_path):
+    q = FormulaCreatedQueue(max_depth=1, overflow_path=str(tmp_path / "overflow.jsonl"))
+    formulas = make_formulas(3)
+    q.publish(formulas)
+    q.remove(formulas[1])
+    assert not q.already_processed(formulas[1])
+
+    names = [event.name for event in iter(q.get_next_item, None)]
+    assert names == ["Formula 0", "Formula 2"]
+
+def test_failed_spill_then_retry_delivers_everything(tmp_path):
+    q = FormulaCreatedQueue(max_depth=1, overflow_path=str(tmp_path / "overflow.jsonl"))
+    q.publish(make_formulas(2, "Musk")) # one event in memory, one on disk
+    formulas = make_formulas(2)
+    append = q._overflow.append
+    def fail_once(events):
+        q._overflow.append = append
+        raise OSError("disk full")
+    q._overflow.append = fail_once
+
+    with pytest.raises(OSError):
+        q.publish(formulas) # neither event reached the file
+    q.remove(formulas) # the publisher's rollback
+    q.publish(formulas) # and retry - they spill this time
+
+    names = [event.name for event in iter(q.get_next_item, None)]
+    assert names == ["Formula 0", "Formula 1", "Formula 0", "Formula 1"] # Musk's, then the retried ones'
+    assert not q._spilled and not q._overflow_removed
+
+def test_overflow_refuses_non_empty_file(tmp_path):
+    path = tmp_path / "overflow.jsonl"
+    path.write_text('{"name": "Left over", "id": 1}\n')
+    with pytest.raises(ValueError):
+        FormulaCreatedQueue(max_depth=1, overflow_path=str(path))
+    assert path.read_text() == '{"name": "Left over", "id": 1}\n' # not truncated
+
+def test_overflow_io_outside_queue_lock(tmp_path):
+    q = FormulaCreatedQueue(max_depth=1, overflow_path=str(tmp_path / "overflow.jsonl"))
+    lock_held = []
+    append, read = q._overflow.append, q._overflow.read
+    q._overflow.append = lambda events: lock_held.append(q._lock.locked()) or append(events)
+    q._overflow.read = lambda max_events: lock_held.append(q._lock.locked()) or read(max_events)
+
+    q.publish(make_formulas(3))
+    names = [event.name for event in iter(q.get_next_item, None)]
+    assert names == ["Formula 0", "Formula 1", "Formula 2"]
+    assert lock_held and not any(lock_held)
+
+def test_publish_update_rekeys_waiting_event(summer_breeze):
+    q = FormulaCreatedQueue()
+    q.publish(summer_breeze)
+    updated = summer_breeze.with_deltas({"Sandalwood": Decimal("1")})
+    q.publish_update(updated, hash(summer_breeze), {"Sandalwood": Decimal("1")})
+
+    assert q.size() == 1 # no separate update event - the consumer hasn't seen the old version
+    assert not q.already_processed(summer_breeze)
+    assert q.already_processed(updated)
+    event = q.get_next_item()
+    assert isinstance(event, FormulaCreatedEvent)
+    assert event.id == hash(updated)
+
+def test_publish_update_after_delivery(summer_breeze):
+    q = FormulaCreatedQueue()
+    q.publish(summer_breeze)
+    q.ack(q.get_next_item().id)
+    updated = summer_breeze.with_deltas({"Sandalwood": Decimal("1")})
+    q.publish_update(updated, hash(summer_breeze), {"Sandalwood": Decimal("1")}, priority=PRIORITY_HIGH)
+
+    event = q.get_next_item()
+    assert isinstance(event, FormulaUpdatedEvent)
+    assert (event.id, event.previous_id, event.deltas) == (hash(updated), hash(summer_breeze), (("Sandalwood", "1"),))
+    assert event.priority == PRIORITY_HIGH
+
+def test_publish_update_saturated_changes_nothing(summer_breeze):
+    q = FormulaCreatedQueue(max_in_flight=1)
+    q.publish(summer_breeze)
+    q.get_next_item() # in process, so the update can't be folded into it
+    updated = summer_breeze.with_deltas({"Sandalwood": Decimal("1")})
+    with pytest.raises(ServiceUnavailable):
+        q.publish_update(updated, hash(summer_breeze), {"Sandalwood": Decimal("1")})
+    assert q.already_processed(summer_breeze)
+    assert not q.already_processed(updated)
+
+def test_update_event_survives_overflow(tmp_path, summer_breeze):
+    q = FormulaCreatedQueue(max_depth=1, overflow_path=str(tmp_path / "overflow.jsonl"))
+    q.publish(make_formulas(1))
+    q.publish(summer_breeze) # spilled
+    q.ack(q.get_next_item().id)
+    q.ack(q.get_next_item().id)
+    q.publish(make_formulas(1, "Musk"))
+    updated = summer_breeze.with_deltas({"Jasmine": Decimal("0.5")})
+    q.publish_update(updated, hash(summer_breeze), {"Jasmine": Decimal("0.5")}) # spilled
+    q.ack(q.get_next_item().id)
+
+    event = q.get_next_item()
+    assert isinstance(event, FormulaUpdatedEvent)
+    assert event.deltas == (("Jasmine", "0.5"),)
+
+def test_same_id_leased_twice(summer_breeze):
+    # A -> B -> A: the original event and the second update carry the same id
+    q = FormulaCreatedQueue()
+    q.publish(summer_breeze)
+    first = q.get_next_item()
+    deltas = {"Sandalwood": Decimal("1")}
+    updated = summer_breeze.with_deltas(deltas)
+    q.publish_update(updated, hash(summer_breeze), deltas)
+    q.ack(q.get_next_item().id)
+    q.publish_update(updated.with_deltas({"Sandalwood": Decimal("-1")}), hash(updated), {"Sandalwood": Decimal("-1")})
+    second = q.get_next_item()
+
+    assert first.id == second.id and first.offset != second.offset
+    assert len(q._in_process) == 2
+    assert q.ack(second.id, offset=second.offset)
+    assert q.ack(first.id, offset=first.offset)
+    assert len(q._in_process) == 0
+
+def test_withdraw_and_accept(summer_breeze, winter_breeze):
+    old, new = FormulaCreatedQueue(), FormulaCreatedQueue()
+    old.publish(summer_breeze)
+    event = old.withdraw(hash(summer_breeze))
+
+    assert old.is_empty() and not old.already_processed(summer_breeze)
+    new.accept(hash(summer_breeze), event)
+    assert new.get_next_item().id == hash(summer_breeze)
+
+    # a leased event stays with its consumer
+    old.publish(winter_breeze)
+    leased = old.get_next_item()
+    assert old.withdraw(hash(winter_breeze)) is None
+    assert old.ack(leased.id)
@@ -0,0 +1,84 @@
+from OsmoCaseStudy.queue import FormulaCreatedEvent, FormulaCreatedQueue
+from OsmoCaseStudy.event_log import FormulaEventLog
+from OsmoCaseStudy.segment_store import EventSegmentStore
+
+def make_events(count, start_timestamp=1_000):
+    return [FormulaCreatedEvent(f"Formula {i}", i, created_timestamp=start_timestamp + i * 10) for i in range(count)]
+
+def test_append_assigns_offsets_across_segments():
+    store = EventSegmentStore(segment_size=4)
+    offsets = [store.append(event) for event in make_events(10)]
+    assert offsets == list(range(10))
+    assert len(store._segments) == 3
+    assert store.size() == 10
+
+def test_replay_from_offset_in_batches():
+    store = EventSegmentStore(segment_size=4)
+    for event in make_events(10):
+        store.append(event)
+
+    batches = list(store.replay(from_offset=3, batch_size=3))
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    assert [event.name for batch in batches for event in batch] == [f"Formula {i}" for i in range(3, 10)]
+    assert batches[0][0].offset == 3
+    assert batches[0][0].created_timestamp == 1_030
+
+def test_replay_from_timestamp():
+    store = EventSegmentStore(segment_size=4)
+    for event in make_events(10):
+        store.append(event)
+
+    assert store.seek_timestamp(1_045) == 5
+    assert store.seek_timestamp(0) == 0
+    assert store.seek_timestamp(10_000) == 10
+    events = [event for batch in store.replay(from_timestamp=1_070) for event in batch]
+    assert [event.id for event in events] == [7, 8, 9]
+
+def test_seek_timestamp_with_out_of_order_acks():
+    store = EventSegmentStore()
+    for timestamp in [100, 300, 200, 400]:
+        store.append(FormulaCreatedEvent("f", timestamp, created_timestamp=timestamp))
+    # never skips an event created at/after the requested time
+    events = [event for batch in store.replay(from_timestamp=200) for event in batch]
+    assert [event.created_timestamp for event in events] == [300, 200, 400]
+
+def test_retention_drops_oldest_segment():
+    store = EventSegmentStore(segment_size=4, max_segments=2)
+    for event in make_events(10):
+        store.append(event)
+    assert store.first_offset() == 4
+    events = [event for batch in store.replay(from_offset=0) for event in batch]
+    assert events[0].offset == 4
+
+def test_queue_archives_acked_events(summer_breeze, winter_breeze):
+    store = EventSegmentStore()
+    q = FormulaCreatedQueue(archive=store)
+    q.publish([summer_breeze, winter_breeze])
+    q.get_next_item()
+    q.ack(q.get_next_item().id)
+    assert store.size() == 1
+    assert next(store.replay())[0].name == "Winter Breeze"
+
+def test_event_log_archives_truncated_events(summer_breeze, winter_breeze):
+    store = EventSegmentStore()
+    log = FormulaEventLog(archive=store)
+    qa = log.group("qa")
+    log.publish([summer_breeze, winter_breeze])
+    for event in iter(qa.get_next_item, None):
+        qa.ack(event.id)
+    assert log.is_empty()
+    assert [event.name for event in next(store.replay())] == ["Summer Breeze", "Winter Breeze"]
+
+def test_archived_events_keep_their_log_offsets(summer_breeze, winter_breeze, another_summer_breeze):
+    store = EventSegmentStore()
+    log = FormulaEventLog(archive=store)
+    qa = log.group("qa")
+    log.publish([summer_breeze, winter_breeze, another_summer_breeze])
+    log.remove(winter_breeze) # offset 1 is rolled back and never archived
+    for event in iter(qa.get_next_item, None):
+        qa.ack(event.id)
+
+    assert [event.offset for event in next(store.replay())] == [0, 2]
+    assert store.seek_offset(1) == 2
+    assert [event.name for batch in store.replay(from_offset=2) for event in batch] == ["Summer Breeze"]
+    assert store.end_offset() == 3
@@ -0,0 +1,181 @@
+import pytest
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from multiprocessing.connection import Listener
+from threading import Thread
+from OsmoCaseStudy.models.fragrance_formula import FragranceFormula
+from OsmoCaseStudy.models.material import Material
+from OsmoCaseStudy.queue import FormulaCreatedEvent, FormulaUpdatedEvent
+from OsmoCaseStudy.sharding import ConsistentHashRing, Shard, ShardedFragranceServer
+from OsmoCaseStudy.tests.helpers import make_formulas
+
+@pytest.fixture(scope="module")
+def sharded_server():
+    server = ShardedFragranceServer(num_shards=2)
+    yield server
+    server.shutdown()
+
+def test_ring_spreads_formulas():
+    ring = ConsistentHashRing(4)
+    counts = Counter(ring.shard_for(hash(formula)) for formula in make_formulas(4000))
+    assert set(counts) == {0, 1, 2, 3}
+    assert min(counts.values()) > 500
+
+def test_ring_moves_few_formulas_when_growing():
+    formulas = make_formulas(2000)
+    before, after = ConsistentHashRing(4), ConsistentHashRing(5)
+    moved = sum(before.shard_for(hash(f)) != after.shard_for(hash(f)) for f in formulas)
+    assert moved < len(formulas) * 0.35 # ~1/5 expected, far from the ~4/5 of modulo hashing
+
+def test_sharded_submit_and_duplicate(sharded_server, summer_breeze):
+    client = sharded_server.app.test_client()
+    payload = summer_breeze.to_dict()
+    assert client.post("/formulas", json=payload, headers={"Idempotency-Key": "s-1"}).status_code == 200
+    assert client.post("/formulas", json=payload, headers={"Idempotency-Key": "s-2"}).status_code == 409
+
+def test_sharded_list_split_across_shards(sharded_server):
+    formulas = make_formulas(40)
+    shards_used = {sharded_server.ring.shard_for(hash(formula)) for formula in formulas}
+    assert shards_used == {0, 1}
+    before = sum(stats["formulas"] for stats in sharded_server.shard_stats())
+
+    client = sharded_server.app.test_client()
+    response = client.post("/formulas", json=[f.to_dict() for f in formulas], headers={"Idempotency-Key": "s-3"})
+    assert response.status_code == 200
+    stats = sharded_server.shard_stats()
+    assert sum(shard["formulas"] for shard in stats) == before + 40
+    assert all(shard["formulas"] > 0 for shard in stats)
+
+def test_sharded_conflict_rolls_back_other_shards(sharded_server, winter_breeze):
+    client = sharded_server.app.test_client()
+    assert client.post("/formulas", json=winter_breeze.to_dict(), headers={"Idempotency-Key": "s-4"}).status_code == 200
+    conflicting_shard = sharded_server.ring.shard_for(hash(winter_breeze))
+    # a new formula that lives on the other shard
+    candidates = [FragranceFormula("Other", (Material("Musk", Decimal(i + 1)),)) for i in range(100)]
+    other = next(f for f in candidates if sharded_server.ring.shard_for(hash(f)) != conflicting_shard)
+    before = sharded_server.shard_stats()
+
+    response = client.post("/formulas", json=[other.to_dict(), winter_breeze.to_dict()], headers={"Idempotency-Key": "s-5"})
+    assert response.status_code == 409
+    assert sharded_server.shard_stats() == before
+
+def test_sharded_update_moves_between_shards(sharded_server):
+    client = sharded_server.app.test_client()
+    formula = FragranceFormula("Sharded Update", (Material("Oud", Decimal("3")),))
+    client.post("/formulas", json=formula.to_dict(), headers={"Idempotency-Key": "su-create"})
+    # find a delta that lands the updated formula on the other shard
+    shard = sharded_server.ring.shard_for(hash(formula))
+    delta = next(Decimal(i) for i in range(1, 100)
+                 if sharded_server.ring.shard_for(hash(formula.with_deltas({"Oud": Decimal(i)}))) != shard)
+    before = [stats["formulas"] for stats in sharded_server.shard_stats()]
+
+    response = client.patch(f"/formulas/{hash(formula)}", json={"materials": [{"name": "Oud", "delta": str(delta)}]},
+                            headers={"Idempotency-Key": "su-update"})
+    assert response.status_code == 200
+    after = [stats["formulas"] for stats in sharded_server.shard_stats()]
+    assert after[shard] == before[shard] - 1
+    assert sum(after) == sum(before)
+
+def start_shard(shard):
+    # runs a shard in this process, listening the way `python -m OsmoCaseStudy.sharding` does
+    listener = Listener(("127.0.0.1", 0), authkey=b"test")
+    Thread(target=shard.serve_forever, args=(listener,), daemon=True).start()
+    return listener
+
+def test_routers_share_shards(summer_breeze):
+    shard = Shard(0)
+    listener = start_shard(shard)
+    routers = [ShardedFragranceServer(addresses=[listener.address], authkey=b"test") for _ in range(2)]
+    first, second = (router.app.test_client() for router in routers)
+    payload = summer_breeze.to_dict()
+
+    assert first.post("/formulas", json=payload, headers={"Idempotency-Key": "r-1"}).status_code == 200
+    # a retry through another router is recognised, and a new key through it is a duplicate
+    assert second.post("/formulas", json=payload, headers={"Idempotency-Key": "r-1"}).status_code == 200
+    assert second.post("/formulas", json=payload, headers={"Idempotency-Key": "r-2"}).status_code == 409
+    assert shard.server.db.size() == 1
+    for router in routers:
+        router.shutdown()
+    listener.close()
+
+def test_shard_requests_do_not_wait_for_each_other():
+    class SlowShard(Shard):
+        def handle(self, op, *args):
+            if op == "submit":
+                time.sleep(0.2) # e.g. a publish_with_retry backoff
+            return super().handle(op, *args)
+
+    listener = start_shard(SlowShard(0))
+    router = ShardedFragranceServer(addresses=[listener.address], authkey=b"test")
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        results = list(pool.map(router.commit, make_formulas(10)))
+    elapsed = time.monotonic() - start
+
+    assert results == [None] * 10
+    assert elapsed < 1 # one at a time would take 2s
+    router.shutdown()
+    listener.close()
+
+def test_shard_options_passed_through(tmp_path, summer_breeze):
+    path = str(tmp_path / "formulas.bloom")
+    server = ShardedFragranceServer(num_shards=1, queue_options={"max_depth": 0},
+                                    database_options={"duplicate_filter": True, "duplicate_filter_path": path})
+    response = server.app.test_client().post("/formulas", json=summer_breeze.to_dict(), headers={"Idempotency-Key": "o-1"})
+    server.shutdown()
+
+    assert response.status_code == 429
+    assert (tmp_path / "formulas.bloom.shard-0").exists() # saved by the shard on shutdown
+
+def test_addresses_need_authkey():
+    with pytest.raises(ValueError):
+        ShardedFragranceServer(addresses=[("127.0.0.1", 1)])
+
+def moved_update(router, formula, material):
+    # a delta that lands the updated formula on another shard
+    shard = router.ring.shard_for(hash(formula))
+    delta = next(Decimal(i) for i in range(1, 100)
+                 if router.ring.shard_for(hash(formula.with_deltas({material: Decimal(i)}))) != shard)
+    return {"materials": [{"name": material, "delta": str(delta)}]}
+
+def test_cross_shard_update_moves_waiting_event():
+    shards = [Shard(0), Shard(1)]
+    listeners = [start_shard(shard) for shard in shards]
+    router = ShardedFragranceServer(addresses=[listener.address for listener in listeners], authkey=b"test")
+    client = router.app.test_client()
+    formula = FragranceFormula("Moving", (Material("Oud", Decimal("3")),))
+    client.post("/formulas", json=formula.to_dict(), headers={"Idempotency-Key": "m-create"})
+    old, new = shards[router.ring.shard_for(hash(formula))], shards[1 - router.ring.shard_for(hash(formula))]
+
+    response = client.patch(f"/formulas/{hash(formula)}", json=moved_update(router, formula, "Oud"), headers={"Idempotency-Key": "m-update"})
+    assert response.status_code == 200
+    assert old.server.q.is_empty()
+    # no consumer had seen the formula, so it's still announced as created - under its new id
+    event = new.server.q.get_next_item()
+    assert isinstance(event, FormulaCreatedEvent)
+    assert event.id == response.get_json()["id"]
+    router.shutdown()
+    for listener in listeners:
+        listener.close()
+
+def test_cross_shard_update_leaves_leases_alone():
+    shards = [Shard(0), Shard(1)]
+    listeners = [start_shard(shard) for shard in shards]
+    router = ShardedFragranceServer(addresses=[listener.address for listener in listeners], authkey=b"test")
+    client = router.app.test_client()
+    formula = FragranceFormula("Leased", (Material("Oud", Decimal("5")),))
+    client.post("/formulas", json=formula.to_dict(), headers={"Idempotency-Key": "l-create"})
+    old, new = shards[router.ring.shard_for(hash(formula))], shards[1 - router.ring.shard_for(hash(formula))]
+    leased = old.server.q.get_next_item()
+
+    response = client.patch(f"/formulas/{hash(formula)}", json=moved_update(router, formula, "Oud"), headers={"Idempotency-Key": "l-update"})
+    assert response.status_code == 200
+    assert old.server.q.ack(leased.id, offset=leased.offset) # the consumer's lease survived the move
+    event = new.server.q.get_next_item()
+    assert isinstance(event, FormulaUpdatedEvent)
+    assert event.previous_id == hash(formula)
+    router.shutdown()
+    for listener in listeners:
+        listener.close()
@@ -1,5 +1,8 @@
+import json
 import pytest
+from decimal import Decimal
 from OsmoCaseStudy.app import FragranceServer
+from OsmoCaseStudy.queue import FormulaCreatedQueue, PRIORITY_HIGH
 
 @pytest.fixture
 def server():
@@ -29,6 +32,7 @@ def test_submit_formula_valid(client, summer_breeze):
     assert response.status_code == 200
     assert "message" in response.get_json() 
     assert "Formula(s) added!" in response.get_json()["message"]
+    assert response.get_json()["ids"] == [hash(summer_breeze)] # what PATCH /formulas/<id> takes
 
 def test_submit_formula_idempotent_key_missing(client, summer_breeze):
     payload = summer_breeze.to_dict()
@@ -59,6 +63,23 @@ def test_submit_formula_idempotent_key_success(client, summer_breeze):
     )
     assert response.status_code == 200 ## same result, no error
 
+def test_submit_formula_idempotent_key_reused_for_other_request(client, server, summer_breeze, winter_breeze):
+    assert client.post("/formulas", json=summer_breeze.to_dict(), headers={"Idempotency-Key": "test-key-123"}).status_code == 200
+
+    response = client.post("/formulas", json=winter_breeze.to_dict(), headers={"Idempotency-Key": "test-key-123"})
+    assert response.status_code == 422
+    assert server.db.size() == 1
+
+def test_submit_formula_idempotent_key_reserialized_retry(client, server, summer_breeze):
+    payload = summer_breeze.to_dict()
+    headers = {"Idempotency-Key": "test-key-123", "Content-Type": "application/json"}
+    first = client.post("/formulas", data=json.dumps(payload), headers=headers)
+    retry = client.post("/formulas", data=json.dumps(payload, indent=2, sort_keys=True), headers=headers)
+
+    assert first.status_code == retry.status_code == 200 # same JSON, differently serialized - a replay, not a 422
+    assert retry.get_json() == first.get_json()
+    assert server.db.size() == 1
+
 def test_submit_formula_valid_duplicate(client, summer_breeze):
     # "valid" duplicate meaning it's not an accidental duplicate submission
     # the user tried to add the same formula in two separate requests
@@ -229,4 +250,121 @@ def test_omit_info_materials(client, jasmine, bergamot_oil):
 
 
 
-   
\ No newline at end of file
+   
+###################
+# Priority / Tenant Headers
+###################
+def test_submit_formula_priority_headers(client, server, summer_breeze):
+    response = client.post(
+        "/formulas",
+        json=summer_breeze.to_dict(),
+        headers={"Idempotency-Key": "test-key-123", "X-Priority": "high", "X-Tenant-Id": "perfumer"}
+    )
+    assert response.status_code == 200
+    event = server.q.get_next_item()
+    assert event.priority == PRIORITY_HIGH
+    assert event.tenant == "perfumer"
+
+def test_submit_formula_list_defaults_to_bulk(client, server, summer_breeze, winter_breeze):
+    response = client.post(
+        "/formulas",
+        json=[summer_breeze.to_dict(), winter_breeze.to_dict()],
+        headers={"Idempotency-Key": "test-key-123"}
+    )
+    assert response.status_code == 200
+    assert server.q.size_by_priority() == [0, 0, 2]
+
+def test_submit_formula_invalid_priority(client, summer_breeze):
+    response = client.post(
+        "/formulas",
+        json=summer_breeze.to_dict(),
+        headers={"Idempotency-Key": "test-key-123", "X-Priority": "urgent"}
+    )
+    assert response.status_code == 400
+
+###################
+# Backpressure
+###################
+def test_submit_formula_queue_full(summer_breeze, winter_breeze):
+    server = FragranceServer(queue=FormulaCreatedQueue(max_depth=1, default_retry_after=3))
+    client = server.app.test_client()
+    response = client.post("/formulas", json=summer_breeze.to_dict(), headers={"Idempotency-Key": "key-1"})
+    assert response.status_code == 200
+
+    response = client.post("/formulas", json=winter_breeze.to_dict(), headers={"Idempotency-Key": "key-2"})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "3"
+    assert server.db.size() == 1 # rolled back
+
+    # once the queue drains, the same key goes through - the 429 wasn't cached
+    server.q.ack(server.q.get_next_item().id)
+    response = client.post("/formulas", json=winter_breeze.to_dict(), headers={"Idempotency-Key": "key-2"})
+    assert response.status_code == 200
+
+###################
+# PATCH updates
+###################
+def test_update_formula(client, server, summer_breeze):
+    created = client.post("/formulas", json=summer_breeze.to_dict(), headers={"Idempotency-Key": "create"})
+    (id,) = created.get_json()["ids"]
+
+    response = client.patch(
+        f"/formulas/{id}",
+        json={"materials": [{"name": "Lavender Absolute", "delta": 0.1}]},
+        headers={"Idempotency-Key": "update"}
+    )
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["previous_id"] == id
+    assert body["formula"]["materials"][1] == {"name": "Lavender Absolute", "concentration": 10.1}
+    assert server.db.get(id) is None
+    assert server.db.get(body["id"]).materials[1].concentration == Decimal("10.1") # exact, not 10.100000000000001
+
+    # a retry with the same key doesn't apply the delta again
+    retry = client.patch(
+        f"/formulas/{id}",
+        json={"materials": [{"name": "Lavender Absolute", "delta": 0.1}]},
+        headers={"Idempotency-Key": "update"}
+    )
+    assert retry.status_code == 200
+    assert retry.get_json()["id"] == body["id"]
+    assert server.db.size() == 1
+
+def test_update_formula_concentration_must_stay_positive(client, winter_breeze):
+    client.post("/formulas", json=winter_breeze.to_dict(), headers={"Idempotency-Key": "create"})
+    response = client.patch(
+        f"/formulas/{hash(winter_breeze)}",
+        json={"materials": [{"name": "Amber", "delta": -14.3}]},
+        headers={"Idempotency-Key": "update"}
+    )
+    assert response.status_code == 400 # concentration must stay above 0
+
+def test_update_formula_conflict(client, server, another_summer_breeze):
+    client.post("/formulas", json=another_summer_breeze.to_dict(), headers={"Idempotency-Key": "create"})
+    existing = another_summer_breeze.with_deltas({"Jasmine": Decimal("2")})
+    server.db.add_formulas(existing)
+
+    response = client.patch(f"/formulas/{hash(another_summer_breeze)}", json={"materials": [{"name": "Jasmine", "delta": 2}]},
+                            headers={"Idempotency-Key": "update"})
+    assert response.status_code == 409
+    assert server.db.get(hash(another_summer_breeze)) == another_summer_breeze # unchanged
+    assert server.db.get(hash(existing)) is existing
+
+def test_idempotency_key_reused_across_endpoints(client, summer_breeze):
+    client.post("/formulas", json=summer_breeze.to_dict(), headers={"Idempotency-Key": "create"})
+    url = f"/formulas/{hash(summer_breeze)}"
+    deltas = {"materials": [{"name": "Jasmine", "delta": 1}]}
+
+    assert client.patch(url, json=deltas, headers={"Idempotency-Key": "create"}).status_code == 422
+    assert client.patch(url, json=deltas, headers={"Idempotency-Key": "update"}).status_code == 200
+    assert client.post("/formulas", json=summer_breeze.to_dict(), headers={"Idempotency-Key": "update"}).status_code == 422
+
+def test_update_formula_invalid(client, summer_breeze):
+    client.post("/formulas", json=summer_breeze.to_dict(), headers={"Idempotency-Key": "create"})
+    url = f"/formulas/{hash(summer_breeze)}"
+    assert client.patch(url, json={"materials": [{"name": "Jasmine", "delta": 1}]}).status_code == 400 # no key
+    assert client.patch(url, json={"materials": []}, headers={"Idempotency-Key": "a"}).status_code == 400
+    assert client.patch(url, json={"materials": [{"name": "Jasmine", "delta": "lots"}]}, headers={"Idempotency-Key": "b"}).status_code == 400
+    assert client.patch(url, json={"materials": [{"name": "Jasmine", "delta": 0}]}, headers={"Idempotency-Key": "c"}).status_code == 400
+    assert client.patch("/formulas/123", json={"materials": [{"name": "Jasmine", "delta": 1}]},
+                        headers={"Idempotency-Key": "d"}).status_code == 404
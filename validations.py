@@ -1,6 +1,10 @@
+import json
+from decimal import Decimal, InvalidOperation
+from hashlib import blake2b
 from werkzeug.exceptions import BadRequest
 from OsmoCaseStudy.models.material import Material
 from OsmoCaseStudy.models.fragrance_formula import FragranceFormula
+from OsmoCaseStudy.queue import PRIORITIES, DEFAULT_TENANT
 
 # A file for validating functions
 # Separated out from app.py simply for organization 
@@ -46,4 +50,86 @@ def validate_materials(request_materials: list):
         )
         for material in request_materials
     ]
-    return formula_materials
\ No newline at end of file
+    return formula_materials
+
+def validate_deltas(request: dict):
+    """
+    Validates a PATCH body: {"materials": [{"name": "Jasmine", "delta": 0.1}, ...]}
+    and returns the deltas as a dict (Key: material name, Value: Decimal change in concentration).
+    """
+    if not request or not isinstance(request, dict):
+        raise BadRequest("Invalid or missing JSON")
+    if "materials" not in request:
+        raise BadRequest("Missing field 'materials' on formula update")
+    if not isinstance(request["materials"], list) or not request["materials"]:
+        raise BadRequest("A formula update's materials must be a non-empty list")
+
+    deltas = {}
+    for material in request["materials"]:
+        if not isinstance(material, dict) or "name" not in material:
+            raise BadRequest("Missing field 'name' on a material")
+        if "delta" not in material:
+            raise BadRequest("Missing field 'delta' on a material")
+        name = material["name"]
+        if not isinstance(name, str):
+            raise BadRequest("Invalid type in the request: Material name must be a string")
+        if name in deltas:
+            raise BadRequest(f"Material {name!r} appears more than once in the update")
+        if isinstance(material["delta"], bool):
+            raise BadRequest("Invalid type in the request: Material delta must be a decimal")
+        try:
+            ## Note: via str so a JSON float like 0.1 becomes Decimal('0.1'), not its binary approximation
+            delta = Decimal(str(material["delta"]))
+        except InvalidOperation:
+            raise BadRequest("Invalid type in the request: Material delta must be a decimal")
+        if not delta.is_finite() or delta == 0:
+            raise BadRequest(f"Invalid delta for material {name!r}: must be a non-zero number")
+        deltas[name] = delta
+    return deltas
+
+EXPORT_FIELDS = ("id", "name", "materials")
+
+def validate_export_options(args):
+    """
+    Reads the export query string:
+    - cursor: the `cursor` of the last record received, to resume after it
+    - fields: comma-separated subset of id,name,materials (default: all)
+    """
+    cursor = args.get("cursor")
+    if cursor is not None:
+        try:
+            cursor = int(cursor)
+        except ValueError:
+            raise BadRequest("Invalid cursor, expected the cursor of a previously exported record")
+
+    fields = args.get("fields")
+    if fields is not None:
+        fields = {field.strip() for field in fields.split(",") if field.strip()}
+        unknown = fields - set(EXPORT_FIELDS)
+        if not fields or unknown:
+            raise BadRequest(f"Invalid fields, expected a comma-separated list of: {', '.join(EXPORT_FIELDS)}")
+    return cursor, fields
+
+def validate_publish_options(headers, formulas):
+    """
+    Reads which tenant is submitting and how urgent it is from the request headers:
+    - X-Tenant-Id: tenants get a fair share of the queue against each other (default: "default")
+    - X-Priority: high | normal | bulk. Without it, list submissions of more than one formula are
+      treated as bulk so large loads don't delay single interactive submissions.
+    """
+    tenant = headers.get("X-Tenant-Id", DEFAULT_TENANT)
+    priority_name = headers.get("X-Priority")
+    if priority_name is None:
+        priority_name = "bulk" if isinstance(formulas, list) and len(formulas) > 1 else "normal"
+    if priority_name.lower() not in PRIORITIES:
+        raise BadRequest(f"Invalid X-Priority header, expected one of: {', '.join(PRIORITIES)}")
+    return {"tenant": tenant, "priority": PRIORITIES[priority_name.lower()]}
+
+def request_fingerprint(method, path, body: bytes):
+    # identifies what an Idempotency-Key was first used for, so reusing the key for a different request can be refused.
+    # A JSON body is compared in canonical form, so a retry that re-serializes the same payload still matches
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True, separators=(",", ":")).encode()
+    except ValueError:
+        pass # not JSON - compare the raw bytes
+    return blake2b(f"{method} {path}\n".encode() + body, digest_size=16).hexdigest()